@@ -0,0 +1,109 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+# DISCOVERs and REQUESTs of many clients answered by the DHCP server on
+# loopback, handled directly and replayed from the network.
+#
+# Usage: python benchmarks/dhcp.py [CLIENTS]
+
+import os
+import sys
+import time
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lcrs.master.dhcp import packet
+from lcrs.master.dhcp.leases import LeaseManager
+from lcrs.master.dhcp.dhcp_manager import DHCPManager, RECEIVE_BUFFER
+
+def make_request(message_type, mac, xid, requested_ip=None, server_id=None):
+    """A client's packet"""
+    chaddr = "".join(chr(int(b, 16)) for b in mac.split(":"))
+    options = [(packet.OPTION_MESSAGE_TYPE, chr(message_type))]
+    if requested_ip:
+        options.append((packet.OPTION_REQUESTED_IP, socket.inet_aton(requested_ip)))
+    if server_id:
+        options.append((packet.OPTION_SERVER_ID, socket.inet_aton(server_id)))
+    header = packet.BOOTP_HEADER.pack(packet.BOOTREQUEST, 1, len(chaddr), 0, xid, 0, 0x8000,
+                                      packet.ZERO_IP, packet.ZERO_IP, packet.ZERO_IP, packet.ZERO_IP,
+                                      chaddr.ljust(16, "\0"), "\0" * 64, "\0" * 128)
+    return header + packet.MAGIC_COOKIE + packet.encode_options(options)
+
+def bench_dhcp(clients):
+    macs = ["02:00:00:%02x:%02x:%02x" % (i >> 16, (i >> 8) & 255, i & 255) for i in range(clients)]
+    leases = LeaseManager(["10.%d.%d.%d" % (i >> 16, (i >> 8) & 255, i & 255) for i in range(clients)])
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    client.bind(("127.0.0.1", 0))
+    client.settimeout(0.5)
+    manager = DHCPManager(lambda mac: leases.lease(mac)[0], "127.0.0.1", None,
+                          server_port=0, client_port=client.getsockname()[1],
+                          broadcast_address="127.0.0.1", netmask="255.255.255.0")
+    server = ("127.0.0.1", manager.dhcp_socket.getsockname()[1])
+
+    def receive():
+        """Replies by message type, until none has come for a while"""
+        replies = {}
+        while True:
+            try:
+                data = client.recv(4096)
+            except socket.timeout:
+                return replies
+            message_type = ord(packet.parse_options(data, packet.OPTIONS_OFFSET)[packet.OPTION_MESSAGE_TYPE])
+            replies[message_type] = replies.get(message_type, 0) + 1
+
+    # Every client is new, then every client retransmits
+    discovers = [make_request(packet.DISCOVER, mac, i) for i, mac in enumerate(macs)]
+    started = time.time()
+    for data in discovers:
+        manager.handle_packet(data)
+    first = time.time() - started
+    started = time.time()
+    for data in discovers:
+        manager.handle_packet(data)
+    repeated = time.time() - started
+    receive()
+    print "%d DISCOVERs: %.3f s (%.0f us each), %d retransmits: %.3f s" % (
+        clients, first, first / clients * 1e6, clients, repeated)
+
+    # A burst from the network: each client sends its DISCOVER three
+    # times, then its REQUEST twice
+    manager.memory.clear()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    started = time.time()
+    for data in discovers * 3:
+        sender.sendto(data, server)
+    offers = receive().get(packet.OFFER, 0)
+    print "Replay of %d DISCOVERs: %d OFFERs in %.3f s" % (
+        clients * 3, offers, time.time() - started - client.gettimeout())
+    requests = [make_request(packet.REQUEST, mac, i, leases.get(mac), "127.0.0.1")
+                for i, mac in enumerate(macs)]
+    started = time.time()
+    for data in requests * 2:
+        sender.sendto(data, server)
+    acks = receive().get(packet.ACK, 0)
+    print "Replay of %d REQUESTs: %d ACKs in %.3f s" % (
+        clients * 2, acks, time.time() - started - client.gettimeout())
+    print "Stats: %s" % ", ".join("%s %d" % item for item in sorted(manager.stats.items()))
+    manager.close()
+
+if __name__ == "__main__":
+    bench_dhcp(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,63 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+# Decode a HARDWARE reply holding a dmesg of 2 MB, received in 4 KB
+# chunks, the way it was done before frames and with them.
+#
+# Usage: python benchmarks/frames.py [MB]
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lcrs.slave.protocol import HARDWARE, IDLE, pack_frame, FrameDecoder
+
+def bench_frames(size):
+    line = "[%12.6f] ata1.00: ATA-8: WDC WD5000AAKS-00V1A0, 05.01D05, max UDMA/133\n"
+    dmesg = "".join(line % (i * 0.001) for i in range(size // len(line % 0)))
+    reply = [HARDWARE, IDLE, {"dmesg": [dmesg, ""]}]
+
+    # Parse everything received so far after every chunk, until it
+    # is a whole JSON document
+    data = json.dumps(reply[1:])
+    started = time.time()
+    received = ""
+    failed = 0
+    for i in range(0, len(data), 4096):
+        received += data[i:i + 4096]
+        try:
+            json.loads(received)
+            break
+        except ValueError:
+            failed += 1
+    print "Parse on every recv: %.3f s, %d failed parses" % (time.time() - started, failed)
+
+    frame = pack_frame(reply)
+    started = time.time()
+    decoder = FrameDecoder()
+    messages = []
+    for i in range(0, len(frame), 4096):
+        messages += decoder.feed(frame[i:i + 4096])
+    print "FrameDecoder:        %.3f s, %d message of %d bytes" % (time.time() - started, len(messages), len(frame))
+
+if __name__ == "__main__":
+    bench_frames(int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 2 * 1024 * 1024)
@@ -0,0 +1,114 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+# Serve the directory of the files on loopback and let CLIENTS clients
+# fetch them at once, first by TFTP as pxelinux does and then over one
+# keep-alive HTTP connection each. The files must be in one directory.
+#
+# Usage: python benchmarks/httpboot.py CLIENTS FILE [FILE ...]
+
+import os
+import sys
+import time
+import socket
+import struct
+import urllib
+import httplib
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lcrs.master import tftp
+from lcrs.master.bootfiles import BootFileCache
+from lcrs.master.httpboot import HTTPBootServer
+
+def tftp_fetch(port, filename, blksize=1408):
+    """Receive a file one block at a time"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5.0)
+    sock.sendto(struct.pack("!H", tftp.OP_RRQ) + filename + "\0octet\0blksize\0%d\0" % blksize,
+                ("127.0.0.1", port))
+    received = 0
+    try:
+        while True:
+            data, peer = sock.recvfrom(65536)
+            opcode, block = struct.unpack("!HH", data[:4])
+            if opcode == tftp.OP_ERROR:
+                raise tftp.TransferError(block, data[4:].rstrip("\0"))
+            if opcode == tftp.OP_OACK:
+                # The options are acknowledged as block 0
+                block = 0
+            sock.sendto(struct.pack("!HH", tftp.OP_ACK, block), peer)
+            if opcode == tftp.OP_DATA:
+                received += len(data) - 4
+                if len(data) - 4 < blksize:
+                    return received
+    finally:
+        sock.close()
+
+def tftp_boot(port, filenames):
+    for filename in filenames:
+        tftp_fetch(port, filename)
+
+def http_boot(port, filenames):
+    conn = httplib.HTTPConnection("127.0.0.1", port)
+    for filename in filenames:
+        conn.request("GET", "/" + urllib.quote(filename))
+        conn.getresponse().read()
+    conn.close()
+
+def run(label, boot, port, filenames, size, clients):
+    durations = []
+    def client():
+        started = time.time()
+        boot(port, filenames)
+        durations.append(time.time() - started)
+    threads = [threading.Thread(target=client) for __ in range(clients)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - started
+    print "%-24s %d clients in %.2f s, %.2f s each on average, %.1f MB/s" % (
+        label, clients, duration, sum(durations) / len(durations), size * clients / duration / 1e6)
+
+def bench_boot(paths, clients):
+    root = os.path.dirname(os.path.abspath(paths[0]))
+    filenames = [os.path.basename(path) for path in paths]
+    size = sum(os.path.getsize(os.path.join(root, filename)) for filename in filenames)
+    cache = BootFileCache()
+    tftp_server = tftp.TFTPServer(root, "127.0.0.1", 0, cache)
+    http_server = HTTPBootServer(root, "127.0.0.1", 0, cache)
+    for target in (tftp_server.serve_forever, http_server.serve_forever):
+        t = threading.Thread(target=target)
+        t.setDaemon(True)
+        t.start()
+    run("TFTP, blksize 1408", tftp_boot, tftp_server.port, filenames, size, clients)
+    run("HTTP, keep-alive", http_boot, http_server.port, filenames, size, clients)
+    tftp_server.stop()
+    http_server.shutdown()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "Usage: %s CLIENTS FILE [FILE ...]" % sys.argv[0]
+        sys.exit(1)
+    logging.basicConfig(level=logging.ERROR)
+    bench_boot(sys.argv[2:], int(sys.argv[1]))
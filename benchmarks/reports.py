@@ -0,0 +1,70 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+# Write reports of made up computers in 4 groups, and of every computer
+# in DATABASE if it is given.
+#
+# Usage: python benchmarks/reports.py [COMPUTERS [DATABASE]]
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lcrs.master.reports import (REPORT_FORMATS, make_record, filter_records,
+                                 history_records, write_report)
+
+def made_up_records(count, now):
+    for i in range(count):
+        hw_info = {"BIOS S/N": "SN%d" % i,
+                   "CPU": {"name": "Intel Core 2 Duo"},
+                   "Memory": 2048,
+                   "System UUID": "uuid-%d" % i,
+                   "Hard drives": {"sda": {"Size": 160000, "Serial": "WD-%d" % i},
+                                   "sdb": {"Size": 80000, "Serial": "ST-%d" % i}}}
+        yield make_record(hw_info, "Group %d" % (i % 4), "ID%05d" % i,
+                          "02:00:00:00:%02x:%02x" % (i >> 8, i & 255), True,
+                          "native wipe (zeros)", now - timedelta(days=i % 30))
+
+def run(label, records, fmt):
+    f = open(os.devnull, "w")
+    started = time.time()
+    written = write_report(f, records, fmt)
+    f.close()
+    print "%-32s %6d computers in %.2f s" % (label, written, time.time() - started)
+
+def bench_reports(count, database_path=None):
+    now = datetime.now()
+    for fmt in sorted(REPORT_FORMATS):
+        run("Groups, %s" % fmt, made_up_records(count, now), fmt)
+    run("Group 1, last 7 days, csv", filter_records(made_up_records(count, now), since=now - timedelta(days=7),
+                                                     group_names=["Group 1"]), "csv")
+
+    if database_path:
+        from lcrs.master.database import Database
+        database = Database(database_path)
+        for fmt in sorted(REPORT_FORMATS):
+            run("History, %s" % fmt, history_records(database), fmt)
+        run("History, last 7 days, csv", history_records(database, since=now - timedelta(days=7)), "csv")
+
+if __name__ == "__main__":
+    bench_reports(int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+                  sys.argv[2] if len(sys.argv) > 2 else None)
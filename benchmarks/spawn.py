@@ -0,0 +1,68 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+# Spawn-to-result latency of short commands, all serviced by the shared
+# reactor of asyncproc.
+#
+# Usage: python benchmarks/spawn.py [COMMANDS]
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lcrs.slave.asyncproc import Process
+
+def bench_spawn(count):
+    latencies = []
+    started = time.time()
+    for i in range(count):
+        spawned = time.time()
+        p = Process("echo %d" % i, shell=True)
+        p.wait()
+        assert p.read() == "%d\n" % i
+        latencies.append(time.time() - spawned)
+    latencies.sort()
+    print "%d commands one at a time: %.3f s, median %.2f ms, p95 %.2f ms" % (
+        count, time.time() - started, latencies[count // 2] * 1000,
+        latencies[int(count * 0.95)] * 1000)
+
+    started = time.time()
+    processes = [Process("echo %d" % i, shell=True) for i in range(count)]
+    threads = threading.activeCount()
+    for i, p in enumerate(processes):
+        p.wait()
+        assert p.read() == "%d\n" % i
+    print "%d commands at once:       %.3f s, %d threads" % (count, time.time() - started, threads)
+
+    results = {}
+    done = threading.Event()
+    def on_exit(process, exitstatus):
+        results[process] = process.read()
+        if len(results) == count:
+            done.set()
+    started = time.time()
+    processes = [Process("echo %d" % i, shell=True, on_exit=on_exit) for i in range(count)]
+    done.wait(30)
+    print "%d commands with on_exit:  %.3f s, %d results" % (count, time.time() - started, len(results))
+
+if __name__ == "__main__":
+    bench_spawn(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
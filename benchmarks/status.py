@@ -0,0 +1,70 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+# Round trips of STATUS requests to a running slave, from 50 framed
+# connections at the same time.
+#
+# Usage: python benchmarks/status.py [HOST [POLLERS [REQUESTS]]]
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lcrs.slave import settings
+from lcrs.slave.protocol import STATUS, PROTOCOL_VERSION, FRAME_HEADER, pack_frame, recv_exactly
+
+def recv_frame(sock):
+    (length,) = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    return json.loads(recv_exactly(sock, length))
+
+def bench_status(host, pollers, requests):
+    latencies = []
+    lock = threading.Lock()
+
+    def poll():
+        sock = socket.create_connection((host, settings.LISTEN_PORT))
+        sock.sendall(json.dumps([STATUS, {'upgrade': PROTOCOL_VERSION}]))
+        recv_frame(sock)
+        for request_id in range(requests):
+            started = time.time()
+            sock.sendall(pack_frame([request_id, STATUS, {}]))
+            recv_frame(sock)
+            lock.acquire()
+            latencies.append(time.time() - started)
+            lock.release()
+        sock.close()
+
+    threads = [threading.Thread(target=poll) for __ in range(pollers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    print "%d STATUS requests from %d pollers: median %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        len(latencies), pollers, latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000)
+
+if __name__ == "__main__":
+    args = sys.argv[1:] + [None] * 3
+    bench_status(args[0] or "127.0.0.1", int(args[1] or 50), int(args[2] or 40))
@@ -0,0 +1,130 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+# Serve the directory of FILE on loopback and fetch FILE with several
+# block and window sizes, then with CLIENTS clients at once. tftpy is
+# measured as well if it can be imported.
+#
+# Usage: python benchmarks/tftp.py FILE [CLIENTS]
+
+import os
+import sys
+import time
+import socket
+import struct
+import logging
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lcrs.master.tftp import (TFTPServer, TransferError, DEFAULT_BLKSIZE,
+                              OP_RRQ, OP_ACK, OP_OACK, OP_ERROR)
+
+def fetch(port, filename, blksize=None, windowsize=None):
+    """Receive filename and return its size, acknowledging each
+       window as a client following RFC 7440 would"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    sock.settimeout(5.0)
+    options = ""
+    if blksize:
+        options += "blksize\0%d\0" % blksize
+    if windowsize:
+        options += "windowsize\0%d\0" % windowsize
+    sock.sendto(struct.pack("!H", OP_RRQ) + filename + "\0octet\0" + options, ("127.0.0.1", port))
+    size, window = DEFAULT_BLKSIZE, 1
+    expected, unacked, received = 1, 0, 0
+    try:
+        while True:
+            data, peer = sock.recvfrom(65536)
+            opcode = struct.unpack("!H", data[:2])[0]
+            if opcode == OP_OACK:
+                fields = data[2:].split("\0")
+                accepted = dict(zip(fields[0::2], fields[1::2]))
+                size = int(accepted.get("blksize", DEFAULT_BLKSIZE))
+                window = int(accepted.get("windowsize", 1))
+                sock.sendto(struct.pack("!HH", OP_ACK, 0), peer)
+                continue
+            if opcode == OP_ERROR:
+                raise TransferError(struct.unpack("!H", data[2:4])[0], data[4:].rstrip("\0"))
+            if struct.unpack("!H", data[2:4])[0] != expected & 0xffff:
+                # A block was lost, ask for the rest after the last good one
+                sock.sendto(struct.pack("!HH", OP_ACK, (expected - 1) & 0xffff), peer)
+                unacked = 0
+                continue
+            received += len(data) - 4
+            expected += 1
+            unacked += 1
+            last = len(data) - 4 < size
+            if last or unacked == window:
+                sock.sendto(struct.pack("!HH", OP_ACK, (expected - 1) & 0xffff), peer)
+                unacked = 0
+            if last:
+                return received
+    finally:
+        sock.close()
+
+def run(label, path, port, count=1, **options):
+    root, filename = os.path.split(path)
+    threads = [threading.Thread(target=fetch, args=(port, filename), kwargs=options) for __ in range(count)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.time() - started
+    print "%-36s %7.1f MB/s" % (label, os.path.getsize(path) * count / duration / 1e6)
+
+def bench_tftp(path, clients):
+    root = os.path.dirname(path)
+    server = TFTPServer(root, "127.0.0.1", 0)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    run("built-in, 512 byte blocks", path, server.port)
+    run("built-in, blksize 1468", path, server.port, blksize=1468)
+    run("built-in, 1468, windowsize 16", path, server.port, blksize=1468, windowsize=16)
+    run("%d clients, built-in, 1468/16" % clients, path, server.port, clients, blksize=1468, windowsize=16)
+    server.stop()
+
+    try:
+        import tftpy #@UnresolvedImport
+    except ImportError:
+        print "tftpy is not installed, it is left out"
+        return
+    logging.getLogger('tftpy').setLevel(logging.ERROR)
+    free = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    free.bind(("127.0.0.1", 0))
+    port = free.getsockname()[1]
+    free.close()
+    tftpy_server = tftpy.TftpServer(root)
+    t = threading.Thread(target=tftpy_server.listen, args=("127.0.0.1", port))
+    t.setDaemon(True)
+    t.start()
+    time.sleep(0.5)
+    run("tftpy, 512 byte blocks", path, port)
+    run("tftpy, blksize 1468", path, port, blksize=1468)
+    run("%d clients, tftpy, 1468" % clients, path, port, clients, blksize=1468)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: %s FILE [CLIENTS]" % sys.argv[0]
+        sys.exit(1)
+    logging.basicConfig(level=logging.ERROR)
+    bench_tftp(os.path.abspath(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,101 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The files that slaves boot from, memory mapped once and shared by all
+transfers of them. A file is mapped again when it has been changed on
+disk; transfers that started before keep the old mapping until they
+end. So memory use follows the size of the boot files, not the number
+of clients.
+"""
+
+import os
+import mmap
+import logging
+import threading
+
+logger = logging.getLogger('lcrs')
+
+def resolve(root, filename):
+    """The path of a requested file under root, or None if the name
+       points outside of it"""
+    filename = filename.replace("\\", "/").lstrip("/")
+    path = os.path.normpath(os.path.join(root, filename))
+    if not (path == root or path.startswith(root + os.sep)):
+        return None
+    return path
+
+class BootFile():
+    """A mapped file. data may be sliced like a string."""
+
+    def __init__(self, path, st):
+        self.path = path
+        self.size = st.st_size
+        self.signature = (st.st_ino, st.st_size, st.st_mtime)
+        self.f = open(path, "rb")
+        if self.size:
+            self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files cannot be mapped
+            self.data = ""
+
+    def fileno(self):
+        return self.f.fileno()
+
+class BootFileCache():
+    """
+    Files by path. get() may be called from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.__files = {}
+        self.stats = {'hits': 0, 'misses': 0, 'invalidated': 0}
+
+    def get(self, path):
+        """The BootFile of path, mapping it if it is new or has changed.
+           Raises IOError or OSError if it cannot be read."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.lock.acquire()
+            self.__files.pop(path, None)
+            self.lock.release()
+            raise
+        self.lock.acquire()
+        try:
+            bootfile = self.__files.get(path, None)
+            if bootfile and bootfile.signature == (st.st_ino, st.st_size, st.st_mtime):
+                self.stats['hits'] += 1
+                return bootfile
+            if bootfile:
+                logger.info("%s has changed, mapping it again" % path)
+                self.stats['invalidated'] += 1
+            self.stats['misses'] += 1
+            bootfile = BootFile(path, st)
+            self.__files[path] = bootfile
+            return bootfile
+        finally:
+            self.lock.release()
+
+    def cached_bytes(self):
+        self.lock.acquire()
+        size = sum(bootfile.size for bootfile in self.__files.values())
+        self.lock.release()
+        return size
@@ -20,13 +20,11 @@
 import threading
 import logging
 import time
-import socket
-import sys
-import simplejson as json
 from datetime import datetime
 
 from lcrs.slave import protocol
 from lcrs.slave import settings as slave_settings
+from lcrs.master.connection import SlaveConnection, ConnectionException
 
 import re
 import random
@@ -35,13 +33,6 @@ import random
 logger = logging.getLogger('lcrs')
 
 # Exceptions. All are handled within the computer object!
-class ConnectionException(Exception):
-    """Raised when a socket error occurs"""
-    def __init__(self, value):
-        self.parameter = value
-    def __str__(self):
-        return repr(self.parameter)
-
 class ResponseFailException(Exception):
     """Raised when remote site sends back"""
     def __init__(self, value):
@@ -77,6 +68,11 @@ class State:
         self.__wipe_info = ""
         self.__scan_info = ""
         self.__progress = 0.0
+        # Current and average bytes per second, and seconds left, of
+        # the current activity. None when not known.
+        self.__throughput = None
+        self.__avg_throughput = None
+        self.__eta = None
     
     def update(self, state, info=None, progress=None):
         self.lock.acquire()
@@ -103,6 +99,10 @@ class State:
             self.update_progress(progress)
         
         self.__state = state
+        if not state in [State.SCANNING, State.WIPING]:
+            self.__throughput = None
+            self.__avg_throughput = None
+            self.__eta = None
         if not info is None:
             self.__info = info
             if self.state in [State.SCANNING, State.SCANNED, State.SCAN_FAILED]:
@@ -120,6 +120,15 @@ class State:
             self.__progress = progress
         self.lock.release()
     
+    def update_rates(self, throughput, avg_throughput, eta):
+        """Throughput in bytes per second and ETA in seconds"""
+        self.lock.acquire()
+        if self.state == State.WIPING:
+            self.__throughput = throughput
+            self.__avg_throughput = avg_throughput
+            self.__eta = eta
+        self.lock.release()
+    
     @property
     def is_connected(self):
         self.lock.acquire()
@@ -154,8 +163,31 @@ class State:
         _progress = self.__progress
         self.lock.release()
         return _progress
+    
+    @property
+    def throughput(self):
+        self.lock.acquire()
+        _throughput = self.__throughput
+        self.lock.release()
+        return _throughput
+    
+    @property
+    def avg_throughput(self):
+        self.lock.acquire()
+        _avg_throughput = self.__avg_throughput
+        self.lock.release()
+        return _avg_throughput
+    
+    @property
+    def eta(self):
+        self.lock.acquire()
+        _eta = self.__eta
+        self.lock.release()
+        return _eta
 
-# Shell commands for the first iteration and functions for analyzing data
+# Shell commands for the first iteration and functions for analyzing data.
+# Instead of just the function, a tuple (function, timeout) overrides
+# SCAN_TIMEOUT for that command.
 SCAN_ITERATION_1 = {
     "/usr/sbin/lspci": "analyze_lspci_data",
     "dmesg": "analyze_dmesg_data",
@@ -169,15 +201,22 @@ SCAN_ITERATION_1 = {
     "cat /proc/meminfo": "analyze_meminfo_data",
     "cat /proc/cpuinfo": "analyze_cpu_data",
     "cat /proc/sys/dev/cdrom/info": "analyze_cdrom_info",
-    "cat /proc/acpi/battery/BAT0/info": "analyze_battery_info",
+    "cat /proc/acpi/battery/BAT0/info": ("analyze_battery_info", 5.0),
 }
 
+# Number of scan commands the slave runs at the same time
+SCAN_WORKERS = 4
+
+# Seconds before the slave kills a scan command that does not finish
+SCAN_TIMEOUT = 30.0
+
 #dd if=/dev/dvd of=/dev/null count=1 2>/dev/null; if [ $? -eq 0 ]; then echo "disk found"; else echo "no disk"; fi
 
 # Shell commands for second iteration. Each command has a tuple (analyze function, command parser)
 # for analyzing output and parsing the command (for possible inclusion of data from the first iteration)
+# An optional third element overrides SCAN_TIMEOUT for the command.
 SCAN_ITERATION_2 = {
-    "echo %(sdX)s && hdparm -i /dev/%(sdX)s": ("analyze_hdparm", lambda com, hw: [com % {'sdX': key} for key in hw.get("Hard drives", {}).keys()]),
+    "echo %(sdX)s && hdparm -i /dev/%(sdX)s": ("analyze_hdparm", lambda com, hw: [com % {'sdX': key} for key in hw.get("Hard drives", {}).keys()], 10.0),
     "echo %(sdX)s && sdparm -q -p sn /dev/%(sdX)s": ("analyze_sdparm", lambda com, hw: [com % {'sdX': key} for key in hw.get("Hard drives", {}).keys()]),
     "echo %(sdX)s && blockdev --getsize64 /dev/%(sdX)s": ("analyze_blockdev", lambda com, hw: [com % {'sdX': key} for key in hw.get("Hard drives", {}).keys()]),
     "echo %(sdX)s && readlink -f /sys/block/%(sdX)s/": ("analyze_sysblock", lambda com, hw: [com % {'sdX': key} for key in hw.get("Hard drives", {}).keys()]),
@@ -186,24 +225,77 @@ SCAN_ITERATION_2 = {
 HDD_DUMP_COMMAND = "dd if=/dev/%(dev)s ibs=%(blocksize)d count=%(blocks)d skip=%(offset)d | hexdump -v"
 HDD_DUMP_BLOCKSIZE = 512
 HDD_DUMP_BLOCKS = 1
+HDD_DUMP_TIMEOUT = 4.0 # Seconds to wait for the dump command
+
+# Scan functions that find a drive's serial number, which tells whether
+# an interrupted wipe may be resumed on it
+SERIAL_ANALYZERS = ("analyze_hdparm", "analyze_sdparm")
+SERIAL_TIMEOUT = 10.0
+# Seconds after its last checkpoint that an interrupted wipe may be
+# resumed, later it starts over
+CHECKPOINT_MAX_AGE = 12 * 3600
         
+# A shell command, or a dictionary of options for the slave's native
+# wipe engine (block_size, direct, fsync_interval, verify). Methods that
+# verify find bad sectors while wiping, so no badblocks pass is needed.
 WIPE_METHODS = {
     "Wipe (zeros)": "wipe -z -v -l0 -p1 /dev/%(dev)s",
+    "Native wipe (zeros)": {'block_size': 4 * 1024 * 1024, 'direct': True},
+    "Native wipe and verify (zeros)": {'block_size': 4 * 1024 * 1024, 'direct': True, 'verify': True},
 #    "ATA Secure Erase": "wipe -z -v -l0 -p1 /dev/%(dev)s",
 }
 
+# Number of random sectors the slave reads back to verify a wiped drive
+VERIFY_SECTORS = 10000
+
+# Seconds without any event from a subscribed slave before it is
+# considered lost. Slaves send a heartbeat event when nothing happens.
+EVENT_TIMEOUT = 3 * slave_settings.HEARTBEAT_INTERVAL
+
 # TODO: Output badblocks in a file to check later perhaps?
 BADBLOCKS = "badblocks -e 1 -s -o /tmp/badblocks /dev/%(dev)s"
 
+def scan_entry_1(entry):
+    """Returns (analyze function, timeout) of a SCAN_ITERATION_1 entry"""
+    if type(entry) == tuple:
+        return entry
+    return entry, None
+
+def scan_entry_2(entry):
+    """Returns (analyze function, command parser, timeout) of a
+       SCAN_ITERATION_2 entry"""
+    if len(entry) == 2:
+        return entry + (None,)
+    return entry
+
+def uuid_to_mac(uuid):
+    """The MAC address that a slave's uuid was made from, in the form
+       the DHCP server uses"""
+    node = int(uuid)
+    return ":".join("%02x" % ((node >> shift) & 0xff) for shift in range(40, -8, -8))
+
+def wipe_method_verifies(method):
+    """Whether a wipe method reads back what it writes"""
+    wipe_method = WIPE_METHODS[method]
+    return type(wipe_method) == dict and wipe_method.get('verify', False)
+
 class Computer():
     """
     """
     
-    def __init__(self, computer_id, ipAddress, macAddress, config_master):
+    def __init__(self, computer_id, ipAddress, macAddress, config_master, database=None,
+                 leases=None):
 
         self.id = computer_id or 0
         self.ipAddress = ipAddress
         self.macAddress = macAddress
+        # Name of the network segment the computer is on
+        self.segment = None
+        self.connection = SlaveConnection(ipAddress)
+        # Records scans and wipes, see lcrs.master.database
+        self.database = database
+        # The DHCP leases, told the uuid of the slave
+        self.leases = leases
         
         self.state = State()
 
@@ -222,15 +314,41 @@ class Computer():
         self.wipe_method = None
         self.wipe_hexsample_before = None # Hex-digest of some sector on HD
         self.wipe_hexsample_after  = None # Hex-digest of some sector on HD
+        # The wipe going on, as left with the slave by remember()
+        self.__wipe_info = None
         
         self.shutdown_after_wiping = False
         
+        # Wipe all drives at the same time if the slave supports it
+        self.wipe_parallel = config_master.wipeParallel
+        # Read back all of each drive after wiping, not just samples
+        self.verify_full = config_master.wipeVerifyFull
+        # Continue an interrupted native wipe from its last checkpoint
+        self.wipe_resume = config_master.wipeResume
+        # (serial, size) of a drive -> (method, offset, slave uuid, time)
+        # that it has been wiped up to by the native engine of a slave,
+        # for resuming. They are also kept in the database, for a master
+        # that is restarted.
+        self.wipe_checkpoints = {}
+        # Progress of each drive while wiping in parallel
+        self.__drive_progress = None
+        # (throughput, average throughput, ETA) of drives being worked on
+        self.__drive_rates = {}
+        
         self.debug_mode_request = config_master.DEBUG
 
         self.is_registered = False # Says whether the computer has been registered in some database
 
         self.__slave__uuid = None
         self.__slave_uuid_conflict = False
+        
+        # Status pushed by the slave through SUBSCRIBE
+        self.__status_changed = threading.Condition()
+        self.__subscribed = False
+        self.__status = None
+        self.__event_seq = None
+        self.__last_event = 0
+        self.__resync = False
 
     def scan(self, callback_progress=None, callback_finished=None, 
              callback_failed=None):
@@ -274,9 +392,14 @@ class Computer():
 
         # Send the scan1 list of commands to execute
         commands = SCAN_ITERATION_1.keys()
+        timeouts = {}
+        for command, entry in SCAN_ITERATION_1.items():
+            __, timeout = scan_entry_1(entry)
+            if timeout:
+                timeouts[command] = timeout
         
         try:
-            if not self.__request_and_monitor(commands, callback_progress1,
+            if not self.__request_and_monitor(commands, timeouts, callback_progress1,
                                               callback_finished, callback_failed):
                 return
             
@@ -291,13 +414,19 @@ class Computer():
             
         # Send the scan2 list of commands to execute
         commands = []
-        for command, (__, parse_command) in SCAN_ITERATION_2.items():
+        timeouts = {}
+        for command, entry in SCAN_ITERATION_2.items():
+            __, parse_command, timeout = scan_entry_2(entry)
             if parse_command:
-                commands = commands + parse_command(command, self.hw_info)
+                parsed = parse_command(command, self.hw_info)
             else:
-                commands.append(command)
+                parsed = [command]
+            commands = commands + parsed
+            if timeout:
+                for c in parsed:
+                    timeouts[c] = timeout
 
-        if not self.__request_and_monitor(commands, callback_progress2,
+        if not self.__request_and_monitor(commands, timeouts, callback_progress2,
                                           callback_finished, callback_failed):
             return
 
@@ -309,14 +438,24 @@ class Computer():
         if not state == protocol.FAIL:
             self.state.update(State.SCANNED, info="Scanning finished", progress=1.0)
             self.scanned = True
+            self.remember()
         else:
             self.state.update(State.SCAN_FAILED, info="Scanning failed", progress=1.0)
+        if self.database:
+            self.database.add_scan(self, self.scanned)
         callback_finished(self) if callback_finished else ()
     
-    def __request_and_monitor(self, scan_commands, callback_progress=None, 
+    def __request_and_monitor(self, scan_commands, timeouts={}, callback_progress=None, 
                               callback_finished=None, callback_failed=None):
         
-        request = (protocol.SCAN, scan_commands)
+        if self.__slave_is_framed():
+            request = (protocol.SCAN, {'commands': scan_commands,
+                                       'workers': SCAN_WORKERS,
+                                       'timeout': SCAN_TIMEOUT,
+                                       'timeouts': timeouts})
+        else:
+            # Older slaves only understand a plain list of commands
+            request = (protocol.SCAN, scan_commands)
         status, data = self.__send_to_slave(request)
         
         # If something went wrong...
@@ -340,13 +479,14 @@ class Computer():
                 return False
             if state == protocol.IDLE:
                 return True
-            time.sleep(1)
+            self.__wait_for_change(1, data)
     
     def __analyze_scan_data(self, data):
         
         for k1, (stdout, stderr) in data.items():
             
-            for command, analyze_func in SCAN_ITERATION_1.items():
+            for command, entry in SCAN_ITERATION_1.items():
+                analyze_func, __ = scan_entry_1(entry)
                 if k1 == command:
                     if callable(analyze_func):
                         func = analyze_func
@@ -354,7 +494,8 @@ class Computer():
                         func = getattr(self, analyze_func)
                     self.hw_info = func(stdout, stderr, self.hw_info)
     
-            for command, (analyze_func, parse_command) in SCAN_ITERATION_2.items():
+            for command, entry in SCAN_ITERATION_2.items():
+                analyze_func, parse_command, __ = scan_entry_2(entry)
                 if parse_command:
                     commands = parse_command(command, self.hw_info)
                 else:
@@ -368,67 +509,29 @@ class Computer():
                         self.hw_info = func(stdout, stderr, self.hw_info)
 
     def __send_to_slave(self, request):
-        request = json.dumps(request)
-        reply = ""
-        for __ in range(1):
-            # Retry 1 times
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout (2.0)
-                s.connect( (self.ipAddress, slave_settings.LISTEN_PORT) )
-                s.settimeout (1.0)
-                s.send(request)
-                self.state.update(State.CONNECTED)
-                break
-            except socket.timeout:
-                time.sleep(1)
-            except socket.error:
-                s.close()
-                self.state.update(State.NOT_CONNECTED, "Could not connect")
-                logger.error("Could not connect")
-                raise ConnectionException("Could not connect")
-            except:
-                s.close()
-                e = sys.exc_info()[1]
-                self.state.update(State.NOT_CONNECTED, "Error connecting.")
-                logger.error(e)
-                raise ConnectionException("Could not connect")
-        
-        if not self.state.is_connected:
-            s.close()
-            raise ConnectionException("Timeout connecting")
-
-        retries = 0
-        max_retries = 2
-        while True:
-            try:
-                s.settimeout (5.0)
-                reply = reply + s.recv (slave_settings.MAX_PACKET_SIZE)
-                self.state.update(State.CONNECTED)
-                reply = json.loads(reply)
-                break
-            except json.JSONDecodeError:
-                continue
-            except ValueError:
-                continue
-            except socket.timeout:
-                retries += 1
-                if retries > max_retries:
-                    s.close()
-                    raise ConnectionException("Timeout while receiving reply")
-                self.state.update(State.NOT_CONNECTED, "Connection timeout")
-                continue
-            except socket.error:
-                s.close()
-                self.state.update(State.NOT_CONNECTED, "Connection failure")
-                logger.error("Could not connect after sending request")
-                raise ConnectionException("Could not connect")
-            
-        s.close()
+        command, data = request
+        try:
+            reply = self.connection.request(command, data)
+        except ConnectionException, msg:
+            self.state.update(State.NOT_CONNECTED, msg.parameter)
+            raise
+        self.state.update(State.CONNECTED)
         return reply
 
+    def __slave_is_framed(self):
+        """Whether requests may carry framed protocol options. After a
+           lost connection the protocol is negotiated again first."""
+        try:
+            framed = self.connection.is_framed()
+        except ConnectionException, msg:
+            self.state.update(State.NOT_CONNECTED, msg.parameter)
+            raise
+        self.state.update(State.CONNECTED)
+        return framed
+    
     def slave_state(self, **kwargs):
-        """Get status message and progress from slave
+        """Get status message and progress from slave. If the slave
+           pushes events, the latest one is returned without asking.
         """
         if self.debug_mode_request:
             try:
@@ -438,14 +541,25 @@ class Computer():
                 logger.debug("Requested debug mode for computer ID %s, response: %s" % (str(self.id), response))
             except ConnectionException:
                 pass
+        if not kwargs:
+            status = self.__pushed_status()
+            if status:
+                return status
         try:
             request = (protocol.STATUS, kwargs)
             state, data = self.__send_to_slave(request)
-            return state, data
         except ConnectionException:
             return (protocol.DISCONNECTED, "Could not connect")
+        if self.__resync and type(data) == dict:
+            self.__status_changed.acquire()
+            self.__resync = False
+            self.__event_seq = max(self.__event_seq, data.get('seq', None))
+            self.__status_changed.release()
+        return state, data
 
     def update_state(self):
+        if not self.__subscribed:
+            self.__subscribe()
         state, data = self.slave_state()
         if not state == protocol.DISCONNECTED:
             self.state.update_progress(data.get('progress', None))
@@ -453,8 +567,174 @@ class Computer():
             if not self.__slave__uuid is None and self.__slave__uuid != slave__uuid:
                 self.__slave_uuid_conflict = True
                 logger.critical("A conflict has been discovered on ip: %s" % self.ipAddress)
+            if self.leases and slave__uuid:
+                self.leases.set_uuid(self.macAddress, slave__uuid)
             self.__slave__uuid = slave__uuid
     
+    def adopt(self, callback_finished=None, callback_failed=None,
+              callback_progress=None):
+        """Take over a slave that was running before the master was
+           started. What the earlier master knew about the computer is
+           read back from the slave, and a wipe that was going on is
+           followed from where the slave is, without restarting jobs.
+           Returns False if there is no slave to adopt."""
+        state, data = self.slave_state()
+        if state == protocol.DISCONNECTED or type(data) != dict or not data.get('uuid', None):
+            return False
+        self.__slave__uuid = data['uuid']
+        if not self.macAddress:
+            self.macAddress = uuid_to_mac(data['uuid'])
+        # Without notes from the slave, the details of the last scan in
+        # the database are shown
+        info = None
+        if 'adopt' in data.get('features', []):
+            try:
+                __, info = self.__send_to_slave((protocol.MASTER_INFO, None))
+            except ConnectionException:
+                pass
+        if type(info) != dict:
+            self.hw_info = self.__stored_hw_info()
+            return True
+        
+        logger.info("Adopting slave on %s" % self.ipAddress)
+        self.id = info.get('id', None) or self.id
+        self.hw_info = info.get('hw_info', None) or self.__stored_hw_info()
+        if info.get('scanned', False):
+            self.scanned = True
+            self.state.update(State.SCANNED, info="Scanning finished", progress=1.0)
+        for attr in ('wipe_started_on', 'wipe_finished_on'):
+            if info.get(attr, None):
+                setattr(self, attr, datetime.fromtimestamp(info[attr]))
+        if info.get('wiped', False):
+            self.wiped = True
+            self.wipe_method = info.get('wipe_method', None)
+            self.state.update(State.WIPED, info="All drives wiped!", progress=1.0)
+        if self.database:
+            self.database.save_computer(self)
+        
+        wipe_info = info.get('wipe', None)
+        if not self.scanned or type(wipe_info) != dict or not wipe_info.get('method', None) in WIPE_METHODS:
+            return True
+        jobs = data.get('jobs', None)
+        if jobs is None:
+            # An old style job cannot be told apart from a new one
+            self.state.update(State.WIPE_FAILED, "Lost track of the wipe when LCRS was restarted")
+            return True
+        running = dict((dev_name, job['kind']) for dev_name, job in jobs.items())
+        logger.info("Following wipe on %s, jobs running: %s" % (self.ipAddress, str(running)))
+        self.state.update(State.WIPING, "Following wipe started before LCRS was restarted")
+        self.__start_wipe(wipe_info['method'], wipe_info.get('badblocks', False),
+                          callback_finished, callback_failed, callback_progress,
+                          wipe_info, running)
+        return True
+    
+    def __stored_hw_info(self):
+        """hw_info of the last scan of this computer in the database"""
+        if not self.database or not self.macAddress:
+            return {}
+        return self.database.hw_info(self.macAddress) or {}
+    
+    def remember(self):
+        """Store what the master knows about this computer in the
+           database, and leave it with the slave so it can be adopted
+           after the master is restarted"""
+        if self.database:
+            self.database.save_computer(self)
+        if not self.__slave_has_feature('adopt'):
+            return
+        def timestamp(date):
+            return time.mktime(date.timetuple()) if date else None
+        info = {'id': self.id,
+                'hw_info': self.hw_info,
+                'scanned': self.scanned,
+                'wiped': self.wiped,
+                'wipe_method': self.wipe_method,
+                'wipe_started_on': timestamp(self.wipe_started_on),
+                'wipe_finished_on': timestamp(self.wipe_finished_on),
+                'wipe': self.__wipe_info}
+        try:
+            self.__send_to_slave((protocol.MASTER_INFO, info))
+        except ConnectionException, msg:
+            logger.warning("Could not leave info with slave on %s: %s" % (self.ipAddress, str(msg)))
+        except RuntimeError:
+            # Another thread changed hw_info while it was being sent,
+            # it will be sent again after the next step
+            logger.debug("hw_info changed while leaving it with slave on %s" % self.ipAddress)
+    
+    def __subscribe(self):
+        """Ask the slave to push state and progress events"""
+        try:
+            reply = self.connection.subscribe(self.__on_event)
+        except ConnectionException:
+            return
+        if not reply or reply[0] == protocol.FAIL:
+            return
+        state, data = reply
+        self.__status_changed.acquire()
+        if self.__event_seq is None or data.get('seq', 0) > self.__event_seq:
+            self.__event_seq = data.get('seq', None)
+            self.__status = (state, data)
+        self.__last_event = time.time()
+        self.__subscribed = True
+        self.__status_changed.notifyAll()
+        self.__status_changed.release()
+        logger.debug("Subscribed to events from computer ID %s" % str(self.id))
+    
+    def __on_event(self, state, data):
+        """Called from the connection's reader thread for each event"""
+        self.__status_changed.acquire()
+        if state == protocol.DISCONNECTED:
+            self.__subscribed = False
+            self.__event_seq = None
+        else:
+            seq = data.get('seq', None)
+            if not self.__event_seq is None and seq != self.__event_seq + 1:
+                logger.warning("Missed events from %s (got %s, expected %s)" %
+                               (self.ipAddress, str(seq), str(self.__event_seq + 1)))
+                self.__resync = True
+            self.__event_seq = seq
+            self.__status = (state, data)
+            self.__last_event = time.time()
+        self.__status_changed.notifyAll()
+        self.__status_changed.release()
+        if state == protocol.DISCONNECTED:
+            self.state.update(State.NOT_CONNECTED, "Connection lost")
+        else:
+            self.state.update(State.CONNECTED)
+            self.state.update_progress(data.get('progress', None))
+    
+    def __pushed_status(self):
+        """The latest status pushed by the slave, or None if we have to
+           ask for it"""
+        self.__status_changed.acquire()
+        subscribed = self.__subscribed
+        status = self.__status
+        silent = time.time() - self.__last_event
+        resync = self.__resync
+        self.__status_changed.release()
+        if not subscribed or resync:
+            return None
+        if silent > EVENT_TIMEOUT:
+            logger.warning("No events from %s for %d seconds" % (self.ipAddress, silent))
+            # Start over, the reader thread reports the disconnect
+            self.connection.close()
+            return None
+        return status
+    
+    def __wait_for_change(self, timeout, data=None):
+        """Sleep until the slave pushes an event newer than the status
+           data, or for timeout seconds without a subscription"""
+        self.__status_changed.acquire()
+        try:
+            if self.__subscribed:
+                seq = data.get('seq', None) if type(data) == dict else None
+                if seq is None or seq == self.__event_seq:
+                    self.__status_changed.wait(timeout)
+                return
+        finally:
+            self.__status_changed.release()
+        time.sleep(timeout)
+    
     def wipe(self, method, badblocks=False,
              callback_finished=None, callback_failed=None,
              callback_progress=None):
@@ -466,12 +746,19 @@ class Computer():
         
         self.wiped = False
         self.state.update(State.WIPING, "Starting wipe...")
-        self.wipe_method = method
-        self.drives = self.hw_info.get('Hard drives', {}).keys()        
-        self.wiped = False
         self.wipe_started_on = datetime.now()
+        self.__start_wipe(method, badblocks, callback_finished, callback_failed,
+                          callback_progress, {'method': method, 'badblocks': badblocks, 'done': []})
+    
+    def __start_wipe(self, method, badblocks, callback_finished, callback_failed,
+                     callback_progress, wipe_info, running={}):
+        """Start a new wipe or follow an adopted one in a thread"""
+        self.wipe_method = method
+        self.drives = self.hw_info.get('Hard drives', {}).keys()
+        self.__wipe_info = wipe_info
 
         if not self.drives:
+            self.__wipe_info = None
             self.state.update(State.WIPE_FAILED, info="No hard drives detected", progress=1.0)
             callback_failed(self) if callback_failed else ()
             return
@@ -481,55 +768,265 @@ class Computer():
         t = threading.Thread(target=self.__wipe_thread, 
                              args=(method, badblocks,
                                    callback_finished, callback_failed,
-                                   callback_progress))
+                                   callback_progress, running))
         t.setDaemon(True)
         t.start()
     
     def __wipe_thread(self, method, badblocks=False,
                         callback_finished=None, callback_failed=None,
-                        callback_progress=None):
-        wipe_cnt = 0
-        for dev_name in self.drives:
-            wipe_cnt = wipe_cnt + 1
-            callback_progress(self, self.progress()) if callback_progress else ()
-
+                        callback_progress=None, running={}):
+        """running maps drives to the kind of job that an earlier
+           master left running on them, which is followed instead of
+           started again"""
+        has_jobs = self.__slave_has_jobs()
+        native = type(WIPE_METHODS[method]) == dict
+        if native and not has_jobs:
+            self.__wipe_info = None
+            self.state.update(State.WIPE_FAILED, "The slave does not support %s" % method, progress=0.0)
+            callback_failed(self) if callback_failed else ()
+            return
+        
+        self.remember()
+        if self.wipe_parallel and len(self.drives) > 1 and has_jobs:
+            if not self.__wipe_drives_parallel(method, badblocks, callback_failed,
+                                               callback_progress, running):
+                return
+        else:
+            wipe_cnt = 0
+            for dev_name in self.drives:
+                wipe_cnt = wipe_cnt + 1
+                if dev_name in self.__wipe_info['done']:
+                    continue
+                callback_progress(self, self.progress()) if callback_progress else ()
+                try:
+                    # The native engine always runs as a job on the device
+                    self.__wipe_one_drive(dev_name, wipe_cnt, method, badblocks,
+                                          callback_progress, device_job=native,
+                                          running=running.get(dev_name, None))
+                except (ResponseFailException, ConnectionException), msg:
+                    self.state.update(State.WIPE_FAILED, msg.parameter, progress=0.0)
+                    self.__end_wipe()
+                    callback_failed(self) if callback_failed else ()
+                    return
+        
+        self.wiped = True
+        self.state.update(State.WIPED, info="All drives wiped!", progress=1.0)
+        self.wipe_finished_on = datetime.now()
+        self.__end_wipe()
+        callback_finished(self) if callback_finished else ()
+        if self.drives and self.shutdown_after_wiping:
+            self.shutdown()
+    
+    def __wipe_drives_parallel(self, method, badblocks, callback_failed,
+                               callback_progress, running={}):
+        """Wipe all drives at the same time, one thread per drive.
+           Progress is the average of all drives."""
+        self.state.update(State.WIPING, "Wiping %d drives in parallel" % len(self.drives))
+        done = self.__wipe_info['done']
+        self.__drive_progress = dict((dev_name, 1.0 if dev_name in done else 0.0)
+                                     for dev_name in self.drives)
+        errors = []
+        
+        def wipe_drive(dev_name, wipe_cnt):
             try:
-                # 1) Get a dump
+                self.__wipe_one_drive(dev_name, wipe_cnt, method, badblocks,
+                                      callback_progress, device_job=True,
+                                      running=running.get(dev_name, None))
+            except (ResponseFailException, ConnectionException), msg:
+                errors.append(msg.parameter)
+        
+        threads = []
+        for wipe_cnt, dev_name in enumerate(self.drives):
+            if dev_name in done:
+                continue
+            t = threading.Thread(target=wipe_drive, args=(dev_name, wipe_cnt + 1))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        self.__drive_progress = None
+        
+        if errors:
+            self.state.update(State.WIPE_FAILED, "; ".join(errors), progress=0.0)
+            self.__end_wipe()
+            callback_failed(self) if callback_failed else ()
+            return False
+        return True
+    
+    def __end_wipe(self):
+        """Forget the wipe that has ended and record how it went"""
+        self.__wipe_info = None
+        self.remember()
+        if self.database:
+            self.database.add_wipe(self)
+    
+    def __wipe_one_drive(self, dev_name, wipe_cnt, method, badblocks,
+                         callback_progress, device_job=False, running=None):
+        """Dump, check, wipe and verify a single drive. Raises
+           ResponseFailException with a message for the user. With
+           running, the slave is already doing that step of the drive."""
+        step = "Wipe"
+        try:
+            # 1) Get a dump
+            if running is None:
                 logger.debug("Fetching before dump for computer ID %s" % str(self.id))
                 self.hw_info["Hard drives"][dev_name]["Dump before"] = self.__wipe_dump(dev_name)
                 logger.debug("Received before dump from Computer ID %s" % str(self.id))
-                
-                if badblocks:
+            
+            if badblocks and not wipe_method_verifies(method) and running in (None, 'badblocks'):
+                if not device_job:
                     self.state.update(State.WIPING, "Checking for badblocks on drive %d of %d" % (wipe_cnt, len(self.drives)))
-                    try:
-                        self.__bad_blocks(dev_name, callback_progress)
-                    except ResponseFailException, msg:
-                        self.state.update(State.WIPE_FAILED, "Badblocks failed on drive %d: %s" % (wipe_cnt, str(msg)), progress=0.0)
-                        callback_failed(self) if callback_failed else ()
-                        return
-                self.state.update(State.WIPING, "Wiping drive %d of %d" % (wipe_cnt, len(self.drives)))
-                self.__wipe_drive(dev_name, method, callback_progress)
+                step = "Badblocks"
+                self.__bad_blocks(dev_name, callback_progress, device_job, started=running == 'badblocks')
+                step = "Wipe"
+            if running != 'verify':
+                if not device_job:
+                    self.state.update(State.WIPING, "Wiping drive %d of %d" % (wipe_cnt, len(self.drives)))
+                self.__wipe_drive(dev_name, method, callback_progress, device_job, started=running == 'wipe')
+            if self.__slave_has_feature('verify'):
+                if not device_job:
+                    self.state.update(State.WIPING, "Verifying drive %d of %d" % (wipe_cnt, len(self.drives)))
+                step = "Verify"
+                # Nothing was written before the checkpoint of a resumed
+                # wipe, so all of the drive is read back
+                resumed = bool(self.hw_info["Hard drives"][dev_name].get("Resumed at byte", None))
+                verify = self.__verify_drive(dev_name, callback_progress, started=running == 'verify',
+                                             full=resumed)
+            else:
                 logger.debug("Fetching after dump for computer ID %s" % str(self.id))
                 self.hw_info["Hard drives"][dev_name]["Dump after"] = self.__wipe_dump(dev_name)
                 logger.debug("Received after dump from Computer ID %s" % str(self.id))
+                verify = None
 
-            except ResponseFailException, msg:
-                self.state.update(State.WIPE_FAILED, "Wipe failed on drive %d: %s" % (wipe_cnt, str(msg)), progress=0.0)
-                callback_failed(self) if callback_failed else ()
-                return
+        except ResponseFailException, msg:
+            raise ResponseFailException("%s failed on drive %d: %s" % (step, wipe_cnt, str(msg)))
 
+        if verify:
+            failures = verify['sectors_failed'] + verify['sectors_unreadable']
+            if failures:
+                raise ResponseFailException("Verify after did not pass: %s (drive %d of %d)" %
+                                            (self.hw_info["Hard drives"][dev_name]["Verify after"],
+                                             wipe_cnt, len(self.drives)))
+        else:
             dump_check = self.__verify_after_dump(self.hw_info["Hard drives"][dev_name].get("Dump after", " 1"))
             if not dump_check:
-                self.state.update(State.WIPE_FAILED, "Dump after did not pass (drive %d of %d)" % (wipe_cnt, len(self.drives)))
-                callback_failed(self) if callback_failed else ()
-                return
+                raise ResponseFailException("Dump after did not pass (drive %d of %d)" % (wipe_cnt, len(self.drives)))
         
-        self.wiped = True
-        self.state.update(State.WIPED, info="All drives wiped!", progress=1.0)
-        self.wipe_finished_on = datetime.now()
-        callback_finished(self) if callback_finished else ()
-        if self.drives and self.shutdown_after_wiping:
-            self.shutdown()
+        self.__wipe_info['done'].append(dev_name)
+        self.remember()
+    
+    def __verify_drive(self, dev_name, callback_progress=None, started=False, full=False):
+        """Have the slave read back VERIFY_SECTORS random sectors of a
+           wiped drive, or all of it with verify_full or full. Returns
+           the summary of the VERIFY job. With started, only follow the
+           VERIFY job that is already there."""
+        if self.verify_full or full:
+            request = (protocol.VERIFY, {'device': dev_name, 'full': True})
+            self.__update_drive_progress(dev_name, 0.0)
+        else:
+            request = (protocol.VERIFY, {'device': dev_name, 'sectors': VERIFY_SECTORS})
+        if not started:
+            state, data = self.__send_to_slave(request)
+            if state == protocol.FAIL:
+                raise ResponseFailException(str(data))
+        
+        while True:
+            state, data = self.__job_state(dev_name, *self.slave_state())
+            job = data.get('job', None) if type(data) == dict else None
+            
+            if job and job['kind'] == 'verify' and job['done']:
+                failures = job['sectors_failed'] + job['sectors_unreadable']
+                if job.get('full', False):
+                    self.__update_drive_progress(dev_name, 1.0)
+                    self.hw_info["Hard drives"][dev_name]["Verified bytes"] = job['bytes_verified']
+                    if failures:
+                        verify_after = "%d sectors did not read back as zeros" % failures
+                    else:
+                        verify_after = "All %d bytes read back as zeros" % job['bytes_verified']
+                else:
+                    self.hw_info["Hard drives"][dev_name]["Verified sectors"] = job['sectors_checked']
+                    verify_after = "%d of %d random sectors read back as zeros" % (job['sectors_checked'] - failures,
+                                                                                   job['sectors_checked'])
+                self.hw_info["Hard drives"][dev_name]["Verify after"] = verify_after
+                self.hw_info["Hard drives"][dev_name]["Verify failures"] = failures
+                if job['failed_offsets']:
+                    logger.error("Sectors that did not verify on /dev/%s: %s" % (dev_name, str(job['failed_offsets'])))
+                return job
+            
+            elif state == protocol.BUSY and job and job.get('full', False):
+                self.__update_drive_progress(dev_name, job['progress'], data)
+                callback_progress(self, self.progress()) if callback_progress else ()
+            
+            elif state == protocol.FAIL:
+                raise ResponseFailException(data.get('fail_message', None) if type(data) == dict else str(data))
+            
+            elif state == protocol.IDLE:
+                raise ResponseFailException("Verify was interrupted. Error: %s" % str(data))
+            
+            elif state == protocol.DISCONNECTED:
+                self.state.update(State.NOT_CONNECTED, "Not connected")
+            
+            self.__wait_for_change(2, data)
+    
+    def __slave_has_jobs(self):
+        """Whether the slave can run jobs on several devices at once"""
+        state, data = self.slave_state()
+        return type(data) == dict and 'jobs' in data
+    
+    def __slave_has_feature(self, feature):
+        """Whether the slave announces a feature, such as 'verify'"""
+        state, data = self.slave_state()
+        return type(data) == dict and feature in data.get('features', [])
+    
+    def __job_state(self, dev_name, state, data):
+        """Narrow a slave status down to the job on dev_name, so it
+           reads like the status of a slave running only that job"""
+        if type(data) != dict or not 'jobs' in data:
+            return state, data
+        job = data['jobs'].get(dev_name, None)
+        if job is None:
+            # The job is gone, probably because of a RESET
+            return protocol.IDLE, data
+        return job['state'], {'progress': job['progress'],
+                              'progress_time': job.get('progress_time', None),
+                              'throughput': job.get('throughput', None),
+                              'avg_throughput': job.get('avg_throughput', None),
+                              'eta': job.get('eta', None),
+                              'checkpoint': job.get('checkpoint', None),
+                              'wipe_done': job['done'] and job['kind'] == 'wipe',
+                              'badblocks_done': job['done'] and job['kind'] == 'badblocks',
+                              'bad_sectors': job.get('bad_sectors', None),
+                              'fail_message': job['fail_message'],
+                              'job': job,
+                              'seq': data.get('seq', None)}
+    
+    def __update_drive_progress(self, dev_name, progress, data=None):
+        """Progress of the drive being worked on, or the average of all
+           drives when they are wiped in parallel. The throughput of
+           the drives in the slave's status data adds up, and the ETA is
+           that of the slowest one."""
+        drive_progress = self.__drive_progress
+        if not progress is None and not drive_progress is None:
+            drive_progress[dev_name] = progress
+            progress = sum(drive_progress.values()) / len(drive_progress)
+        self.state.update_progress(progress)
+        
+        if type(data) == dict:
+            self.__drive_rates[dev_name] = (data.get('throughput', None),
+                                            data.get('avg_throughput', None),
+                                            data.get('eta', None))
+        else:
+            # Starting or done, the last rates are no news
+            self.__drive_rates.pop(dev_name, None)
+        rates = self.__drive_rates.values()
+        def total(values):
+            values = [v for v in values if not v is None]
+            return sum(values) if values else None
+        etas = [r[2] for r in rates if not r[2] is None]
+        self.state.update_rates(total([r[0] for r in rates]),
+                                total([r[1] for r in rates]),
+                                max(etas) if etas else None)
     
     def __verify_after_dump(self, dump_data):
         """
@@ -548,24 +1045,30 @@ class Computer():
         return True
         
     
-    def __bad_blocks(self, dev_name, callback_progress):
+    def __bad_blocks(self, dev_name, callback_progress, device_job=False, started=False):
         """Check a drive for bad blocks"""
         
         badblocks_command = BADBLOCKS % {'dev': dev_name,}
+        if device_job:
+            badblocks_command = {'command': badblocks_command, 'device': dev_name}
         request = (protocol.BADBLOCKS, badblocks_command)
-        self.__send_to_slave(request)
+        if not started:
+            state, data = self.__send_to_slave(request)
+            if device_job and state == protocol.FAIL:
+                raise ResponseFailException(str(data))
         
-        self.state.update_progress(0.0)
+        self.__update_drive_progress(dev_name, 0.0)
         callback_progress(self, self.progress()) if callback_progress else ()
 
         logger.debug("Doing badblocks on Computer ID %s" % str(self.id))
         
         while True:
             
-            state, data = self.slave_state()
+            status = self.slave_state()
+            state, data = self.__job_state(dev_name, *status) if device_job else status
             
             if type(data) == dict and data.get('badblocks_done', False):
-                self.state.update_progress(1.0)
+                self.__update_drive_progress(dev_name, 1.0)
                 self.hw_info["Hard drives"][dev_name]["Badblocks"] = False
                 break
 
@@ -576,7 +1079,7 @@ class Computer():
             
             elif state == protocol.BUSY:
                 progress = data.get('progress', None) if type(data) == dict else None
-                self.state.update_progress(progress)
+                self.__update_drive_progress(dev_name, progress, data)
                 logger.debug("Received data assuming to be progress while doing badblocks and BUSY: %s" % str(data))
             
             elif state == protocol.DISCONNECTED:
@@ -591,27 +1094,61 @@ class Computer():
             logger.debug("Badblocks doing callback_progress")
             callback_progress(self, self.progress()) if callback_progress else ()
             logger.debug("Badblocks did callback_progress")
-            time.sleep(2)
+            self.__wait_for_change(2, data)
     
-    def __wipe_drive(self, dev_name, method, callback_progress=None):
+    def __wipe_drive(self, dev_name, method, callback_progress=None, device_job=False,
+                     started=False):
+        
+        wipe_method = WIPE_METHODS[method]
+        native = type(wipe_method) == dict
         
         #TODO: Standardise these values all over the project!
-        self.hw_info["Hard drives"][dev_name]["Wipe method"] = "wipe standard"
+        self.hw_info["Hard drives"][dev_name]["Wipe method"] = "native zeros" if native else "wipe standard"
         self.hw_info["Hard drives"][dev_name]["Passes"] = 1
 
-        self.state.update_progress(0.0)
+        self.__update_drive_progress(dev_name, 0.0)
         callback_progress(self, self.progress()) if callback_progress else ()
 
-        wipe_command = WIPE_METHODS[method] % {'dev': dev_name,}
+        if native:
+            wipe_command = {'engine': wipe_method, 'device': dev_name}
+        elif device_job:
+            wipe_command = {'command': wipe_method % {'dev': dev_name,}, 'device': dev_name}
+        else:
+            wipe_command = wipe_method % {'dev': dev_name,}
         request = (protocol.WIPE, wipe_command)
-        self.__send_to_slave(request)
+        
+        checkpoint = self.__wipe_checkpoint(dev_name, method) if native else None
+        if checkpoint and not started:
+            logger.info("Resuming wipe of /dev/%s on computer ID %s at byte %d" % (dev_name, str(self.id), checkpoint))
+            self.hw_info["Hard drives"][dev_name]["Resumed at byte"] = checkpoint
+            self.__resume_info(dev_name, checkpoint)
+            request = (protocol.RESUME, dict(wipe_command, offset=checkpoint))
+        elif not started:
+            # A checkpoint left from before must not be resumed into
+            # this wipe once it is interrupted
+            self.__clear_wipe_checkpoint(dev_name)
+            self.hw_info["Hard drives"][dev_name].pop("Resumed at byte", None)
+        if not started:
+            # Otherwise the slave is wiping already and we follow it
+            state, data = self.__send_to_slave(request)
+            if device_job and state == protocol.FAIL:
+                raise ResponseFailException(str(data))
         
         while True:
             
-            state, data = self.slave_state()
+            status = self.slave_state()
+            state, data = self.__job_state(dev_name, *status) if device_job else status
 
+            if native and type(data) == dict and data.get('checkpoint', None):
+                self.__save_wipe_checkpoint(dev_name, method, data['checkpoint'])
+            
+            if wipe_method_verifies(method) and type(data) == dict and not data.get('bad_sectors', None) is None:
+                self.hw_info["Hard drives"][dev_name]["Badblocks"] = data['bad_sectors'] > 0
+                self.hw_info["Hard drives"][dev_name]["Bad sectors"] = data['bad_sectors']
+            
             if type(data) == dict and data.get('wipe_done', False):
-                self.state.update_progress(1.0)
+                self.__update_drive_progress(dev_name, 1.0)
+                self.__clear_wipe_checkpoint(dev_name)
                 logger.info("Finished: Computer ID %s" % str(self.id))
                 break
             
@@ -621,6 +1158,10 @@ class Computer():
                 self.state.update(State.WIPE_FAILED, err_msg)
                 raise ResponseFailException(err_msg)
             
+            elif state == protocol.IDLE and native and self.__resume_wipe(dev_name, method, wipe_command, checkpoint):
+                # The slave was restarted, maybe because the power went
+                checkpoint = self.wipe_checkpoints[self.__drive_key(dev_name)][1]
+            
             elif state == protocol.IDLE:
                 logger.error("Wipe was interrupted. Error: %s" % str(data))
                 err_msg = "Wipe was interrupted. Error: %s" % str(data)
@@ -629,16 +1170,104 @@ class Computer():
 
             elif state == protocol.BUSY:
                 progress = data.get('progress', None) if type(data) == dict else None
-                self.state.update_progress(progress)
+                self.__update_drive_progress(dev_name, progress, data)
                 logger.debug("Received data assuming to be progress while doing wipe and BUSY: %s" % str(data))
             
             elif state == protocol.DISCONNECTED:
                 self.state.update(State.NOT_CONNECTED, "Not connected")
             
             callback_progress(self, self.progress()) if callback_progress else ()
-            time.sleep(2)
+            self.__wait_for_change(2, data)
         
     
+    def __drive_key(self, dev_name):
+        """Tells a drive apart from others, even if it shows up under
+           another name after a reboot. None without a serial number."""
+        drive = self.hw_info.get("Hard drives", {}).get(dev_name, {})
+        if not drive.get("Serial", None):
+            return None
+        return (drive["Serial"], drive.get("Size", None))
+    
+    def __wipe_checkpoint(self, dev_name, method):
+        """The offset to resume wiping a drive at, or None to start over.
+           Only a recent checkpoint of the same slave counts."""
+        key = self.__drive_key(dev_name)
+        if not self.wipe_resume or key is None or not self.__slave__uuid:
+            return None
+        since = time.time() - CHECKPOINT_MAX_AGE
+        if not key in self.wipe_checkpoints and self.database:
+            # Left by a master that was restarted while the slave wiped
+            stored = self.database.checkpoint(key[0], key[1], self.__slave__uuid, since)
+            if stored:
+                self.wipe_checkpoints[key] = stored
+        if not key in self.wipe_checkpoints:
+            return None
+        checkpoint_method, offset, slave_uuid, updated_on = self.wipe_checkpoints[key]
+        if checkpoint_method != method or slave_uuid != self.__slave__uuid or updated_on < since:
+            return None
+        if not self.__slave_has_feature('resume'):
+            return None
+        return offset
+    
+    def __resume_wipe(self, dev_name, method, wipe_command, resumed_at):
+        """Continue an interrupted wipe from its checkpoint if the drive
+           is still the same one and the wipe got further since the last
+           time it was resumed. Returns True if the slave took it."""
+        checkpoint = self.__wipe_checkpoint(dev_name, method)
+        if not checkpoint or checkpoint == resumed_at:
+            return False
+        try:
+            if not self.__same_drive(dev_name):
+                logger.warning("/dev/%s on computer ID %s is not the drive that was being wiped" % (dev_name, str(self.id)))
+                return False
+        except ResponseFailException, e:
+            logger.error("Could not read serial number of /dev/%s: %s" % (dev_name, str(e)))
+            return False
+        logger.info("Resuming interrupted wipe of /dev/%s on computer ID %s at byte %d" % (dev_name, str(self.id), checkpoint))
+        self.hw_info["Hard drives"][dev_name]["Resumed at byte"] = checkpoint
+        self.__resume_info(dev_name, checkpoint)
+        state, data = self.__send_to_slave((protocol.RESUME, dict(wipe_command, offset=checkpoint)))
+        if state == protocol.FAIL:
+            logger.error("Could not resume wipe: %s" % str(data))
+            return False
+        return True
+    
+    def __same_drive(self, dev_name):
+        """Read the serial number of a drive again with the scan commands
+           and compare it with the one found by the last scan"""
+        drives = {"Hard drives": {dev_name: {}}}
+        for command, entry in SCAN_ITERATION_2.items():
+            func_name, __, timeout = scan_entry_2(entry)
+            if not func_name in SERIAL_ANALYZERS:
+                continue
+            stdout = self.__shell_exec(command % {'sdX': dev_name}, timeout or SERIAL_TIMEOUT)
+            getattr(self, func_name)(stdout, "", drives)
+        serial = drives["Hard drives"][dev_name].get("Serial", None)
+        return serial is not None and serial == self.hw_info["Hard drives"][dev_name].get("Serial", None)
+    
+    def __resume_info(self, dev_name, checkpoint):
+        """Tell the operator that the wipe goes on where it stopped, and
+           how to have it start over"""
+        self.state.update(State.WIPING, "Resuming wipe of /dev/%s at %d MB, all of it is read back afterwards "
+                          "(set resume = 0 in [wipe] to start over)" %
+                          (dev_name, checkpoint // (1024 * 1024)))
+    
+    def __save_wipe_checkpoint(self, dev_name, method, offset):
+        key = self.__drive_key(dev_name)
+        if key is None or self.wipe_checkpoints.get(key, (None, None))[:2] == (method, offset):
+            return
+        self.wipe_checkpoints[key] = (method, offset, self.__slave__uuid, time.time())
+        if self.database:
+            self.database.save_checkpoint(key[0], key[1], self.__slave__uuid, method, offset)
+    
+    def __clear_wipe_checkpoint(self, dev_name):
+        key = self.__drive_key(dev_name)
+        if key is None:
+            return
+        self.wipe_checkpoints.pop(key, None)
+        if self.database:
+            self.database.clear_checkpoint(key[0], key[1])
+    
     def __wipe_dump(self, dev_name):
         
         size_mb = self.hw_info["Hard drives"][dev_name].get("Size", 0)
@@ -653,28 +1282,46 @@ class Computer():
                                       'blocks': HDD_DUMP_BLOCKS,
                                       'offset': offset}
         
+        try:
+            return self.__shell_exec(command, HDD_DUMP_TIMEOUT)
+        except ResponseFailException, e:
+            logger.error("Could not retrieve HDD dump: %s" % str(e))
+            raise ResponseFailException("Could not retrieve HDD dump. %s Maybe the hard drive has bad sectors?" % str(e))
+    
+    def __shell_exec(self, command, timeout):
+        """Run a shell command on the slave next to whatever else it is
+           doing and return its stdout"""
+        
+        if self.__slave_is_framed():
+            # Do not leave the slave busy with a drive that does not answer
+            command = {'command': command, 'timeout': timeout}
         (state, data) = self.__send_to_slave((protocol.SHELL_EXEC, command))
         
         if state == protocol.FAIL:
             logger.error("Something went wrong sending a SHELL_EXEC: %s" % str(data))
-            raise ResponseFailException("Could not send request for hard drive dump")
+            raise ResponseFailException("Could not send request for shell command.")
         
         exec_id = data
         
-        for __ in range(20):
-            state, ___ = self.slave_state()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            state, status = self.slave_state()
             logger.info("Trying to poll for SHELL_RESULTS, slave state is %s" % protocol.translate_state(state))
-            if state == protocol.IDLE:
+            if type(status) == dict and 'shell_exec_running' in status:
+                # Other jobs may keep the slave busy, look for our command
+                finished = not exec_id in status['shell_exec_running']
+            else:
+                finished = state == protocol.IDLE
+            if finished:
                 (state, data) = self.__send_to_slave((protocol.SHELL_RESULTS, exec_id))
                 if state == protocol.FAIL:
                     logger.error("Something went wrong getting SHELL_RESULTS: %s" % str(data))
                     raise ResponseFailException("Failed getting results from command ID %d" % exec_id)
                 (stdout, ___) = data
                 return stdout
-            time.sleep(0.2)
+            self.__wait_for_change(0.2, status)
             
-        logger.error("Could not retrieve HDD dump. Timed out!")
-        raise ResponseFailException("Could not retrieve HDD dump. Timed out! Maybe the hard drive has bad sectors?")
+        raise ResponseFailException("Timed out!")
 
     def shutdown(self):
         """Asks the slave to perform a shutdown"""
@@ -712,6 +1359,14 @@ class Computer():
     def progress(self):
         return self.state.progress
     
+    def throughput(self):
+        """Bytes per second wiped right now, or None"""
+        return self.state.throughput
+    
+    def eta(self):
+        """Seconds until the current step of wiping is done, or None"""
+        return self.state.eta
+    
     def slave_uuid_conflict(self):
         return self.__slave_uuid_conflict
     
@@ -22,6 +22,11 @@ logger = logging.getLogger('lcrs')
 
 LOG_FILE = "/var/log/lcrs.log"
 
+# Records of computers, scans and wipes
+DATABASE_FILE = "/var/lib/lcrs/lcrs.db"
+# DHCP leases, kept over a restart of the master
+LEASES_FILE = "/var/lib/lcrs/leases.json"
+
 DEBUG = False
 
 TFTP_COMMAND = "in.tftpd -a %(ip)s -s -l -v -v -v -L %(path)s"
@@ -52,6 +57,12 @@ if not config.has_section('network'):
 if not config.has_section('tftp'):
     config.add_section('tftp')
 
+if not config.has_section('wipe'):
+    config.add_section('wipe')
+
+if not config.has_section('http'):
+    config.add_section('http')
+
 def load_plugins():
     import plugins
     import inspect, pkgutil
@@ -97,6 +108,29 @@ dhcpIpRange         = range(
   config.getint('network', 'dhcp-range-upper')+1
 )
 
+def dhcp_segments():
+    """The network segments that DHCP and TFTP are served on, as dicts
+       of name, iface, server_ip and addresses. The first one is set in
+       [network], more can be added in sections [network:<name>] with
+       the same options."""
+    segments = [{'name': dhcpInterface,
+                 'iface': dhcpInterface,
+                 'server_ip': dhcpServerAddress,
+                 'addresses': [dhcpPrefix + str(ip) for ip in dhcpIpRange]}]
+    for section in sorted(config.sections()):
+        if not section.startswith("network:"):
+            continue
+        try:
+            segments.append({'name': section.split(":", 1)[1],
+                             'iface': config.get(section, 'server-iface'),
+                             'server_ip': config.get(section, 'server-ip'),
+                             'addresses': [config.get(section, 'dhcp-prefix') + str(ip) for ip in
+                                           range(config.getint(section, 'dhcp-range-lower'),
+                                                 config.getint(section, 'dhcp-range-upper')+1)]})
+        except (ConfigParser.Error, ValueError), e:
+            logger.error("Ignoring network segment [%s]: %s" % (section, str(e)))
+    return segments
+
 # TFTP
 try:
     tftpRoot = config.get('tftp', 'tftp-root-dir')
@@ -104,6 +138,17 @@ except ConfigParser.NoOptionError:
     tftpRoot = os.path.join(MASTER_PATH, 'pxe-root')
     
 tftpTftpy          = bool(config.getint('tftp', 'use_tftpy'))
+tftpBuiltin        = bool(config.getint('tftp', 'builtin'))
+
+# HTTP boot
+httpEnabled        = bool(config.getint('http', 'enabled'))
+httpPort           = config.getint('http', 'port')
+httpBootFile       = config.get('http', 'boot-file')
+
+# Wipe
+wipeParallel       = bool(config.getint('wipe', 'parallel'))
+wipeVerifyFull     = bool(config.getint('wipe', 'verify-full'))
+wipeResume         = bool(config.getint('wipe', 'resume'))
 
 if not dhcpIpRange:
     logger.error("Wrong initial DHCP in configuration... exiting")
@@ -118,6 +163,13 @@ def write_config():
     config.set('network', 'dhcp-range-upper', str(max(dhcpIpRange)))
     config.set('tftp', 'tftp-root-dir', tftpRoot)
     config.set('tftp', 'use_tftpy', str(int(tftpTftpy)))
+    config.set('tftp', 'builtin', str(int(tftpBuiltin)))
+    config.set('http', 'enabled', str(int(httpEnabled)))
+    config.set('http', 'port', str(httpPort))
+    config.set('http', 'boot-file', httpBootFile)
+    config.set('wipe', 'parallel', str(int(wipeParallel)))
+    config.set('wipe', 'verify-full', str(int(wipeVerifyFull)))
+    config.set('wipe', 'resume', str(int(wipeResume)))
     
     for plugin_class, plugin_config in ui_plugins.items():
         for k,v in plugin_config.items():
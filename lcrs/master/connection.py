@@ -0,0 +1,312 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import logging
+import socket
+import simplejson as json
+
+from lcrs.slave import protocol
+from lcrs.slave import settings as slave_settings
+
+# create logger
+logger = logging.getLogger('lcrs')
+
+CONNECT_TIMEOUT = 2.0 # Seconds before giving up connecting
+REPLY_TIMEOUT = 15.0 # Seconds before giving up waiting for a reply
+
+class ConnectionException(Exception):
+    """Raised when a socket error occurs"""
+    def __init__(self, value):
+        self.parameter = value
+    def __str__(self):
+        return repr(self.parameter)
+
+class PendingReply():
+    """A request that has been sent and is waiting for its reply"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.reply = None
+        self.error = None
+
+    def set_reply(self, reply):
+        self.reply = reply
+        self.event.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.event.set()
+
+class SlaveConnection():
+    """
+    The master's end of the line to a single slave.
+
+    Negotiates the framed protocol and keeps one connection open for
+    all requests. Replies are matched to their requests by request ID
+    in a reader thread, so several threads (polling, scanning, wiping)
+    may have requests in flight at the same time.
+
+    Slaves that do not speak the framed protocol are served with the
+    old mode of one connection per request.
+    """
+
+    def __init__(self, address, port=slave_settings.LISTEN_PORT):
+        self.address = address
+        self.port = port
+        self.lock = threading.RLock()
+        # None: not negotiated, True: framed, False: one-shot
+        self.framed = None
+        # Set once the slave has spoken the framed protocol, after that
+        # it is never given up for one-shot requests
+        self.__framed_before = False
+        self.__socket = None
+        self.__request_cnt = 0
+        self.__pending = {}
+        # request id -> callback for events streamed by SUBSCRIBE
+        self.__subscriptions = {}
+
+    def subscribe(self, callback, data=None, timeout=REPLY_TIMEOUT):
+        """Ask the slave to push state and progress events. Returns the
+           reply to SUBSCRIBE, or None if the slave only speaks the
+           one-shot protocol. Every following event is passed to
+           callback(state, data) in the reader thread, so the callback
+           must not send requests itself. When the connection is lost,
+           callback(protocol.DISCONNECTED, None) is called."""
+        return self.request(protocol.SUBSCRIBE, data, timeout, stream=callback)
+
+    def is_framed(self):
+        """Whether the slave speaks the framed protocol, negotiating it
+           again if the connection was lost. Ask this before sending
+           requests with data that only the framed protocol knows."""
+        self.lock.acquire()
+        try:
+            if self.__socket is None and self.framed is not False:
+                self.__negotiate()
+            return bool(self.framed)
+        finally:
+            self.lock.release()
+
+    def request(self, command, data=None, timeout=REPLY_TIMEOUT, stream=None):
+        """Send a request and block until its reply arrives.
+           Returns a tuple (state, data)."""
+        self.lock.acquire()
+        try:
+            if self.__socket is None and self.framed is not False:
+                self.__negotiate()
+            framed = self.framed
+            if framed:
+                sock = self.__socket
+                self.__request_cnt += 1
+                request_id = self.__request_cnt
+                pending = PendingReply()
+                self.__pending[request_id] = pending
+                if stream:
+                    self.__subscriptions[request_id] = stream
+                try:
+                    sock.sendall(protocol.pack_frame([request_id, command, data]))
+                except socket.error, e:
+                    self.__close(sock)
+                    raise ConnectionException("Could not send request: %s" % str(e))
+        finally:
+            self.lock.release()
+
+        if not framed:
+            if stream:
+                return None
+            return self.__one_shot(command, data)
+
+        if not pending.event.wait(timeout):
+            self.lock.acquire()
+            self.__pending.pop(request_id, None)
+            self.__subscriptions.pop(request_id, None)
+            self.lock.release()
+            # Something is stuck, start over with a fresh connection
+            self.__close(sock)
+            raise ConnectionException("Timeout while receiving reply")
+        if pending.error:
+            raise ConnectionException(pending.error)
+        return pending.reply
+
+    def close(self):
+        self.lock.acquire()
+        sock = self.__socket
+        self.lock.release()
+        if sock:
+            self.__close(sock)
+
+    def __connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.settimeout(CONNECT_TIMEOUT)
+            s.connect((self.address, self.port))
+        except socket.timeout:
+            s.close()
+            raise ConnectionException("Timeout connecting")
+        except socket.error:
+            s.close()
+            logger.error("Could not connect")
+            raise ConnectionException("Could not connect")
+        return s
+
+    def __negotiate(self):
+        """Ask the slave to upgrade the connection to the framed protocol.
+           An old slave answers with plain JSON and hangs up."""
+        s = self.__connect()
+        try:
+            s.settimeout(REPLY_TIMEOUT)
+            s.sendall(json.dumps([protocol.STATUS, {'upgrade': protocol.PROTOCOL_VERSION}]))
+            header = protocol.recv_exactly(s, protocol.FRAME_HEADER.size)
+            if not header:
+                raise socket.error("Connection closed by slave")
+            if header.startswith("["):
+                # Not a frame header but the beginning of a JSON reply
+                s.close()
+                if self.__framed_before:
+                    # Not the slave we talked to before, requests made
+                    # for the framed protocol must not go to it
+                    raise ConnectionException("Slave on %s no longer speaks protocol version %d" %
+                                              (self.address, protocol.PROTOCOL_VERSION))
+                self.framed = False
+                logger.info("Slave on %s does not support protocol version %d, using one-shot requests" %
+                            (self.address, protocol.PROTOCOL_VERSION))
+                return
+            (length,) = protocol.FRAME_HEADER.unpack(header)
+            if length > protocol.MAX_FRAME_SIZE:
+                raise protocol.FrameTooLarge("Frame of %d bytes exceeds limit" % length)
+            json.loads(protocol.recv_exactly(s, length))
+        except socket.timeout:
+            s.close()
+            raise ConnectionException("Timeout while receiving reply")
+        except (socket.error, ValueError), e:
+            s.close()
+            logger.error("Could not negotiate protocol: %s" % str(e))
+            raise ConnectionException("Could not connect")
+
+        s.settimeout(None)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.__socket = s
+        self.framed = True
+        self.__framed_before = True
+        t = threading.Thread(target=self.__reader_thread, args=(s,))
+        t.setDaemon(True)
+        t.start()
+
+    def __reader_thread(self, sock):
+        """Dispatch incoming replies to the threads waiting for them"""
+        decoder = protocol.FrameDecoder()
+        while True:
+            try:
+                data = sock.recv(protocol.RECV_SIZE)
+                if not data:
+                    break
+                messages = decoder.feed(data)
+            except (socket.error, ValueError), e:
+                logger.debug("Connection to %s lost: %s" % (self.address, str(e)))
+                break
+            for message in messages:
+                try:
+                    request_id, state, data = message
+                except (TypeError, ValueError):
+                    logger.error("Slave on %s sent an illegal frame: %s" % (self.address, str(message)))
+                    continue
+                self.lock.acquire()
+                pending = self.__pending.pop(request_id, None)
+                stream = self.__subscriptions.get(request_id, None)
+                self.lock.release()
+                if pending:
+                    pending.set_reply((state, data))
+                elif stream:
+                    try:
+                        stream(state, data)
+                    except Exception:
+                        logger.exception("Error handling event from %s" % self.address)
+        self.__close(sock)
+
+    def __close(self, sock):
+        """Close a framed connection and fail everything waiting on it.
+           The protocol is negotiated again on the next request since
+           the slave may have been restarted in the meantime."""
+        self.lock.acquire()
+        if self.__socket is sock:
+            self.__socket = None
+            self.framed = None
+            pending = self.__pending.values()
+            self.__pending = {}
+            streams = self.__subscriptions.values()
+            self.__subscriptions = {}
+        else:
+            pending = []
+            streams = []
+        self.lock.release()
+        for p in pending:
+            p.set_error("Connection failure")
+        for stream in streams:
+            stream(protocol.DISCONNECTED, None)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+
+    def __one_shot(self, command, data):
+        """Old protocol: one connection per request. The slave closes
+           the connection after its reply, so the reply is read until
+           EOF and parsed once."""
+        s = self.__connect()
+        try:
+            s.settimeout(1.0)
+            s.send(json.dumps([command, data]))
+        except socket.error:
+            s.close()
+            # The slave may have been replaced by a newer one
+            self.framed = None
+            raise ConnectionException("Could not connect")
+
+        chunks = []
+        received = 0
+        retries = 0
+        max_retries = 2
+        while True:
+            try:
+                s.settimeout(5.0)
+                chunk = s.recv(protocol.RECV_SIZE)
+            except socket.timeout:
+                retries += 1
+                if retries > max_retries:
+                    s.close()
+                    raise ConnectionException("Timeout while receiving reply")
+                continue
+            except socket.error:
+                s.close()
+                logger.error("Could not connect after sending request")
+                raise ConnectionException("Could not connect")
+            if not chunk:
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+            if received > protocol.MAX_FRAME_SIZE:
+                s.close()
+                raise ConnectionException("Reply exceeds %d bytes" % protocol.MAX_FRAME_SIZE)
+        s.close()
+
+        try:
+            return tuple(json.loads("".join(chunks)))
+        except ValueError:
+            raise ConnectionException("Could not understand reply")
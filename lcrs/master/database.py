@@ -0,0 +1,335 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keeps computers, their drives and every scan and wipe in an SQLite
+database, so the records outlive the session and a crash of the master.
+
+All writes go through a queue to one writer thread, which commits them
+in batches. Each write is done in a savepoint of its own, so one that
+fails is left out and the rest of the batch is committed. The GTK thread and the computers' threads only take a copy
+of what is to be written. The database runs in WAL mode, so reports can
+read while the writer is busy.
+
+The rows of a computer are found by its MAC address. hw_info is stored
+as JSON with each scan and is only read when it is asked for. Wipe
+checkpoints are kept by drive, with its serial number and size, and
+the uuid of the slave that was wiping it. They only count for that
+slave.
+"""
+
+import os
+import time
+import Queue
+import sqlite3
+import logging
+import threading
+import simplejson as json
+
+logger = logging.getLogger('lcrs')
+
+# Writes committed in one transaction at most
+WRITE_BATCH = 200
+# Seconds the writer waits for more writes before committing
+WRITE_DELAY = 0.5
+# Seconds flush() waits for the writer at most
+FLUSH_TIMEOUT = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS computers (
+    id INTEGER PRIMARY KEY,
+    mac TEXT NOT NULL,
+    system_uuid TEXT,
+    barcode TEXT,
+    ip TEXT,
+    first_seen REAL,
+    last_seen REAL,
+    scanned INTEGER DEFAULT 0,
+    wiped INTEGER DEFAULT 0,
+    wipe_method TEXT,
+    wipe_started_on REAL,
+    wipe_finished_on REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS computers_mac ON computers (mac);
+CREATE INDEX IF NOT EXISTS computers_system_uuid ON computers (system_uuid);
+CREATE INDEX IF NOT EXISTS computers_barcode ON computers (barcode);
+CREATE INDEX IF NOT EXISTS computers_wipe_finished ON computers (wipe_finished_on);
+
+CREATE TABLE IF NOT EXISTS drives (
+    id INTEGER PRIMARY KEY,
+    computer_id INTEGER NOT NULL REFERENCES computers (id),
+    dev_name TEXT NOT NULL,
+    serial TEXT,
+    size_mb INTEGER,
+    bad_sectors INTEGER,
+    verify_after TEXT
+);
+CREATE INDEX IF NOT EXISTS drives_computer ON drives (computer_id);
+CREATE INDEX IF NOT EXISTS drives_serial ON drives (serial);
+
+CREATE TABLE IF NOT EXISTS scan_runs (
+    id INTEGER PRIMARY KEY,
+    computer_id INTEGER NOT NULL REFERENCES computers (id),
+    finished_on REAL,
+    ok INTEGER,
+    hw_info TEXT
+);
+CREATE INDEX IF NOT EXISTS scan_runs_computer ON scan_runs (computer_id);
+
+CREATE TABLE IF NOT EXISTS wipe_runs (
+    id INTEGER PRIMARY KEY,
+    computer_id INTEGER NOT NULL REFERENCES computers (id),
+    method TEXT,
+    started_on REAL,
+    finished_on REAL,
+    wiped INTEGER,
+    info TEXT,
+    drives TEXT
+);
+CREATE INDEX IF NOT EXISTS wipe_runs_computer ON wipe_runs (computer_id);
+
+CREATE TABLE IF NOT EXISTS wipe_checkpoints (
+    serial TEXT NOT NULL,
+    size_mb INTEGER NOT NULL,
+    slave_uuid TEXT,
+    method TEXT,
+    offset INTEGER,
+    updated_on REAL,
+    PRIMARY KEY (serial, size_mb)
+);
+"""
+
+COMPUTER_ID = "(SELECT id FROM computers WHERE mac = ?)"
+
+SUMMARY_COLUMNS = ("mac", "system_uuid", "barcode", "ip", "first_seen", "last_seen",
+                   "scanned", "wiped", "wipe_method", "wipe_started_on", "wipe_finished_on")
+
+def timestamp(date):
+    """Seconds since the epoch of a datetime, or None"""
+    return time.mktime(date.timetuple()) if date else None
+
+class Database():
+    """
+    The master's database. Call the save and add methods from any
+    thread, they return at once. Reads open a connection of their own
+    in the calling thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__queue = Queue.Queue()
+        self.__local = threading.local()
+        self.__thread = None
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        conn = self.__connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(wipe_checkpoints)")]
+        if not "slave_uuid" in columns:
+            # Checkpoints from before they were kept by slave are never resumed
+            conn.execute("ALTER TABLE wipe_checkpoints ADD COLUMN slave_uuid TEXT")
+        conn.commit()
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__writer_thread)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def close(self):
+        """Write everything that is queued and stop the writer"""
+        if self.__thread:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Block until everything queued so far is committed, or timeout
+           seconds have passed. Returns whether it was committed."""
+        if self.__thread is None:
+            return False
+        done = threading.Event()
+        self.__queue.put(done.set)
+        return done.wait(timeout)
+
+    def save_computer(self, computer):
+        """Store the summary of a computer and the drives it has"""
+        if not computer.macAddress:
+            return
+        mac = computer.macAddress
+        hw_info = computer.hw_info
+        now = time.time()
+        statements = [
+            ("INSERT OR IGNORE INTO computers (mac, first_seen) VALUES (?, ?)", (mac, now)),
+            ("UPDATE computers SET system_uuid = ?, barcode = ?, ip = ?, last_seen = ?, "
+             "scanned = ?, wiped = ?, wipe_method = ?, wipe_started_on = ?, wipe_finished_on = ? "
+             "WHERE mac = ?",
+             (hw_info.get("System UUID", None), str(computer.id) if computer.id else None,
+              computer.ipAddress, now, int(computer.scanned), int(computer.wiped),
+              computer.wipe_method, timestamp(computer.wipe_started_on),
+              timestamp(computer.wipe_finished_on), mac)),
+        ]
+        if hw_info.get("Hard drives", None):
+            statements.append(("DELETE FROM drives WHERE computer_id = %s" % COMPUTER_ID, (mac,)))
+            for dev_name, drive in hw_info["Hard drives"].items():
+                statements.append(
+                    ("INSERT INTO drives (computer_id, dev_name, serial, size_mb, bad_sectors, verify_after) "
+                     "VALUES (%s, ?, ?, ?, ?, ?)" % COMPUTER_ID,
+                     (mac, dev_name, drive.get("Serial", None), drive.get("Size", None),
+                      drive.get("Bad sectors", None), drive.get("Verify after", None))))
+        self.__queue.put(statements)
+
+    def add_scan(self, computer, ok):
+        """Store a finished scan and the hw_info it found"""
+        if not computer.macAddress:
+            return
+        self.save_computer(computer)
+        self.__queue.put([
+            ("INSERT INTO scan_runs (computer_id, finished_on, ok, hw_info) VALUES (%s, ?, ?, ?)" % COMPUTER_ID,
+             (computer.macAddress, time.time(), int(ok), json.dumps(computer.hw_info)))])
+
+    def add_wipe(self, computer):
+        """Store a wipe that has ended, whether it went well or not"""
+        if not computer.macAddress:
+            return
+        self.save_computer(computer)
+        self.__queue.put([
+            ("INSERT INTO wipe_runs (computer_id, method, started_on, finished_on, wiped, info, drives) "
+             "VALUES (%s, ?, ?, ?, ?, ?, ?)" % COMPUTER_ID,
+             (computer.macAddress, computer.wipe_method, timestamp(computer.wipe_started_on),
+              time.time(), int(computer.wiped), computer.activity(),
+              json.dumps(computer.hw_info.get("Hard drives", {}))))])
+
+    def save_checkpoint(self, serial, size_mb, slave_uuid, method, offset):
+        """Store the offset that the native engine of a slave has wiped a
+           drive up to, so the wipe can be resumed after the master is
+           restarted"""
+        self.__queue.put([
+            ("INSERT OR REPLACE INTO wipe_checkpoints (serial, size_mb, slave_uuid, method, offset, updated_on) "
+             "VALUES (?, ?, ?, ?, ?, ?)", (serial, size_mb or 0, slave_uuid, method, offset, time.time()))])
+
+    def clear_checkpoint(self, serial, size_mb):
+        self.__queue.put([("DELETE FROM wipe_checkpoints WHERE serial = ? AND size_mb = ?",
+                           (serial, size_mb or 0))])
+
+    def checkpoint(self, serial, size_mb, slave_uuid, since):
+        """(method, offset, slave_uuid, updated_on) of the last checkpoint
+           of a drive, if it was saved for slave_uuid at or after since
+           (seconds since the epoch). Otherwise None."""
+        row = self.__reader().execute(
+            "SELECT method, offset, slave_uuid, updated_on FROM wipe_checkpoints "
+            "WHERE serial = ? AND size_mb = ? AND slave_uuid = ? AND updated_on >= ?",
+            (serial, size_mb or 0, slave_uuid, since)).fetchone()
+        return tuple(row) if row else None
+
+    def summaries(self):
+        """A dictionary of all computers by MAC address, without hw_info"""
+        cursor = self.__reader().execute("SELECT %s FROM computers" % ", ".join(SUMMARY_COLUMNS))
+        return dict((row[0], dict(zip(SUMMARY_COLUMNS, row))) for row in cursor)
+
+    def history(self, since=None, until=None):
+        """Generates (summary, hw_info) of all computers in the order
+           they were wiped, reading one row at a time. With since or
+           until (datetimes), only computers wiped in that time."""
+        where = []
+        args = []
+        if since:
+            where.append("wipe_finished_on >= ?")
+            args.append(timestamp(since))
+        if until:
+            where.append("wipe_finished_on < ?")
+            args.append(timestamp(until))
+        cursor = self.__reader().execute(
+            "SELECT %s, (SELECT hw_info FROM scan_runs WHERE computer_id = computers.id AND ok = 1 "
+            "ORDER BY id DESC LIMIT 1) FROM computers %s ORDER BY wipe_finished_on, id" %
+            (", ".join(SUMMARY_COLUMNS), ("WHERE " + " AND ".join(where)) if where else ""), args)
+        for row in cursor:
+            yield dict(zip(SUMMARY_COLUMNS, row)), json.loads(row[-1]) if row[-1] else {}
+
+    def hw_info(self, mac):
+        """hw_info of the last successful scan of a computer, or None"""
+        row = self.__reader().execute(
+            "SELECT hw_info FROM scan_runs WHERE computer_id = %s AND ok = 1 "
+            "ORDER BY id DESC LIMIT 1" % COMPUTER_ID, (mac,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __connect(self):
+        conn = sqlite3.connect(self.path, timeout=30.0)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def __reader(self):
+        """This thread's connection for reading"""
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__local.conn = self.__connect()
+        return conn
+
+    def __write(self, conn, statements):
+        """Execute the statements of one write in a savepoint, and leave
+           them all out if one fails"""
+        conn.execute("SAVEPOINT write")
+        try:
+            for sql, args in statements:
+                conn.execute(sql, args)
+        except sqlite3.Error, e:
+            logger.error("Could not write to database %s, skipping: %s" % (self.path, str(e)))
+            conn.execute("ROLLBACK TO write")
+        conn.execute("RELEASE write")
+
+    def __writer_thread(self):
+        conn = self.__connect()
+        # Transactions and savepoints are begun here, not by the module
+        conn.isolation_level = None
+        stop = False
+        while not stop:
+            batch = [self.__queue.get()]
+            deadline = time.time() + WRITE_DELAY
+            # A flush or close does not wait for more
+            while len(batch) < WRITE_BATCH and type(batch[-1]) == list:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.__queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            callbacks = []
+            try:
+                conn.execute("BEGIN")
+                for item in batch:
+                    if item is None:
+                        stop = True
+                    elif callable(item):
+                        callbacks.append(item)
+                    else:
+                        self.__write(conn, item)
+                conn.execute("COMMIT")
+            except sqlite3.Error, e:
+                logger.error("Could not write to database %s: %s" % (self.path, str(e)))
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error:
+                    # SQLite has rolled back already
+                    pass
+            for callback in callbacks:
+                callback()
+        conn.close()
@@ -17,98 +17,154 @@
 # You should have received a copy of the GNU General Public License
 # along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
 
-import threading
+import time
 import socket
+import logging
+import threading
 import IN
 
-from pydhcplib import dhcp_packet
-from pydhcplib import dhcp_network
+import packet
+from leases import LEASE_TIME, LeaseManager
 
-from utils import octetsAsInts
-from utils import fillFixedBuffer
+logger = logging.getLogger('lcrs')
 
 """
-    This module deals with IP's represented as either string: '10.20.30.40' or lists of ints: [10,20,30,40]
-    No other representation should be used. Various functions should convert on the go.
+    This module deals with IP's represented as strings: '10.20.30.40'
 """
 
+BOOT_FILE = "pxelinux.0"
+
+# A retransmit of a packet that was answered less than this many
+# seconds ago is dropped, later the same answer is sent again
+RETRANSMIT_WINDOW = 1.0
+# Bytes the kernel may buffer while a burst of requests is handled
+RECEIVE_BUFFER = 1024 * 1024
 
-class DHCPManager(dhcp_network.DhcpNetwork):
+class DHCPManager():
     """
+    Answers DHCP requests of the slaves booting by PXE. get_address is
+    called with the MAC of a client and returns its IP, it must return
+    quickly and must not touch the UI.
+
+    Replies are made from templates. Clients that retransmit while they
+    wait are answered from a cache of the last reply to each MAC.
+
+    The subnet mask is only sent if netmask is given, the master gives
+    the one of the interface. With a path_prefix, such as
+    http://10.20.20.1/, a boot loader that understands it fetches its
+    files from there instead of by TFTP.
     """
-    def __init__ (self, get_address=None, serverAddress='10.20.20.1', netcard="eth1"):
+    def __init__ (self, get_address=None, serverAddress='10.20.20.1', netcard="eth1",
+                  server_port=67, client_port=68, broadcast_address="255.255.255.255",
+                  boot_file=BOOT_FILE, path_prefix=None, netmask=None):
 
         self.get_address = get_address
         self.serverAddress = serverAddress
-        self.memory = {}
-        
-        dhcp_network.DhcpNetwork.__init__(self, netcard, "67", "68")
+        self.client_port = client_port
+        self.broadcast_address = broadcast_address
 
-        self.EnableBroadcast()
-        self.DisableReuseaddr()
-
-        self.CreateSocket()
-        self.BindToDevice()
+        # MAC -> (xid, message type, reply, time sent)
+        self.memory = {}
+        self.stats = {'received': 0, 'replied': 0, 'resent': 0,
+                      'dropped': 0, 'malformed': 0}
+        self.running = True
+
+        self.templates = {}
+        for message_type in (packet.OFFER, packet.ACK):
+            self.templates[message_type] = packet.ReplyTemplate(
+                message_type, serverAddress, lease_time=LEASE_TIME,
+                netmask=netmask, boot_file=boot_file, path_prefix=path_prefix)
+        self.templates[packet.NAK] = packet.ReplyTemplate(packet.NAK, serverAddress)
+
+        self.dhcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.dhcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.dhcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        self.dhcp_socket.settimeout(1.0)
+        if netcard:
+            try :
+                self.dhcp_socket.setsockopt(socket.SOL_SOCKET, IN.SO_BINDTODEVICE, netcard+'\0')
+            except socket.error, msg :
+                raise Exception("DHCP server error binding to device (%s:%s): %s" % (netcard, server_port, str(msg)))
+        try :
+            self.dhcp_socket.bind(('', server_port))
+        except socket.error, msg :
+            raise Exception("DHCP server error binding to device (%s:%s): %s" % (netcard, server_port, str(msg)))
 
         self.dhcpThread = threading.Thread (target = self.driveDHCPthread)
         self.dhcpThread.setDaemon(True)
         self.dhcpThread.start()
 
+    def close(self):
+        self.running = False
+        self.dhcpThread.join()
+        self.dhcp_socket.close()
 
-    def BindToDevice(self) :
-        try :
-            self.dhcp_socket.setsockopt(socket.SOL_SOCKET,IN.SO_BINDTODEVICE,self.listen_address+'\0')
-        except socket.error, msg :
-            raise Exception("DHCP server error binding to device (%s:%s): %s" % (self.listen_address, self.listen_port, str(msg)))
-
-        try :
-            self.dhcp_socket.bind(('', self.listen_port))
-        except socket.error, msg :
-            raise Exception("DHCP server error binding to device (%s:%s): %s" % (self.listen_address, self.listen_port, str(msg)))
-
-    def addBootInfoAndBroadcast (self, packet, clientAddress):
-
-        packet.SetMultipleOptions ({
-            #'tftp_server_name': map(ord, '10.20.20.1'),
-            #'bootfile_name': map(ord, 'pxelinux.0'),
-            'server_identifier': octetsAsInts (self.serverAddress),
-            'sname': fillFixedBuffer (64, self.serverAddress),      #map(ord,self.tftpServerAddress) + [0]*( 64-len(self.tftpServerAddress)),
-            'file' : fillFixedBuffer (128, 'pxelinux.0'),           #map(ord,'pxelinux.0') + [0]*(128-len('pxelinux.0')),
-            'ciaddr': octetsAsInts (self.serverAddress),                 #[10,20,20,100],
-            'yiaddr': octetsAsInts (clientAddress),                 #[10,20,20,100],
-            'siaddr': octetsAsInts (self.serverAddress)             #[10,20,20,1]
-            })
-        self.SendDhcpPacketTo (packet, "255.255.255.255", 68)
-
-    def HandleDhcpDiscover(self, packet):
-        clientMacAddress = ":".join ('%02x'%i for i in packet.GetHardwareAddress())
+    def handle_packet(self, data):
+        """Answer one packet from a client"""
+        self.stats['received'] += 1
         try:
-            clientAddress = self.get_address(clientMacAddress)
-        except:
+            request = packet.Request(data)
+        except packet.MalformedPacket, e:
+            self.stats['malformed'] += 1
+            logger.debug("Ignoring DHCP packet: %s" % str(e))
             return
 
-        self.memory[ clientMacAddress ] = clientAddress
+        if not request.message_type in (packet.DISCOVER, packet.REQUEST):
+            return
 
-        packet.SetMultipleOptions ({'ip_address_lease_time': [0,2,0,0]})  # Think it means 2*256*256 seconds :)
-        offer = dhcp_packet.DhcpPacket()
-        offer.CreateDhcpOfferPacketFrom (packet)
-        self.addBootInfoAndBroadcast (offer, clientAddress)
+        # A REQUEST for another server's offer
+        server_id = request.server_id
+        if request.message_type == packet.REQUEST and server_id and server_id != self.serverAddress:
+            self.memory.pop(request.mac, None)
+            return
 
-    def HandleDhcpRequest(self, packet):
-        clientMacAddress = ":".join ('%02x'%i for i in packet.GetHardwareAddress())
+        remembered = self.memory.get(request.mac, None)
+        if remembered and remembered[0] == request.xid and remembered[1] == request.message_type:
+            if time.time() - remembered[3] < RETRANSMIT_WINDOW:
+                self.stats['dropped'] += 1
+                return
+            self.stats['resent'] += 1
+            self.send(remembered[2], request.mac)
+            return
 
-        if clientMacAddress in self.memory:
-            clientAddress = self.memory[ clientMacAddress ]
+        try:
+            clientAddress = self.get_address(request.mac)
+        except Exception, e:
+            logger.error("No address for %s: %s" % (request.mac, str(e)))
+            return
 
-            packet.TransformToDhcpAckPacket()
-            self.addBootInfoAndBroadcast (packet, clientAddress)
+        if request.message_type == packet.DISCOVER:
+            reply = self.templates[packet.OFFER].reply(request, clientAddress)
         else:
-            print "Odd error: Why can't I remember this hardware/mac address?: " + clientMacAddress
+            requested_ip = request.requested_ip
+            if requested_ip and requested_ip != clientAddress:
+                logger.info("%s requested %s, but has %s" % (request.mac, requested_ip, clientAddress))
+                reply = self.templates[packet.NAK].reply(request)
+            else:
+                reply = self.templates[packet.ACK].reply(request, clientAddress)
+
+        self.memory[request.mac] = (request.xid, request.message_type, reply, time.time())
+        self.send(reply, request.mac)
+
+    def send(self, reply, mac):
+        try:
+            self.dhcp_socket.sendto(reply, (self.broadcast_address, self.client_port))
+            self.stats['replied'] += 1
+        except socket.error, msg:
+            logger.error("Could not send DHCP reply to %s: %s" % (mac, str(msg)))
 
     def driveDHCPthread (self):
         """
-            The main driving loop that breathes life into the threadless DhcpServer
+            The main driving loop, answering packets as they arrive
         """
-        while True :
-            self.GetNextDhcpPacket()
-
+        while self.running :
+            try:
+                data, __ = self.dhcp_socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except socket.error, msg:
+                if self.running:
+                    logger.error("DHCP server could not receive: %s" % str(msg))
+                    time.sleep(1.0)
+                continue
+            self.handle_packet(data)
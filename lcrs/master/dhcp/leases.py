@@ -0,0 +1,295 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+import tempfile
+import threading
+import simplejson as json
+from collections import deque
+
+logger = logging.getLogger('lcrs')
+
+# Seconds a lease is valid, as announced to the clients
+LEASE_TIME = 2 * 256 * 256
+# Seconds the saver waits for more changes before writing the leases
+SAVE_DELAY = 0.5
+
+class NoFreeAddress(Exception):
+    """Raised when every address of the pool is leased and none has
+       expired"""
+    pass
+
+class Lease():
+
+    def __init__(self, mac, ip, expires, uuid=None, active=True):
+        self.mac = mac
+        self.ip = ip
+        self.expires = expires
+        # The uuid that the slave on this address reported
+        self.uuid = uuid
+        # False for a lease loaded from disk, until the client asks
+        # for it again in this session
+        self.active = active
+
+    def to_dict(self):
+        return {'mac': self.mac, 'ip': self.ip, 'expires': self.expires, 'uuid': self.uuid}
+
+class LeaseManager():
+    """
+    Hands out the addresses of the DHCP range. Leases are found by MAC
+    address and by IP, and free addresses are kept in a queue, so a
+    lease costs the same however large the range is. A computer keeps
+    its address for as long as the master runs, unless the pool runs
+    dry: then leases that have expired are taken back, oldest first.
+    All methods may be called from any thread.
+
+    addresses is a list, or a dictionary of pool name -> list of
+    addresses when there is a pool for each network segment. A client
+    is leased an address from the pool of the segment it asks on.
+
+    With a path, the leases are loaded from it and saved to it whenever
+    they change, so a computer gets the same address after the master
+    is restarted. Saving is done by a thread of its own, which writes
+    a new file and renames it over the old one.
+    """
+
+    def __init__(self, addresses, lease_time=LEASE_TIME, path=None):
+        if type(addresses) != dict:
+            addresses = {None: addresses}
+        self.pools = dict((name, list(ips)) for name, ips in addresses.items())
+        self.addresses = sum(self.pools.values(), [])
+        # Address -> name of its pool
+        self.__pool_of = {}
+        for name, ips in self.pools.items():
+            for ip in ips:
+                if ip in self.__pool_of:
+                    raise ValueError("%s is in both pool %s and %s" % (ip, self.__pool_of[ip], name))
+                self.__pool_of[ip] = name
+        self.lease_time = lease_time
+        self.path = path
+        self.lock = threading.Lock()
+        self.__by_mac = {}
+        self.__by_ip = {}
+        if path:
+            self.__load()
+        # Pool name -> free addresses. May hold addresses that have been
+        # leased since they were put here, they are skipped when taken
+        self.__free = dict((name, deque(ip for ip in ips if not ip in self.__by_ip))
+                           for name, ips in self.pools.items())
+        self.__changed = threading.Event()
+        self.__saver = None
+        if path:
+            self.__saver = threading.Thread(target=self.__saver_thread)
+            self.__saver.setDaemon(True)
+            self.__saver.start()
+
+    def lease(self, mac, pool=None):
+        """Returns (ip, new) with the address of mac in pool, leasing a
+           free one if it has none. new is also True the first time a
+           lease from before a restart is asked for, and when a computer
+           has moved to another pool. The lease is renewed either way."""
+        if not pool in self.pools:
+            raise KeyError("No address pool %s" % pool)
+        self.lock.acquire()
+        try:
+            self.__changed.set()
+            lease = self.__by_mac.get(mac, None)
+            if lease and self.__pool_of[lease.ip] != pool:
+                self.__release(mac)
+                lease = None
+            if lease:
+                lease.expires = time.time() + self.lease_time
+                new = not lease.active
+                lease.active = True
+                return lease.ip, new
+            ip = self.__take_free(pool)
+            if ip is None:
+                ip = self.__reclaim_expired(pool)
+            if ip is None:
+                raise NoFreeAddress("All %d addresses of pool %s are leased" % (len(self.pools[pool]), pool))
+            self.__add(mac, ip)
+            return ip, True
+        finally:
+            self.lock.release()
+
+    def reserve(self, mac, ip):
+        """Lease a given address to mac, for a computer that already
+           uses it. A lease that either of them had is released."""
+        if not ip in self.__pool_of:
+            raise KeyError("%s is in no address pool" % ip)
+        self.lock.acquire()
+        try:
+            self.__changed.set()
+            lease = self.__by_mac.get(mac, None)
+            uuid = lease.uuid if lease else None
+            self.__release(mac)
+            other = self.__by_ip.get(ip, None)
+            if other:
+                self.__release(other.mac)
+            self.__add(mac, ip).uuid = uuid
+        finally:
+            self.lock.release()
+
+    def release(self, mac):
+        """Take back the address of mac, for a computer that is gone"""
+        self.lock.acquire()
+        try:
+            self.__changed.set()
+            self.__release(mac)
+        finally:
+            self.lock.release()
+
+    def set_uuid(self, mac, uuid):
+        """Remember the uuid reported by the slave of mac"""
+        self.lock.acquire()
+        try:
+            lease = self.__by_mac.get(mac, None)
+            if lease and lease.uuid != uuid:
+                lease.uuid = uuid
+                self.__changed.set()
+        finally:
+            self.lock.release()
+
+    def get(self, mac):
+        """The address leased to mac, or None"""
+        self.lock.acquire()
+        lease = self.__by_mac.get(mac, None)
+        self.lock.release()
+        return lease.ip if lease else None
+
+    def pool_of(self, ip):
+        """Name of the pool that ip belongs to"""
+        return self.__pool_of.get(ip, None)
+
+    def free_count(self):
+        self.lock.acquire()
+        count = len(self.addresses) - len(self.__by_ip)
+        self.lock.release()
+        return count
+
+    def known(self):
+        """Addresses of the leases from before a restart that have not
+           been asked for again"""
+        self.lock.acquire()
+        ips = [lease.ip for lease in self.__by_mac.values() if not lease.active]
+        self.lock.release()
+        return ips
+
+    def save(self):
+        """Write the leases to disk now"""
+        if not self.path:
+            return
+        self.lock.acquire()
+        try:
+            data = json.dumps([lease.to_dict() for lease in self.__by_mac.values()])
+        finally:
+            self.lock.release()
+        directory = os.path.dirname(self.path) or "."
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(prefix=".leases", dir=directory)
+        try:
+            f = os.fdopen(fd, "w")
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def close(self):
+        """Save what has changed and stop saving"""
+        if self.__saver:
+            saver = self.__saver
+            self.__saver = None
+            self.__changed.set()
+            saver.join()
+
+    def __add(self, mac, ip):
+        lease = Lease(mac, ip, time.time() + self.lease_time)
+        self.__by_mac[mac] = lease
+        self.__by_ip[ip] = lease
+        return lease
+
+    def __load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            f = open(self.path)
+            try:
+                leases = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            logger.error("Could not read leases from %s: %s" % (self.path, str(e)))
+            return
+        for d in leases:
+            # The range may have been changed in the settings
+            if not d['ip'] in self.__pool_of or d['ip'] in self.__by_ip:
+                continue
+            lease = Lease(d['mac'], d['ip'], d['expires'], d.get('uuid', None), active=False)
+            self.__by_mac[lease.mac] = lease
+            self.__by_ip[lease.ip] = lease
+        logger.info("Loaded %d leases from %s" % (len(self.__by_mac), self.path))
+
+    def __saver_thread(self):
+        # close() may be called before this thread first gets to run, so
+        # it is only asked whether to stop after a save
+        while True:
+            self.__changed.wait()
+            # Collect the changes of a burst of requests in one write
+            time.sleep(SAVE_DELAY)
+            self.__changed.clear()
+            try:
+                self.save()
+            except (IOError, OSError), e:
+                logger.error("Could not save leases to %s: %s" % (self.path, str(e)))
+            if not self.__saver:
+                break
+
+    def __release(self, mac):
+        lease = self.__by_mac.pop(mac, None)
+        if lease:
+            del self.__by_ip[lease.ip]
+            self.__free[self.__pool_of[lease.ip]].append(lease.ip)
+
+    def __take_free(self, pool):
+        free = self.__free[pool]
+        while free:
+            ip = free.popleft()
+            if not ip in self.__by_ip:
+                return ip
+        return None
+
+    def __reclaim_expired(self, pool):
+        now = time.time()
+        expired = [lease for lease in self.__by_mac.values()
+                   if lease.expires < now and self.__pool_of[lease.ip] == pool]
+        if not expired:
+            return None
+        lease = min(expired, key=lambda l: l.expires)
+        logger.warning("Address pool is exhausted, taking back %s from %s" % (lease.ip, lease.mac))
+        self.__release(lease.mac)
+        return self.__take_free(pool)
@@ -0,0 +1,165 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reads the few fields of a DHCP request that the server needs, and
+writes replies from templates. A template holds everything that is the
+same for all clients, so a reply is a copy of it with the client's
+transaction ID, hardware address and IP filled in.
+"""
+
+import socket
+import struct
+
+# op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr,
+# giaddr, chaddr, sname, file
+BOOTP_HEADER = struct.Struct("!BBBBIHH4s4s4s4s16s64s128s")
+MAGIC_COOKIE = "\x63\x82\x53\x63"
+OPTIONS_OFFSET = BOOTP_HEADER.size + len(MAGIC_COOKIE)
+
+BOOTREQUEST = 1
+BOOTREPLY = 2
+
+# Message types (option 53)
+(DISCOVER,
+ OFFER,
+ REQUEST,
+ DECLINE,
+ ACK,
+ NAK,
+ RELEASE,
+ INFORM) = range(1, 9)
+
+OPTION_PAD = 0
+OPTION_SUBNET_MASK = 1
+OPTION_REQUESTED_IP = 50
+OPTION_LEASE_TIME = 51
+OPTION_MESSAGE_TYPE = 53
+OPTION_SERVER_ID = 54
+# PXELINUX path prefix, RFC 5071
+OPTION_PATH_PREFIX = 210
+OPTION_END = 255
+
+# Offsets of the fields that differ from client to client
+XID_OFFSET = 4
+FLAGS_OFFSET = 10
+CIADDR_OFFSET = 12
+YIADDR_OFFSET = 16
+GIADDR_OFFSET = 24
+CHADDR_OFFSET = 28
+
+ZERO_IP = "\0\0\0\0"
+
+class MalformedPacket(ValueError):
+    pass
+
+class Request():
+    """The fields of a client's packet that matter to the server"""
+
+    def __init__(self, data):
+        if len(data) < OPTIONS_OFFSET:
+            raise MalformedPacket("Packet of %d bytes is too short" % len(data))
+        (op, __, hlen, __, self.xid, __, self.flags, self.ciaddr, __, __,
+         self.giaddr, chaddr, __, __) = BOOTP_HEADER.unpack_from(data)
+        if op != BOOTREQUEST:
+            raise MalformedPacket("Not a request")
+        if data[BOOTP_HEADER.size:OPTIONS_OFFSET] != MAGIC_COOKIE:
+            raise MalformedPacket("No DHCP magic cookie")
+        self.chaddr = chaddr
+        self.mac = ":".join("%02x" % ord(c) for c in chaddr[:min(hlen, 16)])
+        self.options = parse_options(data, OPTIONS_OFFSET)
+        message_type = self.options.get(OPTION_MESSAGE_TYPE, None)
+        if not message_type:
+            raise MalformedPacket("No message type")
+        self.message_type = ord(message_type[0])
+
+    @property
+    def requested_ip(self):
+        """The address the client asks for, or None"""
+        requested = self.options.get(OPTION_REQUESTED_IP, None)
+        if requested and len(requested) == 4:
+            return socket.inet_ntoa(requested)
+        if self.ciaddr != ZERO_IP:
+            return socket.inet_ntoa(self.ciaddr)
+        return None
+
+    @property
+    def server_id(self):
+        server_id = self.options.get(OPTION_SERVER_ID, None)
+        if server_id and len(server_id) == 4:
+            return socket.inet_ntoa(server_id)
+        return None
+
+def parse_options(data, offset):
+    """A dictionary of option code -> raw value"""
+    options = {}
+    end = len(data)
+    while offset < end:
+        code = ord(data[offset])
+        if code == OPTION_END:
+            break
+        if code == OPTION_PAD:
+            offset += 1
+            continue
+        if offset + 1 >= end:
+            raise MalformedPacket("Truncated option %d" % code)
+        length = ord(data[offset + 1])
+        options[code] = data[offset + 2:offset + 2 + length]
+        offset += 2 + length
+    return options
+
+def encode_options(options):
+    return "".join(chr(code) + chr(len(value)) + value for code, value in options) + chr(OPTION_END)
+
+def fixed_string(s, size):
+    return s[:size - 1].ljust(size, "\0")
+
+class ReplyTemplate():
+    """A reply of one message type, prepared for all clients"""
+
+    def __init__(self, message_type, server_address, lease_time=None,
+                 netmask=None, boot_file=None, path_prefix=None):
+        server = socket.inet_aton(server_address)
+        options = [(OPTION_MESSAGE_TYPE, chr(message_type)),
+                   (OPTION_SERVER_ID, server)]
+        if lease_time:
+            options.append((OPTION_LEASE_TIME, struct.pack("!I", lease_time)))
+        if netmask:
+            options.append((OPTION_SUBNET_MASK, socket.inet_aton(netmask)))
+        if path_prefix:
+            options.append((OPTION_PATH_PREFIX, path_prefix))
+        header = BOOTP_HEADER.pack(BOOTREPLY, 1, 6, 0, 0, 0, 0,
+                                   ZERO_IP, ZERO_IP,
+                                   server if boot_file else ZERO_IP,
+                                   ZERO_IP, "\0" * 16,
+                                   fixed_string(server_address if boot_file else "", 64),
+                                   fixed_string(boot_file or "", 128))
+        self.data = header + MAGIC_COOKIE + encode_options(options)
+
+    def reply(self, request, yiaddr=None):
+        """The reply to request, offering yiaddr"""
+        buf = bytearray(self.data)
+        struct.pack_into("!I", buf, XID_OFFSET, request.xid)
+        struct.pack_into("!H", buf, FLAGS_OFFSET, request.flags)
+        buf[CIADDR_OFFSET:CIADDR_OFFSET + 4] = request.ciaddr
+        if yiaddr:
+            buf[YIADDR_OFFSET:YIADDR_OFFSET + 4] = socket.inet_aton(yiaddr)
+        buf[GIADDR_OFFSET:GIADDR_OFFSET + 4] = request.giaddr
+        buf[CHADDR_OFFSET:CHADDR_OFFSET + 16] = request.chaddr
+        return str(buf)
@@ -0,0 +1,201 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serves the TFTP root over HTTP, for boot loaders that can fetch the
+kernel and initrd that way (lpxelinux.0 of SYSLINUX 5 and later, or
+iPXE). The DHCP server tells them to by sending the HTTP address of
+the root as the PXELINUX path prefix (option 210), so only the loader
+itself is sent by TFTP.
+
+Connections are kept alive between requests, single byte ranges are
+supported, and file contents are sent with sendfile(2) from the boot
+file cache that the TFTP servers use.
+"""
+
+import os
+import re
+import time
+import errno
+import select
+import socket
+import urllib
+import urlparse
+import logging
+import SocketServer
+import BaseHTTPServer
+
+from bootfiles import BootFileCache, resolve
+
+logger = logging.getLogger('lcrs')
+
+# Seconds an idle connection is kept open
+KEEPALIVE_TIMEOUT = 30
+# Bytes written at a time when sendfile is not available
+CHUNK_SIZE = 256 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def _load_sendfile():
+    """sendfile(2) through ctypes, os.sendfile is not in Python 2"""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc_sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return sent
+    return sendfile
+
+sendfile = _load_sendfile()
+
+def parse_range(header, size):
+    """(first, last) byte of a Range header, None to send the whole
+       file, or raises ValueError if it cannot be satisfied"""
+    m = RANGE_RE.match(header.strip().replace(" ", ""))
+    if not m:
+        # Several ranges or other units, the whole file will do
+        return None
+    first, last = m.groups()
+    if not first:
+        if not last:
+            return None
+        # The last bytes of the file
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first > last:
+        raise ValueError("Range starts after the end")
+    return first, last
+
+class BootRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    server_version = "LCRS"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def do_GET(self):
+        self.__serve(True)
+
+    def do_HEAD(self):
+        self.__serve(False)
+
+    def log_message(self, fmt, *args):
+        logger.debug("HTTP %s: %s" % (self.client_address[0], fmt % args))
+
+    def __serve(self, send_body):
+        path = resolve(self.server.root, urllib.unquote(urlparse.urlsplit(self.path)[2]))
+        if path is None:
+            self.__error(403)
+            return
+        try:
+            bootfile = self.server.cache.get(path)
+        except EnvironmentError:
+            self.__error(404)
+            return
+
+        first, last = 0, bootfile.size - 1
+        status = 200
+        if self.headers.get("Range", None) and bootfile.size:
+            try:
+                byte_range = parse_range(self.headers["Range"], bootfile.size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % bootfile.size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range:
+                first, last = byte_range
+                status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", self.date_time_string(bootfile.signature[2]))
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, bootfile.size))
+        self.end_headers()
+        if send_body and last >= first:
+            self.wfile.flush()
+            self.__send_file(bootfile, first, last - first + 1)
+            self.server.add_sent(last - first + 1)
+
+    def __send_file(self, bootfile, offset, count):
+        if sendfile is None:
+            end = offset + count
+            while offset < end:
+                self.wfile.write(bootfile.data[offset:min(end, offset + CHUNK_SIZE)])
+                offset += CHUNK_SIZE
+            return
+        # The socket is non-blocking because it has a timeout
+        out_fd = self.connection.fileno()
+        while count > 0:
+            try:
+                sent = sendfile(out_fd, bootfile.fileno(), offset, count)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise socket.error(e.errno, e.strerror)
+                if not select.select([], [out_fd], [], self.timeout)[1]:
+                    raise socket.timeout("Timed out sending %s" % bootfile.path)
+                continue
+            if sent == 0:
+                raise socket.error(errno.EPIPE, "Connection closed")
+            offset += sent
+            count -= sent
+
+    def __error(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+class HTTPBootServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the files under root on listen_ip. Call serve_forever() in
+    a thread of its own, and shutdown() to end it.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, listen_ip, port=80, cache=None):
+        self.root = os.path.abspath(root)
+        self.cache = cache or BootFileCache()
+        self.stats = {'bytes_sent': 0, 'started': time.time()}
+        BaseHTTPServer.HTTPServer.__init__(self, (listen_ip, port), BootRequestHandler)
+        self.port = self.server_address[1]
+
+    def add_sent(self, count):
+        # Only a statistic, a lost update from another thread is fine
+        self.stats['bytes_sent'] += count
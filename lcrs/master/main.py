@@ -39,45 +39,117 @@ import threading
 
 from lcrs.master.ui.mainwindow import MainWindow
 from lcrs.master import config_master
+from lcrs.slave import settings as slave_settings
 
 from group import Group
 from computer import Computer
+from database import Database
+from dhcp.leases import LeaseManager
+from bootfiles import BootFileCache
+
+# Addresses of the DHCP range probed at the same time for slaves that
+# are still running from before the master was started
+ADOPT_WORKERS = 32
+ADOPT_CONNECT_TIMEOUT = 1.0 # Seconds, slaves are on the local network
 
 class GtkMaster():
     """
     """
     def __init__(self):
 
-        # Check if the selected interface is configured correctly...
-        network_up = False
+        # Check if the selected interfaces are configured correctly...
+        self.segments = config_master.dhcp_segments()
+        self.segments_up = []
+        for segment in self.segments:
+            try:
+                ifconfig = subprocess.check_output(["ifconfig", segment['iface']])
+                p_ifconfig = re.compile(r"inet\s*addr:\s*%s" % re.escape(segment['server_ip']))
+                if not p_ifconfig.search(ifconfig):
+                    self.thread_failure_notify("The network interface (%s) is not up running with the correct IP address (%s). Check your settings or make sure that the network is running. Then restart LCRS." % (segment['iface'], segment['server_ip']))
+                else:
+                    # The slaves get the netmask of the interface
+                    p_mask = re.compile(r"inet\s*addr:\s*%s\s.*?Mask:\s*([\d.]+)" % re.escape(segment['server_ip']))
+                    m = p_mask.search(ifconfig)
+                    segment['netmask'] = m.group(1) if m else None
+                    self.segments_up.append(segment)
+            except:
+                self.thread_failure_notify("The network interface (%s) that is configured for the master server does not exist. Please check your settings or make sure that the network is running. Then restart LCRS." % segment['iface'])
+        network_up = bool(self.segments_up)
+        
+        # Only the summaries are loaded, hw_info is read when needed
+        self.database = None
+        self.known_computers = {}
         try:
-            ifconfig = subprocess.check_output(["ifconfig", config_master.dhcpInterface])
-            p_ifconfig = re.compile(r"inet\s*addr:\s*%s" % re.escape(config_master.dhcpServerAddress))
-            if not p_ifconfig.search(ifconfig):
-                self.thread_failure_notify("The network interface (%s) is not up running with the correct IP address (%s). Check your settings or make sure that the network is running. Then restart LCRS." % (config_master.dhcpInterface, config_master.dhcpServerAddress))
-            else:
-                network_up = True
-        except:
-            self.thread_failure_notify("The network interface (%s) that is configured for the master server does not exist. Please check your settings or make sure that the network is running. Then restart LCRS." % config_master.dhcpInterface)
+            self.database = Database(config_master.DATABASE_FILE)
+            self.database.start()
+            self.known_computers = self.database.summaries()
+            logger.info("%d computers in database %s" % (len(self.known_computers), config_master.DATABASE_FILE))
+        except Exception, e:
+            self.thread_failure_notify("Could not open the database %s, nothing will be recorded. Error was: %s" % (config_master.DATABASE_FILE, str(e)))
         
         #self.splash_window = splash.SplashWindow(self.start_main_window)     
         self.start_main_window()
-        self.dhcpIp4Range = [ config_master.dhcpPrefix + str(ip) for ip in config_master.dhcpIpRange ]
+        # One pool of addresses for each segment, with a lease index
+        # shared by the DHCP servers of all of them
+        try:
+            self.leases = LeaseManager(dict((segment['name'], segment['addresses']) for segment in self.segments),
+                                       path=config_master.LEASES_FILE)
+        except ValueError, e:
+            logger.error("Overlapping network segments: %s" % str(e))
+            self.thread_failure_notify("The DHCP ranges of the network segments overlap, only the first segment is served. Error was: %s" % str(e))
+            self.segments = self.segments[:1]
+            self.segments_up = [segment for segment in self.segments_up if segment in self.segments]
+            network_up = bool(self.segments_up)
+            self.leases = LeaseManager({self.segments[0]['name']: self.segments[0]['addresses']},
+                                       path=config_master.LEASES_FILE)
+        # MAC -> Computer of every computer that has a lease
+        self.computers = {}
+        # Slaves from before a restart reserve their addresses as they
+        # are found, DHCP is answered meanwhile
+        if network_up:
+            t = threading.Thread(target=self.adopt_slaves)
+            t.setDaemon(True)
+            t.start()
+        
+        # Boot files mapped once for the TFTP and HTTP servers of all
+        # segments
+        self.boot_files = BootFileCache()
+        
+        # Segment name -> HTTPBootServer, for the segments where the
+        # boot loader fetches the kernel and initrd by HTTP
+        self.http_servers = {}
+        if config_master.httpEnabled and network_up:
+            if not os.path.isfile(os.path.join(config_master.tftpRoot, config_master.httpBootFile)):
+                self.thread_failure_notify("HTTP boot is enabled, but the boot loader %s is not in the TFTP directory %s. Booting by TFTP only." % (config_master.httpBootFile, config_master.tftpRoot))
+            else:
+                self.start_http_servers()
         
         # The IP address has to match the address of the interface
         # used to send the dhcp packets.
-        if network_up:
+        # Segment name -> DHCPManager
+        self.dhcp_managers = {}
+        for segment in self.segments_up:
+            
+            def get_address(hwAddr, segment_name=segment['name']):
+                return self.get_dhcp_address(hwAddr, segment_name)
+            
+            boot_options = {'netmask': segment['netmask']}
+            http_server = self.http_servers.get(segment['name'], None)
+            if http_server:
+                boot_options['boot_file'] = config_master.httpBootFile
+                boot_options['path_prefix'] = "http://%s:%d/" % (segment['server_ip'], http_server.port)
             
             try:
                 from dhcp import DHCPManager
-                self.dhcpmgr = DHCPManager (self.get_dhcp_address,
-                                            config_master.dhcpServerAddress, config_master.dhcpInterface)
+                self.dhcp_managers[segment['name']] = DHCPManager (get_address,
+                                                                   segment['server_ip'], segment['iface'],
+                                                                   **boot_options)
             except ImportError:
-                self.thread_failure_notify("Could not start DHCP server. You do not have pydhcplib install. Try to run sudo apt-get install python-pydhcplib.")            
+                self.thread_failure_notify("Could not start DHCP server. Your Python installation is missing the IN module.")            
             except:
-                self.thread_failure_notify("Could not start DHCP server. Please check that you are running the program as root and that no other instances of a DHCP server is running (e.g. another instance of LCRS).")            
+                self.thread_failure_notify("Could not start DHCP server on %s. Please check that you are running the program as root and that no other instances of a DHCP server is running (e.g. another instance of LCRS)." % segment['iface'])            
 
-        def tftpyListen():
+        def tftpyListen(listen_ip):
             import tftpy #@UnresolvedImport
             try:
                 tftpy.TftpShared.setLogLevel(logging.FATAL)
@@ -89,26 +161,43 @@ class GtkMaster():
                 else:
                     print "Starting TFTP server in %s " % tftp_path
                     tftpserver = tftpy.TftpServer(tftp_path)
-                    tftpserver.listen(listenip=config_master.dhcpServerAddress, listenport=69)
+                    tftpserver.listen(listenip=listen_ip, listenport=69)
             except socket.error:
-                error = "Error assigning IP %s address for TFTP server. Another one is running or you didn't run this program with root permissions. Perhaps another instance of the program is left running or you have started this instance before the ports could be freed." % config_master.dhcpServerAddress
+                error = "Error assigning IP %s address for TFTP server. Another one is running or you didn't run this program with root permissions. Perhaps another instance of the program is left running or you have started this instance before the ports could be freed." % listen_ip
                 print error
                 self.thread_failure_notify(error)
             except tftpy.TftpShared.TftpException:
-                tftpyListen()
+                tftpyListen(listen_ip)
+
+        def builtinListen(listen_ip):
+            from tftp import TFTPServer
+            tftp_path = os.path.abspath(config_master.tftpRoot)
+            if not os.path.exists(tftp_path):
+                error = "TFTP directory does not exist! Could not start TFTP server. Please check your settings."
+                logger.error(error)
+                self.thread_failure_notify(error)
+                return
+            try:
+                tftpserver = TFTPServer(tftp_path, listen_ip, cache=self.boot_files)
+            except socket.error:
+                error = "Error assigning IP %s address for TFTP server. Another one is running or you didn't run this program with root permissions. Perhaps another instance of the program is left running or you have started this instance before the ports could be freed." % listen_ip
+                logger.error(error)
+                self.thread_failure_notify(error)
+                return
+            self.tftp_servers.append(tftpserver)
+            logger.info("Starting TFTP server on %s in %s" % (listen_ip, tftp_path))
+            tftpserver.serve_forever()
 
-        def tftpdListen():
+        def tftpdListen(listen_ip):
             tftp_path = os.path.abspath(config_master.tftpRoot)
             if not os.path.exists(tftp_path):
                 error = "TFTP directory does not exist! Could not start TFTP server. Please check your settings."
                 logger.error(error)
                 self.thread_failure_notify(error)
             else:
-                os.system("killall in.tftpd")
-                os.system("stop tftpd-hpa")
                 tftp_command = (
                     config_master.TFTP_COMMAND % 
-                    {'ip': config_master.dhcpServerAddress, 'path': tftp_path}
+                    {'ip': listen_ip, 'path': tftp_path}
                 )
                 logger.info("Starting TFTP server: %s " % tftp_command)
                 tftpd_process = subprocess.Popen(
@@ -126,10 +215,42 @@ class GtkMaster():
                     logger.error(error_msg)
                 logger.debug("tftpd finished")
 
-        if network_up:
-            self.tftp_thread = threading.Thread (target = tftpyListen if config_master.tftpTftpy else tftpdListen)
-            self.tftp_thread.setDaemon(True)
-            self.tftp_thread.start()
+        if config_master.tftpBuiltin:
+            tftpListen = builtinListen
+        elif config_master.tftpTftpy:
+            tftpListen = tftpyListen
+        else:
+            tftpListen = tftpdListen
+        
+        # The built-in server cannot share the port with tftpd either
+        if network_up and tftpListen != tftpyListen:
+            os.system("killall in.tftpd")
+            os.system("stop tftpd-hpa")
+        
+        self.tftp_threads = []
+        self.tftp_servers = []
+        for segment in self.segments_up:
+            t = threading.Thread (target = tftpListen,
+                                  args = (segment['server_ip'],))
+            t.setDaemon(True)
+            t.start()
+            self.tftp_threads.append(t)
+    
+    def start_http_servers(self):
+        from httpboot import HTTPBootServer
+        http_path = os.path.abspath(config_master.tftpRoot)
+        for segment in self.segments_up:
+            try:
+                server = HTTPBootServer(http_path, segment['server_ip'], config_master.httpPort,
+                                        cache=self.boot_files)
+            except socket.error, e:
+                self.thread_failure_notify("Could not start HTTP server on %s:%d, booting by TFTP only. Error was: %s" % (segment['server_ip'], config_master.httpPort, str(e)))
+                continue
+            logger.info("Starting HTTP server on %s:%d in %s" % (segment['server_ip'], server.port, http_path))
+            t = threading.Thread(target=server.serve_forever)
+            t.setDaemon(True)
+            t.start()
+            self.http_servers[segment['name']] = server
     
     def thread_failure_notify(self, msg):
 
@@ -160,24 +281,106 @@ class GtkMaster():
     def get_config(self):
         return config_master
 
-    def get_dhcp_address (self, hwAddr):
+    def get_dhcp_address (self, hwAddr, segment_name=None):
+        """Called by the DHCP thread of a segment for every client. The
+           computer of a new lease is added in the GTK thread, so the DHCP
+           server never waits for the UI."""
+        hwAddr = str(hwAddr)
+        ip, new = self.leases.lease(hwAddr, segment_name)
+        if new:
+            gobject.idle_add(self.add_computer, hwAddr, ip, segment_name)
+        return ip
+    
+    def add_computer(self, hwAddr, ip, segment_name=None):
+        # The row of a computer that moved to another segment stays
+        # until it is removed
+        old = self.computers.get(hwAddr, None)
+        if old and old.ipAddress != ip:
+            logger.info("%s moved from %s to %s" % (hwAddr, old.ipAddress, ip))
+        # Keep the ID of a computer that has been here before
+        known = self.known_computers.get(hwAddr, {})
+        newmaster = Computer(known.get('barcode', None), ip, hwAddr, config_master,
+                             database=self.database, leases=self.leases)
+        newmaster.segment = segment_name
+        if self.database:
+            self.database.save_computer(newmaster)
+        self.computers[hwAddr] = newmaster
+        self.groups[0].addComputer(newmaster)
+        self.appWindow.appendComputer(newmaster, self.groups[0])
+    
+    def remove_computer(self, computer):
+        """Forget a computer that was removed from its group, so its
+           address can be leased again"""
+        if self.computers.get(computer.macAddress, None) is computer:
+            del self.computers[computer.macAddress]
+            self.leases.release(computer.macAddress)
+    
+    def adopt_slaves(self):
+        """Look for slaves in the DHCP range that kept their lease from
+           before the master was restarted, and adopt them with their
+           jobs instead of waiting for them to ask for a new address"""
+        # Addresses leased before the restart are the likeliest
+        known = self.leases.known()
+        known_set = set(known)
+        addresses = known + [ip for segment in self.segments_up for ip in segment['addresses']
+                             if not ip in known_set]
+        lock = threading.Lock()
         
-        for computer in sum([g.computers for g in self.groups], []):
-            if computer.macAddress == hwAddr:
-                return computer.ipAddress
+        def probe():
+            while True:
+                lock.acquire()
+                ip = addresses.pop(0) if addresses else None
+                lock.release()
+                if ip is None:
+                    return
+                if slave_listening(ip):
+                    self.adopt_slave(ip)
         
-        ip = self.dhcpIp4Range.pop(0)
+        for __ in range(min(ADOPT_WORKERS, len(addresses))):
+            t = threading.Thread(target=probe)
+            t.setDaemon(True)
+            t.start()
+    
+    def adopt_slave(self, ip):
         
-        newmaster = Computer(None, str(ip), str(hwAddr), config_master)
-        self.groups[0].addComputer(newmaster)
-        self.appWindow.appendComputer(newmaster, self.groups[0])
-        return ip
+        def update(computer, *args):
+            gobject.idle_add(self.appWindow.update_computer, computer)
+        
+        def finished(computer):
+            update(computer)
+            if computer.wiped:
+                self.appWindow.alert_plugins('on-wipe-finished', computer)
+        
+        computer = Computer(None, ip, None, config_master, database=self.database,
+                            leases=self.leases)
+        if not computer.adopt(callback_finished=finished, callback_failed=update,
+                              callback_progress=update):
+            computer.connection.close()
+            return
+        logger.info("Adopted slave on %s (%s)" % (ip, computer.macAddress))
+        self.leases.reserve(computer.macAddress, ip)
+        computer.segment = self.leases.pool_of(ip)
+        gobject.idle_add(self.add_adopted_computer, computer)
+    
+    def add_adopted_computer(self, computer):
+        self.computers[computer.macAddress] = computer
+        self.groups[0].addComputer(computer)
+        self.appWindow.appendComputer(computer, self.groups[0])
     
     def addGroup(self, name):
         group = Group(name)
         self.groups.append(group)
         self.appWindow.appendGroup(group)
 
+def slave_listening(ip):
+    """Whether something accepts connections on the slave port of ip"""
+    try:
+        s = socket.create_connection((ip, slave_settings.LISTEN_PORT), ADOPT_CONNECT_TIMEOUT)
+    except (socket.error, socket.timeout):
+        return False
+    s.close()
+    return True
+
 if __name__ == '__main__':
 
     # Parse command line arguments
@@ -213,6 +416,14 @@ if __name__ == '__main__':
     
     app = GtkMaster()
     gtk.main()
+    
+    if app.database:
+        app.database.close()
+    app.leases.close()
+    for tftpserver in app.tftp_servers:
+        tftpserver.stop()
+    for httpserver in app.http_servers.values():
+        httpserver.shutdown()
 
     # Clean up
     os.system("killall in.tftpd")
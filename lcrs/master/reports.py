@@ -15,47 +15,153 @@
 # You should have received a copy of the GNU General Public License
 # along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
 
+"""
+Reports of the computers that have been processed, as HTML, CSV or JSON
+lines. Records are generated one computer at a time, from the groups of
+this session or from the database, and written straight to the file.
+"""
+
 import os
+import cgi
+import csv
+import simplejson as json
 from datetime import datetime
+from cStringIO import StringIO
 
 from lcrs.master import config_master
 
 REPORT_TEMPLATE_HTML = os.path.join(config_master.MASTER_PATH, "report_template.html")
 
-def make_report(groups, fmt, template=None):
-    
-    if not template:
-        if fmt == "html":
-            template = REPORT_TEMPLATE_HTML
-    
-    f = file(template)
-    
-    data = f.readlines()
-    data = "".join(data)
-    
-    data = data.replace("$report_date$", datetime.now().strftime("%D"))
-    
-    row_data = ""
-    
+# Format -> file name extension
+REPORT_FORMATS = {"html": ".html",
+                  "csv": ".csv",
+                  "jsonl": ".jsonl"}
+
+CSV_COLUMNS = ("id", "group", "mac", "system_uuid", "bios_sn", "wiped",
+               "wipe_method", "wipe_finished_on", "drives", "cpu", "memory")
+
+def computer_record(computer, group_name=None):
+    """The fields of a report row for a Computer"""
+    return make_record(computer.hw_info, group_name, computer.id, computer.macAddress,
+                       computer.wiped, computer.wipe_method, computer.wipe_finished_on)
+
+def make_record(hw_info, group_name, computer_id, mac, wiped, wipe_method, wipe_finished_on):
+    hw_info = hw_info or {}
+    drives = [{'size': v.get("Size", None), 'serial': v.get("Serial", None)}
+              for __, v in sorted(hw_info.get("Hard drives", {}).items())]
+    return {'id': computer_id,
+            'group': group_name,
+            'mac': mac,
+            'system_uuid': hw_info.get("System UUID", None),
+            'bios_sn': hw_info.get("BIOS S/N", ""),
+            'scanned': bool(hw_info),
+            'wiped': bool(wiped),
+            'wipe_method': wipe_method,
+            'wipe_finished_on': wipe_finished_on,
+            'drives': drives,
+            'cpu': hw_info.get("CPU", {}).get("name", "Unknown"),
+            'memory': hw_info.get("Memory", 0)}
+
+def group_records(groups):
+    """Records of the computers in groups of this session"""
     for group in groups:
-        for computer in group.computers:
-            if fmt == "html":
-                if computer.hw_info:
-                    html = "<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s<br />%s MB RAM</td></tr>" % (
-                                computer.id,
-                                computer.hw_info.get("BIOS S/N", ""),
-                                computer.wipe_method.title() if computer.wiped else "Not wiped",
-                                computer.wipe_finished_on.strftime("%D %T") if computer.wipe_finished_on else "-",
-                                ["%s MB, S/N: %s" % (v["Size"], v["Serial"]) for v in computer.hw_info.get("Hard drives", {}).values()],
-                                computer.hw_info.get("CPU", {}).get("name", "Unknown"),
-                                computer.hw_info.get("Memory", 0),
-                                )
-                else:
-                    html = "<tr><td>%s</td><td>-</td></tr>" % (computer.id,)
-                
-                row_data = row_data + html + "\n"
-    
-    print row_data
-    data = data.replace("$report_rows$", row_data)
-    
-    return data
+        for computer in list(group.computers):
+            yield computer_record(computer, group.getName())
+
+def history_records(database, since=None, until=None):
+    """Records of every computer in the database, wiped between since
+       and until if they are given. They belong to no group."""
+    for summary, hw_info in database.history(since, until):
+        finished_on = summary['wipe_finished_on']
+        yield make_record(hw_info, None, summary['barcode'], summary['mac'],
+                          summary['wiped'], summary['wipe_method'],
+                          datetime.fromtimestamp(finished_on) if finished_on else None)
+
+def filter_records(records, since=None, until=None, group_names=None):
+    """Only records wiped on or after since and before until, and in
+       one of group_names"""
+    for record in records:
+        if not group_names is None and not record['group'] in group_names:
+            continue
+        if since or until:
+            finished_on = record['wipe_finished_on']
+            if finished_on is None:
+                continue
+            if since and finished_on < since:
+                continue
+            if until and finished_on >= until:
+                continue
+        yield record
+
+def format_drives(record, separator):
+    return separator.join("%s MB, S/N: %s" % (d['size'], d['serial']) for d in record['drives'])
+
+def format_date(date):
+    return date.strftime("%D %T") if date else "-"
+
+def write_html(f, records, template=None):
+    f_template = file(template or REPORT_TEMPLATE_HTML)
+    try:
+        data = f_template.read()
+    finally:
+        f_template.close()
+    data = data.replace("$report_date$", datetime.now().strftime("%D"))
+    head, tail = data.split("$report_rows$", 1)
+    f.write(head)
+    count = 0
+    for record in records:
+        if record['scanned']:
+            cells = (record['id'],
+                     record['bios_sn'],
+                     record['wipe_method'].title() if record['wiped'] and record['wipe_method'] else "Not wiped",
+                     format_date(record['wipe_finished_on']),
+                     format_drives(record, "\n"),
+                     "%s\n%s MB RAM" % (record['cpu'], record['memory']))
+            f.write("<tr>%s</tr>\n" % "".join(
+                "<td>%s</td>" % cgi.escape(unicode(c)).replace("\n", "<br />").encode('utf-8')
+                for c in cells))
+        else:
+            f.write("<tr><td>%s</td><td>-</td></tr>\n" % cgi.escape(unicode(record['id'])).encode('utf-8'))
+        count += 1
+    f.write(tail)
+    return count
+
+def write_csv(f, records):
+    writer = csv.writer(f)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for record in records:
+        row = dict(record,
+                   wipe_finished_on=record['wipe_finished_on'].isoformat() if record['wipe_finished_on'] else "",
+                   drives=format_drives(record, "; "))
+        writer.writerow([unicode(row[c] if not row[c] is None else "").encode('utf-8')
+                         for c in CSV_COLUMNS])
+        count += 1
+    return count
+
+def write_jsonl(f, records):
+    count = 0
+    for record in records:
+        if record['wipe_finished_on']:
+            record = dict(record, wipe_finished_on=record['wipe_finished_on'].isoformat())
+        f.write(json.dumps(record))
+        f.write("\n")
+        count += 1
+    return count
+
+def write_report(f, records, fmt, template=None):
+    """Write records to the open file f as they are generated. Returns
+       the number of computers in the report."""
+    if fmt == "html":
+        return write_html(f, records, template)
+    if fmt == "csv":
+        return write_csv(f, records)
+    if fmt == "jsonl":
+        return write_jsonl(f, records)
+    raise ValueError("Unknown report format: %s" % fmt)
+
+def make_report(groups, fmt, template=None):
+    """The report of the computers in groups as a string"""
+    f = StringIO()
+    write_report(f, group_records(groups), fmt, template)
+    return f.getvalue()
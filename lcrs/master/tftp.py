@@ -0,0 +1,365 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A read-only TFTP server for booting the slaves, serving all transfers
+from one thread.
+
+Clients may ask for larger blocks (blksize, RFC 2348) and for several
+blocks to be sent before each acknowledgement (windowsize, RFC 7440).
+PXE clients usually ask for blksize and tsize, so a kernel and initrd
+are sent in 1468 byte blocks instead of 512 byte ones.
+
+Files are read from a BootFileCache, so all transfers of a file share
+one memory mapping of it. Sending is not zero-copy: each block is
+copied out of the mapping and into its packet.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+import threading
+from collections import deque
+
+from bootfiles import BootFileCache, resolve
+
+logger = logging.getLogger('lcrs')
+
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+ERROR_UNDEFINED = 0
+ERROR_NOT_FOUND = 1
+ERROR_ACCESS = 2
+ERROR_ILLEGAL = 4
+ERROR_UNKNOWN_TID = 5
+ERROR_OPTION = 8
+
+DEFAULT_BLKSIZE = 512
+# The largest block that fits in an Ethernet frame without fragmenting
+MAX_BLKSIZE = 1468
+MAX_WINDOWSIZE = 64
+
+# Seconds before a window is sent again, and times it is sent again
+# before the transfer is given up
+TIMEOUT = 1.0
+RETRIES = 5
+
+# Finished transfers kept for their stats
+STATS_KEPT = 100
+
+class TransferError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+def error_packet(code, message):
+    return struct.pack("!HH", OP_ERROR, code) + message + "\0"
+
+def parse_request(data):
+    """Returns (opcode, filename, mode, options) of a RRQ or WRQ"""
+    opcode = struct.unpack("!H", data[:2])[0]
+    fields = data[2:].split("\0")
+    if len(fields) < 3:
+        raise TransferError(ERROR_ILLEGAL, "Malformed request")
+    filename, mode = fields[0], fields[1].lower()
+    options = {}
+    # The fields end with an empty string after the last \0
+    pairs = fields[2:-1]
+    for i in range(0, len(pairs) - 1, 2):
+        options[pairs[i].lower()] = pairs[i + 1]
+    return opcode, filename, mode, options
+
+class Transfer():
+    """A file being sent to one client, from a socket of its own"""
+
+    def __init__(self, server, client, path, options):
+        self.server = server
+        self.client = client
+        self.filename = path
+        self.file = server.cache.get(path)
+        self.size = self.file.size
+        self.blksize = DEFAULT_BLKSIZE
+        self.windowsize = 1
+        self.timeout = TIMEOUT
+
+        # Options that are acknowledged in an OACK
+        self.accepted = []
+        if 'blksize' in options:
+            self.blksize = max(8, min(MAX_BLKSIZE, int(options['blksize'])))
+            self.accepted.append(('blksize', self.blksize))
+        if 'windowsize' in options:
+            self.windowsize = max(1, min(MAX_WINDOWSIZE, int(options['windowsize'])))
+            self.accepted.append(('windowsize', self.windowsize))
+        if 'tsize' in options:
+            self.accepted.append(('tsize', self.size))
+        if 'timeout' in options:
+            self.timeout = max(1, min(255, int(options['timeout'])))
+            self.accepted.append(('timeout', self.timeout))
+
+        # The last block is shorter than blksize, possibly empty
+        self.blocks = self.size // self.blksize + 1
+        # Blocks are counted from 1, the OACK is block 0
+        self.acked = 0
+        self.sent = 0
+        self.retries = 0
+        self.deadline = None
+        self.done = False
+
+        self.stats = {'client': "%s:%d" % client,
+                      'filename': path,
+                      'size': self.size,
+                      'blksize': self.blksize,
+                      'windowsize': self.windowsize,
+                      'bytes_sent': 0,
+                      'packets_sent': 0,
+                      'retransmits': 0,
+                      'started': time.time(),
+                      'duration': None,
+                      'error': None}
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((server.listen_ip, 0))
+        self.sock.setblocking(0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def start(self):
+        if self.accepted:
+            self.__send(struct.pack("!H", OP_OACK) +
+                        "".join("%s\0%s\0" % (k, v) for k, v in self.accepted))
+            self.deadline = time.time() + self.timeout
+        else:
+            self.__send_window()
+
+    def read_block(self, block):
+        """A copy of a block of the file. Filling one packet buffer from
+           a buffer() of the mapping copies less, but costs three times
+           as much per block in Python 2."""
+        offset = (block - 1) * self.blksize
+        return self.file.data[offset:offset + self.blksize]
+
+    def handle(self, data, address):
+        if address != self.client:
+            # Not our client, RFC 1350 asks us to tell it off
+            self.sock.sendto(error_packet(ERROR_UNKNOWN_TID, "Unknown transfer ID"), address)
+            return
+        if len(data) < 4:
+            return
+        opcode, number = struct.unpack("!HH", data[:4])
+        if opcode == OP_ERROR:
+            self.finish("Client aborted: %s" % data[4:].rstrip("\0"))
+            return
+        if opcode != OP_ACK:
+            return
+        # Block numbers wrap at 65536, find the one in the window that
+        # is acknowledged. Older ACKs are duplicates and are ignored.
+        ahead = (number - self.acked) & 0xffff
+        if ahead > self.sent - self.acked:
+            return
+        self.acked += ahead
+        self.retries = 0
+        if self.acked >= self.blocks:
+            self.finish()
+            return
+        if ahead == 0 and self.sent > 0:
+            # Answering repeated ACKs would send every block twice from
+            # here on (the Sorcerer's Apprentice bug), the timeout takes
+            # care of them
+            return
+        if self.acked < self.sent:
+            # The client lost the rest of the window
+            self.stats['retransmits'] += 1
+        self.__send_window()
+
+    def check_timeout(self, now):
+        if self.done or self.deadline is None or now < self.deadline:
+            return
+        self.retries += 1
+        if self.retries > RETRIES:
+            self.finish("Timed out")
+            return
+        self.stats['retransmits'] += 1
+        if self.acked == 0 and self.sent == 0 and self.accepted:
+            self.start()
+        else:
+            self.__send_window()
+
+    def finish(self, error=None):
+        self.done = True
+        self.stats['duration'] = time.time() - self.stats['started']
+        self.stats['error'] = error
+        # A mapping that has been replaced is unmapped with its last
+        # transfer
+        self.file = None
+
+    def __send_window(self):
+        """Send the blocks after the last one acknowledged"""
+        last = min(self.blocks, self.acked + self.windowsize)
+        for block in range(self.acked + 1, last + 1):
+            data = self.read_block(block)
+            self.__send(struct.pack("!HH", OP_DATA, block & 0xffff) + data)
+            self.stats['bytes_sent'] += len(data)
+        self.sent = last
+        self.deadline = time.time() + self.timeout
+
+    def __send(self, packet):
+        try:
+            self.sock.sendto(packet, self.client)
+            self.stats['packets_sent'] += 1
+        except socket.error, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+class TFTPServer():
+    """
+    Serves the files under root on listen_ip. Call serve_forever() in
+    a thread of its own, and stop() to end it. Servers on several
+    addresses may share a cache.
+    """
+
+    def __init__(self, root, listen_ip, port=69, cache=None):
+        self.root = os.path.abspath(root)
+        self.cache = cache or BootFileCache()
+        self.listen_ip = listen_ip
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((listen_ip, port))
+        self.sock.setblocking(0)
+        self.port = self.sock.getsockname()[1]
+        self.running = False
+        # fileno -> Transfer
+        self.transfers = {}
+        self.finished = deque(maxlen=STATS_KEPT)
+        self.lock = threading.Lock()
+
+    def resolve(self, filename):
+        """The path of a requested file, which must be under root"""
+        path = resolve(self.root, filename)
+        if path is None:
+            raise TransferError(ERROR_ACCESS, "Access violation")
+        if not os.path.isfile(path):
+            raise TransferError(ERROR_NOT_FOUND, "File not found")
+        return path
+
+    def stats(self):
+        """Stats of the transfers going on and the last ones finished"""
+        self.lock.acquire()
+        try:
+            return ([dict(t.stats) for t in self.transfers.values()],
+                    [dict(s) for s in self.finished])
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        self.running = False
+
+    def serve_forever(self):
+        self.running = True
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN)
+        while self.running:
+            for fd, __ in poller.poll(100):
+                if fd == self.sock.fileno():
+                    self.__accept(poller)
+                    continue
+                transfer = self.transfers.get(fd, None)
+                if transfer is None:
+                    continue
+                while not transfer.done:
+                    try:
+                        data, address = transfer.sock.recvfrom(65536)
+                    except socket.error:
+                        break
+                    self.__guarded(transfer, transfer.handle, data, address)
+            now = time.time()
+            for fd, transfer in self.transfers.items():
+                self.__guarded(transfer, transfer.check_timeout, now)
+                if transfer.done:
+                    self.__finished(poller, fd, transfer)
+        for fd, transfer in self.transfers.items():
+            transfer.finish("Server stopped")
+            self.__finished(poller, fd, transfer)
+        self.sock.close()
+
+    def __guarded(self, transfer, method, *args):
+        """Call a method of a transfer, ending only that transfer if it
+           fails, so the others go on"""
+        try:
+            method(*args)
+        except Exception, e:
+            logger.exception("TFTP transfer of %s to %s:%d failed" % ((transfer.filename,) + transfer.client))
+            transfer.finish(str(e) or e.__class__.__name__)
+
+    def __accept(self, poller):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except socket.error:
+                return
+            try:
+                opcode, filename, mode, options = parse_request(data)
+                if opcode == OP_WRQ:
+                    raise TransferError(ERROR_ACCESS, "Server is read-only")
+                if opcode != OP_RRQ:
+                    raise TransferError(ERROR_ILLEGAL, "Illegal TFTP operation")
+                path = self.resolve(filename)
+                transfer = Transfer(self, address, path, options)
+            except TransferError, e:
+                logger.debug("TFTP request from %s:%d refused: %s" % (address + (str(e),)))
+                self.sock.sendto(error_packet(e.code, str(e)), address)
+                continue
+            except (ValueError, struct.error):
+                self.sock.sendto(error_packet(ERROR_OPTION, "Bad request"), address)
+                continue
+            except EnvironmentError, e:
+                self.sock.sendto(error_packet(ERROR_ACCESS, str(e)), address)
+                continue
+            logger.debug("TFTP sending %s to %s:%d, blksize %d, windowsize %d" %
+                         (path, address[0], address[1], transfer.blksize, transfer.windowsize))
+            self.lock.acquire()
+            self.transfers[transfer.fileno()] = transfer
+            self.lock.release()
+            poller.register(transfer.fileno(), select.POLLIN)
+            self.__guarded(transfer, transfer.start)
+
+    def __finished(self, poller, fd, transfer):
+        poller.unregister(fd)
+        self.lock.acquire()
+        del self.transfers[fd]
+        self.finished.append(transfer.stats)
+        self.lock.release()
+        transfer.sock.close()
+        stats = transfer.stats
+        if stats['error']:
+            logger.warning("TFTP transfer of %s to %s failed: %s" % (stats['filename'], stats['client'], stats['error']))
+        else:
+            logger.info("TFTP sent %s to %s: %d bytes in %.2f s, %d retransmits" %
+                        (stats['filename'], stats['client'], stats['size'],
+                         stats['duration'], stats['retransmits']))
@@ -27,10 +27,11 @@ from lcrs.master.plugins import CallbackFailed
 from lcrs.master import config_master
 from lcrs.master.ui.decorators import idle_add_decorator
 
-COLUMN_LENGTH = 10
+COLUMN_LENGTH = 12
 (COLUMN_STATUS_ICON, COLUMN_ICON_SIZE, COLUMN_ID, COLUMN_ID_FONT,
- COLUMN_NETWORK, COLUMN_PROGRESS, COLUMN_WIPED, COLUMN_REGISTERED, 
- COLUMN_ACTIVITY, COLUMN_COMPUTER) = range(COLUMN_LENGTH)
+ COLUMN_NETWORK, COLUMN_PROGRESS, COLUMN_THROUGHPUT, COLUMN_ETA,
+ COLUMN_WIPED, COLUMN_REGISTERED, COLUMN_ACTIVITY,
+ COLUMN_COMPUTER) = range(COLUMN_LENGTH)
 
 import threading
 
@@ -106,6 +107,16 @@ class GroupPage():
         col = gtk.TreeViewColumn("Progress", cell, value=COLUMN_PROGRESS)
         self.treeview.append_column(col)
 
+        # Throughput column
+        cell = gtk.CellRendererText()
+        col = gtk.TreeViewColumn("Speed", cell, text=COLUMN_THROUGHPUT)
+        self.treeview.append_column(col)
+
+        # ETA column
+        cell = gtk.CellRendererText()
+        col = gtk.TreeViewColumn("ETA", cell, text=COLUMN_ETA)
+        self.treeview.append_column(col)
+
         # Column for wiped icon
         cell = gtk.CellRendererPixbuf()
         col = gtk.TreeViewColumn("Wiped", cell, icon_name=COLUMN_WIPED, stock_size=COLUMN_ICON_SIZE)
@@ -128,6 +139,8 @@ class GroupPage():
                                        gobject.TYPE_STRING, 
                                        gobject.TYPE_STRING, 
                                        gobject.TYPE_INT,     # Progress
+                                       gobject.TYPE_STRING,  # Throughput
+                                       gobject.TYPE_STRING,  # ETA
                                        gobject.TYPE_STRING,  # Wiped
                                        gobject.TYPE_STRING,  # Registered
                                        gobject.TYPE_STRING,  # Activity
@@ -305,6 +318,8 @@ class GroupPage():
                     self.show_computer(computer)
                     return
                 show_error()
+            else:
+                computer.remember()
         
         t = threading.Thread(target=get_id_thread)
         t.setDaemon(True)
@@ -421,7 +436,11 @@ class GroupPage():
         row[COLUMN_ID] = str(computer.id) if computer.id else "No ID"
         row[COLUMN_ID_FONT] = "normal 18"
         row[COLUMN_NETWORK] = "IP: %s\nMAC: %s" % (str(computer.ipAddress), str(computer.macAddress))
+        if computer.segment:
+            row[COLUMN_NETWORK] += "\nSegment: %s" % computer.segment
         row[COLUMN_PROGRESS] = computer.progress() * 100
+        row[COLUMN_THROUGHPUT] = format_throughput(computer.throughput())
+        row[COLUMN_ETA] = format_eta(computer.eta())
         row[COLUMN_ACTIVITY] = computer.activity()
         row[COLUMN_COMPUTER] = computer
         row[COLUMN_WIPED] = wiped_icon(computer.wiped)
@@ -517,6 +536,7 @@ class GroupPage():
                 dialog.destroy()
             if not response_id == gtk.RESPONSE_YES: return
             self.group.removeComputer(computer)
+            self.mainwindow.master_instance.remove_computer(computer)
             self.liststore.remove(it)
             del self.iters[computer]
             self.mainwindow.update_overall_status()
@@ -552,6 +572,8 @@ class GroupPage():
             self.liststore.set_value(it, COLUMN_ID, str(computer.id) if computer.id else "No ID")
             progress = computer.progress()
             self.liststore.set_value(it, COLUMN_PROGRESS, progress * 100 if type(progress) in (float, int) else 0)
+            self.liststore.set_value(it, COLUMN_THROUGHPUT, format_throughput(computer.throughput()))
+            self.liststore.set_value(it, COLUMN_ETA, format_eta(computer.eta()))
             self.liststore.set_value(it, COLUMN_ACTIVITY, computer.activity())
             self.liststore.set_value(it, COLUMN_WIPED, wiped_icon(computer.wiped))
             self.liststore.set_value(it, COLUMN_REGISTERED, register_icon(computer.is_registered))
@@ -563,7 +585,8 @@ class GroupPage():
         
         
     def on_save_report(self, *args):
-        __ = ReportDialog(self.group, self.mainwindow.groups)
+        __ = ReportDialog(self.group, self.mainwindow.groups,
+                          self.mainwindow.master_instance.database)
     
     def on_quit(self, *args):
         self.mainwindow.main_quit()
@@ -587,3 +610,14 @@ def register_icon(is_submitted):
         return "gtk-yes"
     else:
         return "gtk-no"
+
+def format_throughput(throughput):
+    if throughput is None:
+        return ""
+    return "%.1f MB/s" % (throughput / 1e6)
+
+def format_eta(eta):
+    if eta is None:
+        return ""
+    eta = int(eta)
+    return "%d:%02d:%02d" % (eta / 3600, eta / 60 % 60, eta % 60)
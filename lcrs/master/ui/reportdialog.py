@@ -17,24 +17,31 @@
 # along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
 
 import gtk
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import os
 
 from lcrs.master import reports, config_master
 
+# Formats in the order they are offered
+REPORT_FORMAT_NAMES = (("html", "HTML"),
+                       ("csv", "CSV"),
+                       ("jsonl", "JSON lines"))
+
 class ReportDialog:
-    def __init__(self, group_clicked, all_groups):
+    def __init__(self, group_clicked, all_groups, database=None):
         self.glade = gtk.Builder()
         self.glade.add_from_file(
             os.path.join(config_master.MASTER_PATH, 'ui/glade/mainwindow.glade')
         )
         
         self.window = self.glade.get_object ('dialogReport')
+        self.window.set_title("Save report...")
         self.window.connect("delete-event", self.on_delete_event)
         
         self.group = group_clicked
         self.all_groups = all_groups
+        self.database = database
         
         self.get_widget("saveThis").set_label("Save \"%s\"" % self.group.getName())
         self.get_widget("entryName").set_text("lcrs_report_%s" % (datetime.now().strftime("%Y-%m-%d")))
@@ -48,6 +55,8 @@ class ReportDialog:
         self.get_widget("saveThis").connect("clicked", self.on_save_this)
         self.get_widget("saveAll").connect("clicked", self.on_save_all)
         
+        self.add_options()
+        
         self.glade.connect_signals(self)
 
         self.window.show()
@@ -56,6 +65,37 @@ class ReportDialog:
         """Use this object as a dictionary of widgets"""
         return self.glade.get_object(key)
 
+    def add_options(self):
+        """Format and filters of the report"""
+        self.combo_format = gtk.combo_box_new_text()
+        for __, name in REPORT_FORMAT_NAMES:
+            self.combo_format.append_text(name)
+        self.combo_format.set_active(0)
+        self.combo_format.connect("changed", self.on_change_format)
+        
+        self.spin_days = gtk.SpinButton(gtk.Adjustment(0, 0, 3650, 1, 7), digits=0)
+        
+        self.check_history = gtk.CheckButton("Include all computers from earlier sessions")
+        self.check_history.set_sensitive(not self.database is None)
+        self.check_history.connect("toggled", self.update_buttons)
+        
+        hbox = gtk.HBox(spacing=5)
+        hbox.pack_start(gtk.Label("Format:"), False, False)
+        hbox.pack_start(self.combo_format, False, False)
+        hbox.pack_start(gtk.Label("Wiped in the last"), False, False)
+        hbox.pack_start(self.spin_days, False, False)
+        hbox.pack_start(gtk.Label("days (0 for all)"), False, False)
+        vbox = self.get_widget("vbox7")
+        vbox.pack_start(hbox, False, False, 5)
+        vbox.pack_start(self.check_history, False, False, 5)
+        vbox.show_all()
+    
+    def get_format(self):
+        return REPORT_FORMAT_NAMES[self.combo_format.get_active()][0]
+    
+    def on_change_format(self, *args):
+        self.get_widget("label12").set_text(reports.REPORT_FORMATS[self.get_format()])
+    
     def quit(self): #@ReservedAssignment
         self.window.destroy()
     
@@ -70,8 +110,14 @@ class ReportDialog:
         
         self.get_widget("entryName").set_text(original_text)
         
-        self.get_widget("saveThis").set_sensitive(original_text != "")
-        self.get_widget("saveAll").set_sensitive(original_text != "")
+        self.update_buttons()
+    
+    def update_buttons(self, *args):
+        named = self.get_widget("entryName").get_text() != ""
+        # Computers from earlier sessions belong to no group, so only
+        # all of them can be saved
+        self.get_widget("saveThis").set_sensitive(named and not self.check_history.get_active())
+        self.get_widget("saveAll").set_sensitive(named)
     
     def on_delete_event(self, widget, callback_data):
         """
@@ -92,19 +138,31 @@ class ReportDialog:
         self.save_report(self.all_groups)
     
     def save_report(self, groups):
-        data = reports.make_report(groups, "html")
+        fmt = self.get_format()
+        days = self.spin_days.get_value_as_int()
+        since = datetime.now() - timedelta(days=days) if days else None
+        if self.check_history.get_active():
+            # Computers of this session may still be on their way
+            self.database.flush()
+            records = reports.history_records(self.database, since)
+        else:
+            records = reports.filter_records(reports.group_records(groups), since)
+        
         folder = self.get_widget("filechooserbuttonPath").get_current_folder()
-        filename = self.get_widget("entryName").get_text() + ".html"
+        filename = self.get_widget("entryName").get_text() + reports.REPORT_FORMATS[fmt]
         fullpath = os.path.join(folder, filename)
         try:
             f = file(fullpath, "w")
-            f.write(data)
+            try:
+                count = reports.write_report(f, records, fmt)
+            finally:
+                f.close()
             os.chown(fullpath, config_master.USER_UID, config_master.USER_GID)
-        except:
-            self.fail("Could not write to file %s" % fullpath)
-        finally:
-            self.success("Report saved!")
-            self.quit()
+        except Exception, e:
+            self.fail("Could not write to file %s: %s" % (fullpath, str(e)))
+        else:
+            self.success("Report of %d computers saved!" % count)
+        self.quit()
 
 
     def fail(self, msg):
@@ -20,14 +20,48 @@ __licence__ = "GNU General Publice License version 3 or later"
 
 
 import os
+import re
 import time
 import errno
 import signal
 import threading
 import subprocess
 
+from reactor import Reactor, READ, WRITE, ERROR, set_nonblocking
 
-__all__ = [ 'Process', 'with_timeout', 'Timeout' ]
+
+__all__ = [ 'Process', 'OutputBuffer', 'shared_reactor', 'with_timeout', 'Timeout' ]
+
+
+# Seconds between checks whether a process has exited. The interval
+# doubles up to the maximum while the process keeps running.
+EXIT_POLL_MIN = 0.001
+EXIT_POLL_MAX = 1.0
+
+# Output passed to on_line callbacks is split at newlines, carriage
+# returns and backspaces, which progress meters use to redraw a line.
+# Longer lines are passed on in pieces of this many bytes.
+LINE_SEPARATORS = re.compile(r"[\r\n\b]+")
+MAX_LINE_LENGTH = 4096
+
+_shared_reactor = None
+_shared_reactor_lock = threading.Lock()
+
+def shared_reactor():
+    """The reactor serving processes that are not given one. It is
+       started in a background thread on first use.
+    """
+    global _shared_reactor
+    _shared_reactor_lock.acquire()
+    try:
+        if _shared_reactor is None:
+            _shared_reactor = Reactor()
+            t = threading.Thread(name="asyncproc-reactor", target=_shared_reactor.run)
+            t.setDaemon(True)
+            t.start()
+        return _shared_reactor
+    finally:
+        _shared_reactor_lock.release()
 
 
 class Timeout(Exception):
@@ -93,13 +127,82 @@ def with_timeout(timeout, func, *args, **kwargs):
 
 
 
+class OutputBuffer(object):
+    """Output collected from one pipe of a process.
+       Without a limit all output is kept until it is read. With a limit,
+       the output goes into a ring buffer of that many bytes allocated up
+       front, and the oldest output is overwritten by new output.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        # Bytes overwritten before they were read
+        self.dropped = 0
+        if limit is None:
+            self.__chunks = []
+        else:
+            self.__ring = bytearray(limit)
+            self.__start = 0
+            self.__length = 0
+
+    def __len__(self):
+        if self.limit is None:
+            return sum(map(len, self.__chunks))
+        return self.__length
+
+    def append(self, data):
+        if self.limit is None:
+            self.__chunks.append(data)
+            return
+        limit = self.limit
+        n = len(data)
+        if n >= limit:
+            # Nothing but the end of data fits
+            self.dropped += self.__length + n - limit
+            if limit:
+                self.__ring[:] = data[n - limit:]
+            self.__start = 0
+            self.__length = limit
+            return
+        end = (self.__start + self.__length) % limit
+        first = min(n, limit - end)
+        self.__ring[end:end + first] = data[:first]
+        self.__ring[:n - first] = data[first:]
+        overflow = self.__length + n - limit
+        if overflow > 0:
+            self.dropped += overflow
+            self.__start = (self.__start + overflow) % limit
+            self.__length = limit
+        else:
+            self.__length += n
+
+    def peek(self):
+        """Return the buffered output, leaving it in the buffer"""
+        if self.limit is None:
+            return "".join(self.__chunks)
+        end = self.__start + self.__length
+        if end <= self.limit:
+            return str(self.__ring[self.__start:end])
+        return str(self.__ring[self.__start:]) + str(self.__ring[:end - self.limit])
+
+    def take(self):
+        """Return the buffered output and empty the buffer"""
+        data = self.peek()
+        if self.limit is None:
+            del self.__chunks[:]
+        else:
+            self.__start = 0
+            self.__length = 0
+        return data
+
+
 class Process(object):
     """Manager for an asynchronous process.
        The process will be run in the background, and its standard output
        and standard error will be collected asynchronously.
 
        Since the collection of output happens asynchronously (handled by
-       threads), the process won't block even if it outputs large amounts
+       a reactor), the process won't block even if it outputs large amounts
        of data and you do not call Process.read*().
 
        Similarly, it is possible to send data to the standard input of the
@@ -115,9 +218,33 @@ class Process(object):
        Process object won't collect that output, and the read*() methods
        will always return empty strings.  Also, setting stdin to something
        other than PIPE will make the write() method raise an exception.
+
+       The pipes of all processes are serviced by one Reactor: the one
+       given as keyword parameter 'reactor', or else a shared reactor
+       running in a single background thread. No threads are started
+       per process.
+
+       If the keyword parameter 'on_exit' is given, on_exit(process,
+       exitstatus) is called on the reactor's thread once the process
+       has ended and all its output has been collected. More callbacks
+       can be added with add_exit_callback().
+
+       For long-running, chatty processes the keyword parameter
+       'max_output' limits the output kept per pipe to that many bytes,
+       see OutputBuffer. With 'on_line', on_line(process, line,
+       from_stderr) is called on the reactor's thread for every line of
+       output as it arrives, so progress can be parsed without keeping
+       the output around. max_output=0 keeps no output at all.
     """
 
     def __init__(self, *params, **kwparams):
+        self.__reactor = kwparams.pop('reactor', None) or shared_reactor()
+        self.__exit_callbacks = []
+        on_exit = kwparams.pop('on_exit', None)
+        if on_exit:
+            self.__exit_callbacks.append(on_exit)
+        max_output = kwparams.pop('max_output', None)
+        self.__on_line = kwparams.pop('on_line', None)
         if len(params) <= 3:
             kwparams.setdefault('stdin', subprocess.PIPE)
         if len(params) <= 4:
@@ -125,37 +252,27 @@ class Process(object):
         if len(params) <= 5:
             kwparams.setdefault('stderr', subprocess.PIPE)
         self.__pending_input = []
-        self.__collected_outdata = []
-        self.__collected_errdata = []
+        self.__collected_outdata = OutputBuffer(max_output)
+        self.__collected_errdata = OutputBuffer(max_output)
+        # Incomplete last line of each pipe, for on_line
+        self.__partial_lines = {}
         self.__exitstatus = None
         self.__lock = threading.Lock()
-        self.__inputsem = threading.Semaphore(0)
-        # Flag telling feeder threads to quit
+        # Set once the process is reaped and its output collected
+        self.__finished = threading.Event()
+        # Flag telling the feeder to close stdin
         self.__quit = False
+        self.__sources = {}
+        self.__feeding = False
+        self.__exit_timer = None
+        self.__exit_poll = EXIT_POLL_MIN
 
         self.__process = subprocess.Popen(*params, **kwparams)
 
-        if self.__process.stdin:
-            self.__stdin_thread = threading.Thread(
-                name="stdin-thread",
-                target=self.__feeder, args=(self.__pending_input,
-                                            self.__process.stdin))
-            self.__stdin_thread.setDaemon(True)
-            self.__stdin_thread.start()
-        if self.__process.stdout:
-            self.__stdout_thread = threading.Thread(
-                name="stdout-thread",
-                target=self.__reader, args=(self.__collected_outdata,
-                                            self.__process.stdout))
-            self.__stdout_thread.setDaemon(True)
-            self.__stdout_thread.start()
-        if self.__process.stderr:
-            self.__stderr_thread = threading.Thread(
-                name="stderr-thread",
-                target=self.__reader, args=(self.__collected_errdata,
-                                            self.__process.stderr))
-            self.__stderr_thread.setDaemon(True)
-            self.__stderr_thread.start()
+        if self.__reactor.in_reactor_thread():
+            self.__start_reactor()
+        else:
+            self.__reactor.call_soon_threadsafe(self.__start_reactor)
 
     def __del__(self, __killer=os.kill, __sigkill=signal.SIGKILL):
         if self.__exitstatus is None:
@@ -180,6 +297,18 @@ class Process(object):
             raise OSError(errno.ECHILD, os.strerror(errno.ECHILD))
         os.kill(self.pid(), signal)
 
+    def add_exit_callback(self, callback):
+        """Call callback(process, exitstatus) on the reactor's thread once
+           the process has ended and all its output has been collected.
+           If that has already happened, the callback is called soon."""
+        self.__lock.acquire()
+        finished = self.__finished.isSet()
+        if not finished:
+            self.__exit_callbacks.append(callback)
+        self.__lock.release()
+        if finished:
+            self.__reactor.call_soon_threadsafe(callback, self, self.__exitstatus)
+
     def wait(self, flags=0):
         """Return the process' termination status.
 
@@ -191,7 +320,20 @@ class Process(object):
            has succeeded; the Process instance will remember the exit
            status from the first successful call, and return that on
            subsequent calls.
+
+           Only the reactor's thread reaps the process. Called from any
+           other thread, wait() waits for the reactor to notice that the
+           process has ended, so all its output is available once wait()
+           returns.
         """
+        if not self.__reactor.in_reactor_thread():
+            if flags & os.WNOHANG:
+                if self.__finished.isSet():
+                    return self.__exitstatus
+                return None
+            # No timeout: in Python 2 that would make wait() sleep-poll
+            self.__finished.wait()
+            return self.__exitstatus
         if self.__exitstatus is not None:
             return self.__exitstatus
         pid,exitstatus = os.waitpid(self.pid(), flags)
@@ -199,21 +341,7 @@ class Process(object):
             return None
         if os.WIFEXITED(exitstatus) or os.WIFSIGNALED(exitstatus):
             self.__exitstatus = exitstatus
-            # If the process has stopped, we have to make sure to stop
-            # our threads.  The reader threads will stop automatically
-            # (assuming the process hasn't forked), but the feeder thread
-            # must be signalled to stop.
-            if self.__process.stdin:
-                self.closeinput()
-            # We must wait for the reader threads to finish, so that we
-            # can guarantee that all the output from the subprocess is
-            # available to the .read*() methods.
-            # And by the way, it is the responsibility of the reader threads
-            # to close the pipes from the subprocess, not our.
-            if self.__process.stdout:
-                self.__stdout_thread.join()
-            if self.__process.stderr:
-                self.__stderr_thread.join()
+            self.__exited()
         return exitstatus
 
     def terminate(self, graceperiod=1):
@@ -226,60 +354,217 @@ class Process(object):
            terminate() waits up to GRACEPERIOD seconds (default 1) before
            escalating the level of force.  As there are three levels, a total
            of (3-1)*GRACEPERIOD is allowed before the process is SIGKILL:ed.
-           GRACEPERIOD must be an integer, and must be at least 1.
               If the process was started with stdin not set to PIPE, the
            first level (closing stdin) is skipped.
+              On the reactor's thread terminate() does not block: stdin is
+           closed and SIGTERM sent right away, SIGKILL follows after
+           GRACEPERIOD seconds if needed, and the process is reaped by
+           reactor timers. Returns None if the process has not ended yet.
         """
+        if self.__reactor.in_reactor_thread():
+            return self.__terminate_reactor(graceperiod)
+
         if self.__process.stdin:
             # This is rather meaningless when stdin != PIPE.
             self.closeinput()
-            try:
-                return with_timeout(graceperiod, self.wait)
-            except Timeout:
-                pass
+            if self.__finished.wait(graceperiod):
+                return self.__exitstatus
 
-        self.kill(signal.SIGTERM)
         try:
-            return with_timeout(graceperiod, self.wait)
-        except Timeout:
+            self.__kill_group(signal.SIGTERM)
+        except OSError:
             pass
+        if self.__finished.wait(graceperiod):
+            return self.__exitstatus
 
-        self.kill(signal.SIGKILL)
+        try:
+            self.__kill_group(signal.SIGKILL)
+        except OSError:
+            pass
         return self.wait()
 
-    def __reader(self, collector, source):
-        """Read data from source until EOF, adding it to collector.
-        """
+    def __terminate_reactor(self, graceperiod):
+        """Non-blocking terminate() for the reactor's thread"""
+        if self.__process.stdin:
+            self.closeinput()
+        exitstatus = self.wait(os.WNOHANG)
+        if exitstatus is not None:
+            return exitstatus
+        self.__kill_group(signal.SIGTERM)
+
+        def escalate():
+            if self.wait(os.WNOHANG) is None:
+                try:
+                    self.__kill_group(signal.SIGKILL)
+                except OSError:
+                    pass
+                # Reaped by the exit watch
+                self.__watch_exit(EXIT_POLL_MIN)
+
+        self.__reactor.call_later(graceperiod, escalate)
+        return None
+
+    def __kill_group(self, signal):
+        """Signal the process, and everything it started if it leads
+           its own process group (a shell running a pipeline)"""
+        pid = self.pid()
+        try:
+            is_leader = os.getpgid(pid) == pid
+        except OSError:
+            is_leader = False
+        if is_leader:
+            os.killpg(pid, signal)
+        else:
+            self.kill(signal)
+
+    def __start_reactor(self):
+        """Register the pipes of the process with the reactor and start
+           watching for its exit"""
+        for collector, source, from_stderr in ((self.__collected_outdata, self.__process.stdout, False),
+                                               (self.__collected_errdata, self.__process.stderr, True)):
+            if source:
+                set_nonblocking(source)
+                self.__sources[source.fileno()] = (collector, source, from_stderr)
+                self.__reactor.register(source, READ | ERROR, self.__on_readable)
+        if self.__process.stdin:
+            set_nonblocking(self.__process.stdin)
+        self.__watch_exit(EXIT_POLL_MIN)
+
+    def __watch_exit(self, delay=None):
+        """Poll for the exit of the process, backing off from
+           EXIT_POLL_MIN to EXIT_POLL_MAX seconds. Most processes are
+           caught right away when their pipes reach EOF."""
+        if self.__exit_timer:
+            self.__exit_timer.cancel()
+            self.__exit_timer = None
+        if self.wait(os.WNOHANG) is not None:
+            return
+        if delay is not None:
+            self.__exit_poll = delay
+        self.__exit_timer = self.__reactor.call_later(self.__exit_poll, self.__watch_exit)
+        self.__exit_poll = min(self.__exit_poll * 2, EXIT_POLL_MAX)
+
+    def __exited(self):
+        """The process has been reaped: collect the rest of its output
+           and tell whoever is waiting"""
+        if self.__exit_timer:
+            self.__exit_timer.cancel()
+            self.__exit_timer = None
+        if self.__process.stdin:
+            self.closeinput()
+        self.__drain()
+        self.__lock.acquire()
+        callbacks = self.__exit_callbacks
+        self.__exit_callbacks = []
+        self.__finished.set()
+        self.__lock.release()
+        for callback in callbacks:
+            callback(self, self.__exitstatus)
+
+    def __on_readable(self, fd, events):
+        """Reactor callback: collect output from the process"""
+        self.__read_available(fd)
+        if not self.__sources and self.__exitstatus is None:
+            # All output is in, the process is most likely gone
+            self.__watch_exit(EXIT_POLL_MIN)
+
+    def __read_available(self, fd):
+        """Read from a pipe until it would block. Closes it on EOF."""
+        collector, source, from_stderr = self.__sources[fd]
         while True:
-            data = os.read(source.fileno(), 65536)
+            try:
+                data = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                data = ""
+            if data == "":
+                self.__close_source(fd)
+                return
             self.__lock.acquire()
             collector.append(data)
             self.__lock.release()
-            if data == "":
-                source.close()
-                break
-        return
-
-    def __feeder(self, pending, drain):
-        """Feed data from the list pending to the file drain.
-        """
-        while True:
-            self.__inputsem.acquire()
-            self.__lock.acquire()
-            if not pending  and         self.__quit:
-                drain.close()
-                self.__lock.release()
-                break
-            data = pending.pop(0)
+            if self.__on_line:
+                self.__split_lines(fd, data, from_stderr)
+
+    def __close_source(self, fd):
+        """Stop reading a pipe, passing on its last incomplete line"""
+        self.__reactor.unregister(fd)
+        collector, source, from_stderr = self.__sources.pop(fd)
+        source.close()
+        partial = self.__partial_lines.pop(fd, "")
+        if partial:
+            self.__on_line(self, partial, from_stderr)
+
+    def __split_lines(self, fd, data, from_stderr):
+        """Pass complete lines of data on to the on_line callback and
+           keep the incomplete last line for later"""
+        lines = LINE_SEPARATORS.split(self.__partial_lines.get(fd, "") + data)
+        partial = lines.pop()
+        for line in lines:
+            if line:
+                self.__on_line(self, line, from_stderr)
+        while len(partial) > MAX_LINE_LENGTH:
+            self.__on_line(self, partial[:MAX_LINE_LENGTH], from_stderr)
+            partial = partial[MAX_LINE_LENGTH:]
+        self.__partial_lines[fd] = partial
+
+    def __drain(self):
+        """Collect the remaining output of a process that has exited.
+           A pipe still held open by a grandchild is closed anyway."""
+        for fd in self.__sources.keys():
+            self.__read_available(fd)
+            if fd in self.__sources:
+                self.__close_source(fd)
+
+    def __reactor_feed(self):
+        """Start feeding pending input through the reactor, or close
+           stdin when there is nothing left and closeinput() was called"""
+        stdin = self.__process.stdin
+        if stdin.closed or self.__feeding:
+            return
+        self.__lock.acquire()
+        pending = bool(self.__pending_input)
+        quit = self.__quit
+        self.__lock.release()
+        if pending:
+            self.__feeding = True
+            self.__reactor.register(stdin, WRITE | ERROR, self.__on_writable)
+        elif quit:
+            stdin.close()
+
+    def __on_writable(self, fd, events):
+        """Reactor callback: write pending input to the process"""
+        stdin = self.__process.stdin
+        self.__lock.acquire()
+        try:
+            while self.__pending_input:
+                data = self.__pending_input[0]
+                try:
+                    written = os.write(fd, data)
+                except OSError, e:
+                    if e.errno == errno.EAGAIN:
+                        return
+                    # Broken pipe, the process does not want any more
+                    del self.__pending_input[:]
+                    self.__quit = True
+                    break
+                if written < len(data):
+                    self.__pending_input[0] = data[written:]
+                    return
+                self.__pending_input.pop(0)
+        finally:
             self.__lock.release()
-            drain.write(data)
+        self.__reactor.unregister(fd)
+        self.__feeding = False
+        if self.__quit:
+            stdin.close()
 
     def read(self):
         """Read data written by the process to its standard output.
         """
         self.__lock.acquire()
-        outdata = "".join(self.__collected_outdata)
-        del self.__collected_outdata[:]
+        outdata = self.__collected_outdata.take()
         self.__lock.release()
         return outdata
 
@@ -287,8 +572,7 @@ class Process(object):
         """Read data written by the process to its standard error.
         """
         self.__lock.acquire()
-        errdata = "".join(self.__collected_errdata)
-        del self.__collected_errdata[:]
+        errdata = self.__collected_errdata.take()
         self.__lock.release()
         return errdata
 
@@ -300,17 +584,15 @@ class Process(object):
            future versions!
         """
         self.__lock.acquire()
-        outdata = "".join(self.__collected_outdata)
-        del self.__collected_outdata[:]
-        errdata = "".join(self.__collected_errdata)
-        del self.__collected_errdata[:]
+        outdata = self.__collected_outdata.take()
+        errdata = self.__collected_errdata.take()
         self.__lock.release()
         return outdata,errdata
 
     def _peek(self):
         self.__lock.acquire()
-        output = "".join(self.__collected_outdata)
-        error = "".join(self.__collected_errdata)
+        output = self.__collected_outdata.peek()
+        error = self.__collected_errdata.peek()
         self.__lock.release()
         return output,error
 
@@ -321,16 +603,17 @@ class Process(object):
             raise ValueError("Writing to process with stdin not a pipe")
         self.__lock.acquire()
         self.__pending_input.append(data)
-        self.__inputsem.release()
         self.__lock.release()
+        self.__reactor.call_soon_threadsafe(self.__reactor_feed)
 
     def closeinput(self):
         """Close the standard input of a process, so it receives EOF.
         """
         self.__lock.acquire()
         self.__quit = True
-        self.__inputsem.release()
         self.__lock.release()
+        if self.__process.stdin:
+            self.__reactor.call_soon_threadsafe(self.__reactor_feed)
 
 
 class ProcessManager(object):
@@ -342,21 +625,31 @@ class ProcessManager(object):
        made part of the asyncproc module in the first place.
     """
 
-    def __init__(self):
+    def __init__(self, reactor=None):
         self.__last_id = 0
         self.__procs = {}
+        # All processes share one reactor, the module's own by default
+        self.__reactor = reactor
 
-    def start(self, args, executable=None, shell=False, cwd=None, env=None):
+    def start(self, args, executable=None, shell=False, cwd=None, env=None,
+              on_exit=None):
         """Start a program in the background, collecting its output.
            Returns an integer identifying the process. (Note that this
            integer is *not* the OS process id of the actually running
-           process.)
+           process.) If given, on_exit(procid, exitstatus) is called on
+           the reactor's thread when the process has ended.
         """
-        proc = Process(args=args, executable=executable, shell=shell,
-                       cwd=cwd, env=env)
         self.__last_id += 1
-        self.__procs[self.__last_id] = proc
-        return self.__last_id
+        procid = self.__last_id
+        if on_exit:
+            callback = lambda process, exitstatus: on_exit(procid, exitstatus)
+        else:
+            callback = None
+        proc = Process(args=args, executable=executable, shell=shell,
+                       cwd=cwd, env=env, reactor=self.__reactor,
+                       on_exit=callback)
+        self.__procs[procid] = proc
+        return procid
 
     def kill(self, procid, signal):
         return self.__procs[procid].kill(signal)
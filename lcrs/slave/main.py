@@ -19,14 +19,15 @@
 # You should have received a copy of the GNU General Public License
 # along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
 
-import threading
 import socket
 import time
 import json
 import logging
+import errno
 import re
 import os
 import sys
+import collections
 from uuid import getnode as get_mac
 
 # create logger
@@ -40,6 +41,13 @@ logger.setLevel(logging.INFO)
 import settings
 import protocol
 from asyncproc import Process
+from wipeengine import WipeEngine
+from verifier import SectorVerifier, FullVerifier
+from reactor import Reactor, READ, WRITE, ERROR
+
+# WipeEngine options that a master may set in WIPE and RESUME. The
+# offset to start from is only given by RESUME.
+ENGINE_OPTIONS = ('block_size', 'direct', 'fsync_interval', 'verify')
 
 class RequestException(Exception):
     def __init__(self, value):
@@ -47,107 +55,432 @@ class RequestException(Exception):
     def __str__(self):
         return repr(self.parameter)
 
-class Slave():
+class Job():
+    """
+    A long-running command working on one device, such as a wipe or a
+    badblocks check. Jobs on different devices run at the same time.
+    """
+    
+    def __init__(self, kind, device, process=None, worker=None, progress=0.0):
+        self.kind = kind
+        self.device = device
+        self.process = process
+        # A worker thread, like WipeEngine, instead of a process
+        self.worker = worker
+        self.state = protocol.BUSY
+        # More than 0 for a job continuing where another one stopped
+        self.start_progress = progress
+        self.progress = progress
+        # When progress was last seen to change, by the slave's clock
+        self.progress_time = None
+        self.started_on = time.time()
+        self.done = False
+        self.fail_message = ""
+        # Bytes the job works through, if known
+        if worker:
+            self.__size = None
+        else:
+            self.__size = device_size(device) if device else None
+        # (time, progress) readings behind the current throughput
+        self.__readings = collections.deque([(self.started_on, progress)])
+    
+    @property
+    def size(self):
+        if self.worker:
+            # Workers know how big their device is once they have opened it
+            return getattr(self.worker, 'size', None)
+        return self.__size
+    
+    def set_progress(self, progress):
+        """Record a progress reading. Returns False if it is no news."""
+        if progress == self.progress:
+            return False
+        self.progress = progress
+        self.progress_time = time.time()
+        self.__readings.append((self.progress_time, progress))
+        return True
+    
+    def rates(self):
+        """Bytes done, the throughput in bytes per second over the last
+           RATE_WINDOW seconds and since the start, and the estimated
+           seconds left. Without a size only the ETA is known."""
+        busy = self.state == protocol.BUSY
+        now = time.time() if busy else (self.progress_time or self.started_on)
+        readings = self.__readings
+        while len(readings) > 2 and readings[1][0] <= now - settings.RATE_WINDOW:
+            readings.popleft()
+        first_time, first = readings[0]
+        last_time, last = readings[-1]
+        # A drive that has not moved for longer than it took to make the
+        # last progress slows the current rate down
+        duration = max(last_time - first_time, now - last_time)
+        current = (last - first) / duration if busy and duration > 0 else None
+        if now > self.started_on:
+            average = (self.progress - self.start_progress) / (now - self.started_on)
+        else:
+            average = None
+        if busy:
+            eta = (1.0 - self.progress) / current if current else None
+        else:
+            eta = 0.0 if self.done else None
+        size = self.size
+        def scale(rate):
+            return rate * size if size and not rate is None else None
+        return {'started_on': self.started_on,
+                'size': size,
+                'bytes_done': scale(self.progress),
+                'throughput': scale(current),
+                'avg_throughput': scale(average),
+                'eta': eta}
+    
+    def as_dict(self):
+        job = {'kind': self.kind,
+               'state': self.state,
+               'progress': self.progress,
+               'progress_time': self.progress_time,
+               'done': self.done,
+               'fail_message': self.fail_message}
+        if self.worker:
+            job.update(self.worker.status())
+        # The job's throughput over RATE_WINDOW replaces the worker's own
+        job.update(self.rates())
+        return job
+
+class Client():
+    """
+    A connection from the master, serviced by the slave's reactor.
+    It starts out in the one-shot protocol: one request, one reply and
+    the connection is closed. If the master asks for an upgrade, the
+    connection stays open and carries frames.
+    """
+    
+    def __init__(self, slave, client_socket, address):
+        self.slave = slave
+        self.reactor = slave.reactor
+        self.socket = client_socket
+        self.address = address
+        self.framed = False
+        self.decoder = None
+        self.closed = False
+        self.last_activity = time.time()
+        self.__inbuf = ""
+        self.__outbuf = []
+        self.__outbuf_offset = 0
+        self.__close_when_flushed = False
+        self.socket.setblocking(0)
+        self.reactor.register(self.socket, READ | ERROR, self.on_event)
+    
+    def on_event(self, fd, events):
+        if events & WRITE:
+            self.__flush()
+        if events & (READ | ERROR) and not self.closed:
+            self.__receive()
+    
+    def __receive(self):
+        try:
+            raw_data = self.socket.recv(protocol.RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            logger.warning("Error in connection: %s." % str(e))
+            self.close()
+            return
+        if not raw_data:
+            self.close()
+            return
+        self.last_activity = time.time()
+        if self.framed:
+            self.__receive_frames(raw_data)
+        else:
+            self.__receive_one_shot(raw_data)
+    
+    def __receive_one_shot(self, raw_data):
+        self.__inbuf = self.__inbuf + raw_data
+        try:
+            command, data = self.slave.parse_request(self.__inbuf)
+        except RequestException, error_msg:
+            if len(self.__inbuf) < settings.MAX_PACKET_SIZE:
+                # Probably not everything has arrived yet
+                return
+            self.reply_one_shot(self.slave.request_failed(error_msg))
+            return
+        self.__inbuf = ""
+        if self.slave.is_upgrade_request(command, data):
+            logger.debug("Client switched to protocol version %d." % protocol.PROTOCOL_VERSION)
+            self.framed = True
+            self.decoder = protocol.FrameDecoder()
+            self.send_frame(None, [self.slave.state, self.slave.status(data)])
+            return
+        self.reply_one_shot(self.slave.handle_request(command, data))
+    
+    def __receive_frames(self, raw_data):
+        try:
+            messages = self.decoder.feed(raw_data)
+        except ValueError, e:
+            logger.warning("Received an illegal frame, closing connection: %s" % str(e))
+            self.close()
+            return
+        for message in messages:
+            try:
+                request_id, command, data = message
+            except (TypeError, ValueError):
+                logger.warning("Frame must be of type (request_id, command, data), got: %s" % str(message))
+                self.close()
+                return
+            self.send_frame(request_id, self.slave.handle_request(command, data, self, request_id))
+    
+    def reply_one_shot(self, reply):
+        self.__close_when_flushed = True
+        self.send(json.dumps(reply))
     
-    def __init__(self):
+    def send_frame(self, request_id, reply):
+        self.send(protocol.pack_frame([request_id] + list(reply)))
+    
+    def send(self, data):
+        if self.closed:
+            return
+        self.__outbuf.append(data)
+        if len(self.__outbuf) == 1:
+            self.__flush()
+    
+    def __flush(self):
+        """Send as much as the socket takes without blocking"""
+        while self.__outbuf:
+            data = self.__outbuf[0]
+            try:
+                sent = self.socket.send(buffer(data, self.__outbuf_offset))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    break
+                logger.warning("Could not send response. Socket died. %s" % str(e))
+                self.close()
+                return
+            self.__outbuf_offset += sent
+            if self.__outbuf_offset < len(data):
+                break
+            self.__outbuf.pop(0)
+            self.__outbuf_offset = 0
+        if self.__outbuf:
+            self.reactor.modify(self.socket, READ | WRITE | ERROR)
+            return
+        if self.__close_when_flushed:
+            self.close()
+            return
+        self.reactor.modify(self.socket, READ | ERROR)
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.slave.unsubscribe(self)
+        self.reactor.unregister(self.socket)
+        self.socket.close()
+        if self in self.slave.clients:
+            self.slave.clients.remove(self)
+
+class Slave(object):
+    
+    def __init__(self, listen_port=settings.LISTEN_PORT):
         self.socket = None
-        self.state = protocol.IDLE
+        self.reactor = Reactor()
+        self.clients = []
+        # (client, request_id) of connections that asked for events
+        self.subscribers = []
+        self.__event_seq = 0
+        self.__state = protocol.IDLE
         self.__progress = 0.0
+        self.__progress_time = None
+        # Pending publish of progress changes, see __publish_progress()
+        self.__progress_timer = None
         self.shell_exec_cnt = 0
         self.shell_exec_results = {}
-        
-        self.thread = threading.Thread (target = self.listen,)
-        self.thread.setDaemon(True)
-        self.thread.start()
+        self.scan_results = {}
+        self.__scan_queue = []
+        self.__scan_running = 0
+        # Jobs started with a device name, keyed by device
+        self.jobs = {}
+        # IDs of SHELL_EXEC commands that have not finished
+        self.__shell_exec_running = []
         
         self.__wipe_done = False
         self.__badblocks_done = False
         
-        self.signal_mainthread_killall = False
         self.processes = []
         
         self.__fail_message = ""
         self.__wipe_output = None
-        
-        self.__active = True
+        # Old style job running without a device name
+        self.__legacy_job = None
         
         self.uuid = str(get_mac())
+        # What the master knows about this computer (ID, hardware,
+        # wipe) so a restarted master can pick up where it was
+        self.__master_info = None
         
+        self.listen(listen_port)
+    
+    def __get_state(self):
+        # Device jobs keep the slave busy without blocking each other
+        if self.__state == protocol.IDLE and self.__jobs_running():
+            return protocol.BUSY
+        return self.__state
+    
+    def __set_state(self, state):
+        previous = self.state
+        self.__state = state
+        if self.state != previous:
+            self.publish('state')
+    
+    state = property(__get_state, __set_state)
+    
+    def __get_progress(self):
+        return self.__progress
+    
+    def __set_progress(self, progress):
+        changed = progress != self.__progress
+        self.__progress = progress
+        if changed:
+            self.publish('progress')
+    
+    progress = property(__get_progress, __set_progress)
+    
+    def run(self):
+        """Serve clients and child processes until stop() is called"""
+        self.reactor.call_later(settings.CLIENT_SWEEP_INTERVAL, self.__sweep_clients)
+        self.reactor.call_later(settings.HEARTBEAT_INTERVAL, self.__heartbeat)
+        self.reactor.run()
+    
     def stop(self):
-        self.__active = False
+        for client in list(self.clients):
+            client.close()
+        if self.socket:
+            self.reactor.unregister(self.socket)
+            self.socket.close()
+            self.socket = None
+        self.reactor.stop()
     
     def listen(self, listen_port=settings.LISTEN_PORT):
         """
-        Read messages from clients. If the client closes its
-        connection, start from scratch.
+        Accept connections from clients through the reactor.
         """
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-        self.socket.settimeout(2)
+        self.socket.setblocking(0)
         self.socket.bind ( ('', listen_port) )
-        self.socket.listen(10)
+        self.socket.listen(128)
+        self.reactor.register(self.socket, READ, self.__on_accept)
         
         logger.info("Now listening on TCP port %d" % (listen_port))
-        
-        while self.__active:
+    
+    def __on_accept(self, fd, events):
+        while True:
             try:
                 client_socket, address = self.socket.accept()
-                logger.debug("Received connection from %s." % str(address))
-                t = threading.Thread(target=self.__client_thread, args=(client_socket,))
-                t.setDaemon(True)
-                t.start()
-            except socket.timeout:
-                continue
-                    
-        self.socket.close()
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                    logger.warning("Error accepting connection: %s" % str(e))
+                return
+            logger.debug("Received connection from %s." % str(address))
+            self.clients.append(Client(self, client_socket, address))
     
-    def __client_thread(self, client_socket):
-        while self.__active:
-            try:
-                client_socket.settimeout(settings.CLIENT_TIMEOUT)
-                raw_data = client_socket.recv(settings.MAX_PACKET_SIZE)
-                break
-            except socket.timeout:
-                logger.warning("Client timed out.")
+    def __sweep_clients(self):
+        """Drop connections that have been silent for too long. A
+           subscribed master stops polling and only listens, so those
+           connections are kept; heartbeats find out if they are dead."""
+        now = time.time()
+        subscribed = [c for (c, __) in self.subscribers]
+        for client in list(self.clients):
+            if client in subscribed:
                 continue
-            except socket.error, (__, errmsg):
-                logger.warning("Error in connection: %s." % str(errmsg))
-                break
-        
-        if not self.__active:
-            client_socket.close()
+            if now - client.last_activity > settings.CLIENT_TIMEOUT:
+                logger.warning("Client timed out.")
+                client.close()
+        self.reactor.call_later(settings.CLIENT_SWEEP_INTERVAL, self.__sweep_clients)
+    
+    def __heartbeat(self):
+        """Let subscribers know that we are still here"""
+        if self.subscribers:
+            self.publish('heartbeat')
+        self.reactor.call_later(settings.HEARTBEAT_INTERVAL, self.__heartbeat)
+    
+    def publish(self, event):
+        """Push the current status to all subscribers. Every event
+           carries a sequence number so the master can detect gaps."""
+        self.__event_seq += 1
+        if not self.subscribers:
             return
-
-        if raw_data:
-            try:
-                data = self.process_request(raw_data)
-                self.send_reply(client_socket, data)
-            except RequestException, error_msg:
-                logger.warning("Request exception: %s" % error_msg)
-                self.state = protocol.FAIL
-                self.send_reply(client_socket, str(error_msg))
-            except socket.timeout:
-                logger.error("Connection timeout sending reply.")
-            except socket.error, (__, errmsg):
-                logger.error("Error in socet while sending reply: %s." % str(errmsg))
-            except:
-                # A non-socket exception... try to send back the exception
-                self.state = protocol.FAIL
-                self.send_reply(client_socket, "Error in slave: %s" % sys.exc_info()[0])
-                raise
-            client_socket.close()
-        
+        data = self.__status()
+        data['event'] = event
+        for client, request_id in list(self.subscribers):
+            client.send_frame(request_id, [self.state, data])
     
-    def process_request(self, raw_data):
-        """
-        Process some JSON data received from the socket
-        Should be blocking!
-        """
+    def subscribe(self, data, client=None, request_id=None):
+        """Stream state and progress events to the client. Events are
+           replies to the SUBSCRIBE request, i.e. they carry its ID."""
+        logger.info("Received SUBSCRIBE command.")
+        if client is None or not client.framed:
+            raise RequestException("SUBSCRIBE requires protocol version %d." % protocol.PROTOCOL_VERSION)
+        if not (client, request_id) in self.subscribers:
+            self.subscribers.append((client, request_id))
+        return self.__status()
+    
+    def unsubscribe(self, client):
+        self.subscribers = [(c, r) for (c, r) in self.subscribers if c != client]
+    
+    def watch_stdin(self):
+        """Let the operator quit the slave by typing q"""
+        try:
+            self.reactor.register(sys.stdin, READ | ERROR, self.__on_stdin)
+        except (IOError, OSError):
+            logger.debug("Standard input cannot be watched, not accepting commands from it.")
+    
+    def __on_stdin(self, fd, events):
+        s = os.read(fd, 1024)
+        if not s:
+            self.reactor.unregister(fd)
+            return
+        if s.strip() == 'q':
+            print "Cleaning up..."
+            kill_slave_processes(self)
+            self.stop()
+    
+    def is_upgrade_request(self, command, data):
+        """A master asks for framed replies on a persistent connection
+           by sending STATUS with the protocol version it speaks"""
+        return (command == protocol.STATUS and type(data) == dict and
+                data.get('upgrade', 0) >= protocol.PROTOCOL_VERSION)
+    
+    def parse_request(self, raw_data):
+        """Parse a one-shot JSON request"""
         try:
             command, data = json.loads(raw_data)
         except ValueError:
             raise RequestException("Illegal JSON data - must be of type (command, data), got: %s" % str(raw_data))
-        
+        return command, data
+    
+    def handle_request(self, command, data, client=None, request_id=None):
+        """Process a request and return the reply as [state, data]"""
+        try:
+            data = self.process_request(command, data, client, request_id)
+        except RequestException, error_msg:
+            return self.request_failed(error_msg)
+        except Exception:
+            # A non-socket exception... try to send back the exception
+            logger.exception("Error processing request")
+            self.state = protocol.FAIL
+            data = "Error in slave: %s" % sys.exc_info()[0]
+        return [self.state, data]
+    
+    def request_failed(self, error_msg):
+        logger.warning("Request exception: %s" % error_msg)
+        self.state = protocol.FAIL
+        return [self.state, str(error_msg)]
+    
+    def process_request(self, command, data, client=None, request_id=None):
+        """
+        Process a request received from the socket
+        Should not block, it runs on the reactor!
+        """
         if command == protocol.SCAN:
             return self.scan(data)
         if command == protocol.WIPE:
@@ -166,22 +499,73 @@ class Slave():
             return self.reset(data)
         if command == protocol.DEBUG_MODE:
             return self.debug_mode(data)
+        if command == protocol.SUBSCRIBE:
+            return self.subscribe(data, client, request_id)
+        if command == protocol.VERIFY:
+            return self.verify(data)
+        if command == protocol.RESUME:
+            return self.resume(data)
+        if command == protocol.MASTER_INFO:
+            return self.master_info(data)
         
         raise RequestException("Received unknown command ID: %s" % str(command))
-        
-    def send_reply(self, client_socket, data=None):
-        try:
-            client_socket.sendall(json.dumps([self.state, data]))
-        except socket.timeout:
-            logger.warning("Could not send response. Socket timeout.")
-        except socket.error, (__, e_str):
-            logger.warning("Could not send response. Socket died. %s" % str(e_str))
+    
+    def spawn(self, command, max_output=None, on_line=None):
+        """Start a shell command with its output collected by the reactor.
+           Our sockets are not passed on to the child, and it gets its
+           own process group so a timeout can kill the whole pipeline.
+           See asyncproc.Process for max_output and on_line."""
+        process = Process(command, shell=True, close_fds=True, preexec_fn=os.setpgrp,
+                          reactor=self.reactor, max_output=max_output, on_line=on_line)
+        self.processes.append(process)
+        return process
+    
+    def monitor(self, process, on_exit, on_tick=None, interval=settings.POLL_INTERVAL,
+                timeout=None, on_timeout=None):
+        """Calls on_exit(exitcode) as soon as a process has ended and its
+           output is collected, and on_tick() every interval seconds
+           while it is running. If timeout is given, a process still
+           running after that many seconds is terminated and
+           on_timeout() is called instead.
+           Processes killed by RESET are dropped silently."""
+        timers = {}
+        def exited(process, exitcode):
+            for timer in timers.values():
+                timer.cancel()
+            if not process in self.processes:
+                return
+            self.processes.remove(process)
+            on_exit(exitcode)
+        def tick():
+            if not process in self.processes:
+                return
+            on_tick()
+            timers['tick'] = self.reactor.call_later(interval, tick)
+        def timed_out():
+            if not process in self.processes:
+                return
+            self.processes.remove(process)
+            try:
+                process.terminate()
+            except OSError:
+                pass
+            on_timeout() if on_timeout else ()
+        if on_tick:
+            timers['tick'] = self.reactor.call_later(interval, tick)
+        if timeout:
+            timers['timeout'] = self.reactor.call_later(timeout, timed_out)
+        process.add_exit_callback(exited)
     
     def scan(self, data):
-        """ Takes a list of strings to execute in a separate thread.
-            Executes all the commands in the same order as they are listed.
-            The thread function stores all output in a dictionary with the original
-            command as key.
+        """ Takes a list of strings to execute, or a dictionary
+            {'commands': [...], 'workers': n, 'timeout': t,
+             'timeouts': {command: t}} where n is the number of commands
+            to run at the same time (default SCAN_WORKERS) and t is the
+            number of seconds a command may run before it is killed
+            (default SCAN_TIMEOUT, per command in 'timeouts').
+            All output is stored in a dictionary with the original
+            command as key, and progress is the fraction of commands
+            completed.
             Non-blocking!
             Use HARDWARE command to retrieve the list of data.
         """
@@ -189,7 +573,20 @@ class Slave():
         if self.state == protocol.BUSY:
             raise RequestException("Cannot execute SCAN - current state is BUSY.")
         
-        self.state = protocol.BUSY
+        workers = settings.SCAN_WORKERS
+        timeout = settings.SCAN_TIMEOUT
+        timeouts = {}
+        if type(data) == dict:
+            try:
+                workers = int(data.get('workers', workers))
+            except (TypeError, ValueError):
+                raise RequestException("SCAN takes an integer number of workers. Got: %s" % str(data.get('workers')))
+            try:
+                timeout = parse_timeout(data.get('timeout', timeout))
+                timeouts = dict((c, parse_timeout(t)) for c, t in data.get('timeouts', {}).items())
+            except (AttributeError, TypeError, ValueError):
+                raise RequestException("SCAN takes timeouts in seconds. Got: %s" % str(data))
+            data = data.get('commands', None)
         
         # Check list...
         try:
@@ -199,58 +596,140 @@ class Slave():
         except TypeError:
             raise RequestException("SCAN takes a list of strings as input (shell commands to execute). Got: %s" % str(data))
         
+        self.state = protocol.BUSY
         self.scan_results = {}
-        
-        t = threading.Thread(target=self.__scan_thread, args=(data,))
-        t.setDaemon(True)
-        t.start()
+        self.__scan_queue = list(data)
+        self.__scan_total = float(len(data))
+        self.__scan_workers = max(1, workers)
+        self.__scan_timeout = timeout
+        self.__scan_timeouts = timeouts
+        self.__scan_running = 0
+        self.__scan_completed = 0
+        self.progress = 0.0
+        self.__scan_next()
         
         return None
+    
+    def __scan_next(self):
+        # Keep up to __scan_workers commands from the queue running
+        while self.__scan_queue and self.__scan_running < self.__scan_workers:
+            command = self.__scan_queue.pop(0)
+            logger.info("SCAN executing command: %s" % command)
+            try:
+                process = self.spawn(command)
+            except OSError:
+                self.scan_results[command] = ("", "Command does not exist")
+                self.__scan_completed += 1
+                continue
+            self.__scan_running += 1
+            timeout = self.__scan_timeouts.get(command, self.__scan_timeout)
+            self.monitor(process, lambda exitcode, process=process, command=command:
+                                      self.__scan_command_done(process, command),
+                         timeout=timeout,
+                         on_timeout=lambda process=process, command=command, timeout=timeout:
+                                        self.__scan_command_timeout(process, command, timeout))
+        
+        if self.__scan_total:
+            self.progress = self.__scan_completed / self.__scan_total
+            logger.debug("Progress: %.2f" % self.progress)
+        
+        if not self.__scan_queue and not self.__scan_running:
+            self.state = protocol.IDLE
+    
+    def __scan_command_done(self, process, command):
+        self.scan_results[command] = (process.read(), process.readerr())
+        self.__scan_running -= 1
+        self.__scan_completed += 1
+        self.__scan_next()
+    
+    def __scan_command_timeout(self, process, command, timeout):
+        # Keep whatever the command managed to output
+        logger.warning("SCAN command timed out after %.1f seconds: %s" % (timeout, command))
+        self.scan_results[command] = (process.read(),
+                                      process.readerr() + "Timed out after %.1f seconds" % timeout)
+        self.__scan_running -= 1
+        self.__scan_completed += 1
+        self.__scan_next()
         
     def wipe(self, data):
+        """ Takes a shell command wiping a drive, or a dictionary
+            {'command': ..., 'device': 'sda'} to run it as a job on that
+            device next to jobs on other devices.
+            With {'engine': {...}, 'device': 'sda'} the drive is wiped by
+            the native WipeEngine, and the engine dictionary holds its
+            options (block_size, direct, fsync_interval, verify).
+        """
         logger.info("Received WIPE command.")
-        if self.state == protocol.BUSY:
-            raise RequestException("Cannot execute WIPE - current state is BUSY.")
-        self.state = protocol.BUSY
-        self.__wipe_done = False
-        self.__progress = 0.0
-        
-        t = threading.Thread(target=self.__wipe_thread, args=(data,))
-        t.setDaemon(True)
-        t.start()
-
-        return None
+        if type(data) == dict and 'engine' in data:
+            return self.__start_engine('WIPE', data.get('device', None), data['engine'])
+        return self.__start_job('wipe', data, re.compile(r"(\d+)%"),
+                                from_stderr=False, fail_text="Failed while wiping.")
     
-    def __wipe_thread(self, command):
-        process = Process(command, shell=True)
-        self.processes.append(process)
-        re_pct = re.compile(r"(\d+)%", re.M)
-        while True:
-            # check to see if process has ended
-            poll_exitcode = process.wait(os.WNOHANG)
-            if poll_exitcode != None:
-                break
-            # print any new output
-            stdout = process.read()
-            m = re_pct.search(stdout)
-            if m:
-                pct = int(m.group(1))
-                self.__progress = pct / 100.0
-                logger.info("Wipe progress: %d%%" % (self.__progress*100))
-            # Wait another 2 seconds before polling
-            time.sleep(2.0)
-
-        stderr = process.readerr()
-        if poll_exitcode > 0:
-            self.state = protocol.FAIL
-            self.__fail_message = ("Failed while wiping. Return code: %d, Stderr was: %s" % 
-                                   (poll_exitcode, stderr))
-            logger.error(self.__fail_message)
-            return
-        self.__wipe_done = True
-        self.__progress = 1.0
-        logger.info("Wipe finished.")
-        self.state = protocol.IDLE
+    def resume(self, data):
+        """ Takes a dictionary {'device': 'sda', 'offset': n,
+            'engine': {...}} and continues a native wipe of the device
+            from byte n, which should be the checkpoint reported by an
+            earlier WIPE of the same drive. Engine options are those of
+            WIPE.
+        """
+        logger.info("Received RESUME command.")
+        if not type(data) == dict:
+            raise RequestException("RESUME takes a dictionary. Got: %s" % str(data))
+        try:
+            offset = int(data.get('offset', 0))
+        except (TypeError, ValueError):
+            raise RequestException("RESUME takes an offset in bytes. Got: %s" % str(data.get('offset')))
+        return self.__start_engine('RESUME', data.get('device', None), data.get('engine', {}), offset)
+    
+    def __start_engine(self, name, device, options, start_offset=0):
+        """Wipe a device with the native WipeEngine"""
+        if not device:
+            raise RequestException("%s with the native engine takes a device name. Got: %s" % (name, str(device)))
+        if not type(options) == dict:
+            raise RequestException("%s takes a dictionary of engine options. Got: %s" % (name, str(options)))
+        unknown = [k for k in options.keys() if not k in ENGINE_OPTIONS]
+        if unknown:
+            raise RequestException("%s got unknown engine options: %s" % (name, ", ".join(map(str, unknown))))
+        self.__check_device_free(name, device)
+        options = dict((str(k), v) for k, v in options.items())
+        try:
+            engine = WipeEngine("/dev/%s" % device, start_offset=start_offset, **options)
+        except (TypeError, ValueError), e:
+            raise RequestException("Illegal engine options %s: %s" % (str(options), str(e)))
+        progress = 0.0
+        size = device_size(device)
+        if engine.start_offset and size:
+            progress = min(1.0, float(engine.start_offset) / size)
+            logger.info("Resuming wipe of %s at byte %d" % (device, engine.start_offset))
+        return self.__start_worker_job('wipe', device, engine, progress)
+    
+    def verify(self, data):
+        """ Takes a dictionary {'device': 'sda', 'sectors': n,
+            'pattern': byte} and reads n random sectors of the device
+            (default VERIFY_SECTORS) as a job, comparing them with the
+            pattern byte (default 0). The job's status holds a summary
+            and the offsets of sectors that did not match.
+            With {'device': 'sda', 'full': True} the whole device is
+            read and checked for zeros, optionally with 'block_size'
+            and 'direct' like the wipe engine.
+        """
+        logger.info("Received VERIFY command.")
+        if not type(data) == dict or not data.get('device', None):
+            raise RequestException("VERIFY takes a dictionary with a device name. Got: %s" % str(data))
+        device = data['device']
+        self.__check_device_free('VERIFY', device)
+        try:
+            if data.get('full', False):
+                verifier = FullVerifier("/dev/%s" % device,
+                                        int(data.get('block_size', settings.WIPE_BLOCK_SIZE)),
+                                        data.get('direct', settings.WIPE_DIRECT))
+            else:
+                verifier = SectorVerifier("/dev/%s" % device,
+                                          int(data.get('sectors', settings.VERIFY_SECTORS)),
+                                          int(data.get('pattern', 0)))
+        except (TypeError, ValueError), e:
+            raise RequestException("Illegal VERIFY options %s: %s" % (str(data), str(e)))
+        return self.__start_worker_job('verify', device, verifier)
     
     def debug_mode(self, data):
         logger.setLevel(logging.DEBUG)
@@ -258,79 +737,211 @@ class Slave():
         return None
     
     def badblocks(self, data):
+        """ Takes a badblocks shell command, or a dictionary like WIPE"""
         logger.info("Received BADBLOCKS command.")
-        if self.state == protocol.BUSY:
-            raise RequestException("Cannot execute BADBLOCKS - current state is BUSY.")
-        self.state = protocol.BUSY
-        self.__badblocks_done = False
-        self.__progress = 0.0
+        # Search stderr - yes, actually stderr is the pipe that badblocks
+        # uses :(
+        return self.__start_job('badblocks', data, re.compile(r"(\d+\.\d+)%"),
+                                from_stderr=True, fail_text="Failed executing badblocks.")
+    
+    def __start_job(self, kind, data, re_pct, from_stderr, fail_text):
+        name = kind.upper()
+        device = None
+        if type(data) == dict:
+            device = data.get('device', None)
+            data = data.get('command', None)
+            if not device:
+                raise RequestException("%s takes a device name. Got: %s" % (name, str(device)))
+        if not type(data) == str and not type(data) == unicode:
+            raise RequestException("%s takes a shell command as input. Got: %s" % (name, str(data)))
+        
+        if device is None:
+            if self.state == protocol.BUSY:
+                raise RequestException("Cannot execute %s - current state is BUSY." % name)
+        else:
+            self.__check_device_free(name, device)
+        
+        def on_line(process, line, stderr):
+            # Parse progress as it arrives, the latest percentage wins
+            if stderr != from_stderr or not process in self.processes:
+                return
+            percentages = re_pct.findall(line)
+            if percentages:
+                self.__job_progress(job, float(percentages[-1]) / 100.0)
+        
+        # Hours of verbose output would otherwise pile up in memory
+        process = self.spawn(data, max_output=settings.JOB_OUTPUT_LIMIT, on_line=on_line)
+        job = Job(kind, device, process=process)
+        if device is None:
+            # Old style job, reported through the slave's own state
+            if kind == 'wipe':
+                self.__wipe_done = False
+            else:
+                self.__badblocks_done = False
+            self.progress = 0.0
+            self.__progress_time = None
+            self.__legacy_job = job
+            self.state = protocol.BUSY
+        else:
+            self.jobs[device] = job
+            self.publish('job')
+        
+        def job_done(exitcode):
+            stderr = process.readerr()
+            if exitcode > 0:
+                self.__job_failed(job, "%s Return code: %d, Stderr was: %s" %
+                                       (fail_text, exitcode, stderr))
+                return
+            self.__job_finished(job)
+        
+        self.monitor(process, job_done)
         
-        t = threading.Thread(target=self.__badblocks_thread, args=(data,))
-        t.setDaemon(True)
-        t.start()
-
         return None
     
-    def __badblocks_thread(self, command):
-        process = Process(command, shell=True)
-        self.processes.append(process)
-        re_pct = re.compile(r"(\d+)\.\d+%", re.M)
-        while True:
-            # check to see if process has ended
-            poll_exitcode = process.wait(os.WNOHANG)
-            if poll_exitcode != None:
-                break
-            # Search stderr - yes, actually stderr is the pipe that badblocks
-            # uses :(
-            stderr = process.readerr()
-            m = re_pct.search(stderr)
-            if m:
-                pct = int(m.group(1))
-                self.__progress = pct / 100.0
-                logger.info("Badblocks progress: %d%%" % (self.__progress * 100))
-            else:
-                logger.debug("Could not understand badblocks output: %s" % stderr)
-            # Wait another 2 seconds before polling
-            time.sleep(2.0)
-
-        stderr = process.readerr()
-        if poll_exitcode > 0:
-            self.state = protocol.FAIL
-            self.__fail_message = ("Failed executing badblocks. Return code: %d, Stderr was: %s" % 
-                                   (poll_exitcode, stderr))
-            logger.error(self.__fail_message)
+    def __start_worker_job(self, kind, device, worker, progress=0.0):
+        """Run a worker thread as a job on device, starting out at
+           progress. The worker is sampled for progress and reports back
+           when it is finished."""
+        job = Job(kind, device, worker=worker, progress=progress)
+        worker.on_finished = lambda worker: self.reactor.call_soon_threadsafe(self.__worker_done, job)
+        self.jobs[device] = job
+        self.publish('job')
+        worker.start()
+        
+        def sample_progress():
+            if job.state != protocol.BUSY:
+                return
+            self.__job_progress(job, worker.progress)
+            self.reactor.call_later(settings.POLL_INTERVAL, sample_progress)
+        
+        self.reactor.call_later(settings.POLL_INTERVAL, sample_progress)
+        return None
+    
+    def __worker_done(self, job):
+        if self.jobs.get(job.device, None) is not job:
+            # Dropped by RESET
             return
-        self.__progress = 1.0
-        logger.info("Badblocks finished.")
-        self.__badblocks_done = True
-        self.state = protocol.IDLE
+        failure = job.worker.failure()
+        if failure:
+            self.__job_failed(job, failure)
+            return
+        self.__job_finished(job)
+    
+    def __check_device_free(self, name, device):
+        if self.__exclusive_busy():
+            raise RequestException("Cannot execute %s - current state is BUSY." % name)
+        job = self.jobs.get(device, None)
+        if job and job.state == protocol.BUSY:
+            raise RequestException("Cannot execute %s - %s is busy with %s." % (name, device, job.kind))
+    
+    def __jobs_running(self):
+        for job in self.jobs.values():
+            if job.state == protocol.BUSY:
+                return True
+        return False
+    
+    def __exclusive_busy(self):
+        """BUSY with a SCAN or an old style job, which cannot share the
+           slave with anything else"""
+        return self.__state == protocol.BUSY and not self.__shell_exec_running
+    
+    def __job_progress(self, job, progress):
+        if not job.set_progress(progress):
+            return
+        logger.debug("%s progress: %.2f%%" % (job.kind.capitalize(), progress * 100))
+        if job.device is None:
+            self.__progress = progress
+            self.__progress_time = job.progress_time
+        self.__publish_progress()
+    
+    def __publish_progress(self):
+        """Publish a progress event with the newest values, at most every
+           PROGRESS_PUBLISH_INTERVAL however fast the readings come in"""
+        if self.__progress_timer is None:
+            self.__progress_timer = self.reactor.call_later(settings.PROGRESS_PUBLISH_INTERVAL,
+                                                            self.__progress_due)
+    
+    def __progress_due(self):
+        self.__progress_timer = None
+        self.publish('progress')
+    
+    def __job_failed(self, job, fail_message):
+        logger.error(fail_message)
+        job.state = protocol.FAIL
+        job.fail_message = fail_message
+        if job.device is None:
+            self.__fail_message = fail_message
+            self.state = protocol.FAIL
+        else:
+            self.publish('job')
+    
+    def __job_finished(self, job):
+        logger.info("%s finished%s." % (job.kind.capitalize(),
+                                        " on %s" % job.device if job.device else ""))
+        job.set_progress(1.0)
+        job.done = True
+        job.state = protocol.IDLE
+        if job.device is None:
+            if job.kind == 'wipe':
+                self.__wipe_done = True
+            else:
+                self.__badblocks_done = True
+            self.__progress_time = job.progress_time
+            self.progress = 1.0
+            self.state = protocol.IDLE
+        else:
+            self.publish('job')
 
     def shell_exec(self, data):
+        """ Takes a shell command, or a dictionary {'command': ...,
+            'timeout': t} where t is the number of seconds the command
+            may run before it is killed (default SHELL_EXEC_TIMEOUT).
+            Returns an ID for fetching the output with SHELL_RESULTS.
+        """
         logger.info("Received SHELL_EXEC command.")
-        if self.state == protocol.BUSY:
+        if self.__exclusive_busy():
             raise RequestException("Cannot execute SHELL_EXEC - current state is BUSY.")
         
-        self.state = protocol.BUSY
+        timeout = settings.SHELL_EXEC_TIMEOUT
+        if type(data) == dict:
+            try:
+                timeout = parse_timeout(data.get('timeout', timeout))
+            except (TypeError, ValueError):
+                raise RequestException("SHELL_EXEC takes a timeout in seconds. Got: %s" % str(data.get('timeout')))
+            data = data.get('command', None)
+        if not type(data) == str and not type(data) == unicode:
+            raise RequestException("SHELL_EXEC takes a shell command as input. Got: %s" % str(data))
+        
         shell_exec_id = self.shell_exec_cnt
         self.shell_exec_cnt += 1
         
-        t = threading.Thread(target=self.__shell_exec_thread, args=(data, shell_exec_id))
-        t.setDaemon(True)
-        t.start()
+        logger.info("Shell execution of: %s" % data)
+        process = self.spawn(data)
+        self.__shell_exec_running.append(shell_exec_id)
+        self.state = protocol.BUSY
+        # Subscribers must see the command running before the reply
+        self.publish('shell_exec')
+        
+        def shell_exec_done(exitcode):
+            self.__shell_exec_finished(shell_exec_id, process.read(), process.readerr())
+        
+        def shell_exec_timeout():
+            logger.warning("SHELL_EXEC timed out after %.1f seconds: %s" % (timeout, data))
+            self.__shell_exec_finished(shell_exec_id, process.read(),
+                                       process.readerr() + "Timed out after %.1f seconds" % timeout)
+        
+        self.monitor(process, shell_exec_done, timeout=timeout,
+                     on_timeout=shell_exec_timeout)
         
         return shell_exec_id
-
-
-    def __shell_exec_thread(self, command, shell_exec_id):
-        logger.info("Shell execution of: %s" % command)
-        process = Process(command, shell=True)
-        # Initiate process
-        process.wait(os.WNOHANG)
-        self.processes.append(process)
-        # Blocking wait
-        process.wait()
-        self.shell_exec_results[shell_exec_id] = (process.read(), process.readerr())
-        self.state = protocol.IDLE
+    
+    def __shell_exec_finished(self, shell_exec_id, stdout, stderr):
+        self.shell_exec_results[shell_exec_id] = (stdout, stderr)
+        if shell_exec_id in self.__shell_exec_running:
+            self.__shell_exec_running.remove(shell_exec_id)
+        if not self.__shell_exec_running:
+            self.state = protocol.IDLE
+        self.publish('shell_exec')
     
     def shell_results(self, data):
         try:
@@ -346,11 +957,25 @@ class Slave():
         
     def status(self, data):
         logger.debug("Received STATUS command.")
-        return {'progress': self.__progress,
-                'badblocks_done': self.__badblocks_done,
-                'wipe_done': self.__wipe_done,
-                'fail_message': self.__fail_message,
-                'uuid': self.uuid}
+        return self.__status()
+    
+    def __status(self):
+        status = {'progress': self.progress,
+                  'progress_time': self.__progress_time,
+                  'badblocks_done': self.__badblocks_done,
+                  'wipe_done': self.__wipe_done,
+                  'fail_message': self.__fail_message,
+                  'uuid': self.uuid,
+                  'jobs': dict((device, job.as_dict()) for device, job in self.jobs.items()),
+                  'shell_exec_running': list(self.__shell_exec_running),
+                  'features': ['verify', 'resume', 'adopt'],
+                  'protocol': protocol.PROTOCOL_VERSION,
+                  'seq': self.__event_seq}
+        if self.__legacy_job:
+            rates = self.__legacy_job.rates()
+            for key in ('bytes_done', 'throughput', 'avg_throughput', 'eta'):
+                status[key] = rates[key]
+        return status
     
     def hardware(self, data):
         logger.info("Received HARDWARE command.")
@@ -359,48 +984,73 @@ class Slave():
         else:
             return None
     
-    def __scan_thread(self, commands):
-        # Execute a number of commands and return their output in the same order.
-        command_cnt = float(len(commands))
-        self.__progress = 0.0
-        for cnt, command in enumerate(commands, start=1):
-            logger.info("SCAN executing command: %s" % command)
-            self.__progress = cnt / command_cnt
-            logger.debug("Progress: %.2f" % self.__progress)
-            try:
-                process = Process(command, shell=True,)
-                process.wait(os.WNOHANG)
-                self.processes.append(process)
-                process.wait()
-                self.scan_results[command] = (process.read(), process.readerr())
-            except OSError:
-                self.scan_results[command] = ("", "Command does not exist")
-        
-        self.state = protocol.IDLE
+    def master_info(self, data):
+        """ Takes a dictionary that the master wants to have back after
+            it has been restarted, and replaces what it sent before.
+            With None, nothing is changed. Returns the stored dictionary.
+        """
+        logger.debug("Received MASTER_INFO command.")
+        if not data is None:
+            if not type(data) == dict:
+                raise RequestException("MASTER_INFO takes a dictionary. Got: %s" % str(data))
+            self.__master_info = data
+        return self.__master_info
     
     def killall(self):
     
         self.__wipe_done = False
         self.__fail_message = ""
         self.__badblocks_done = False
-        # Signal the main thread to kill everything... can only be done from there!
-        self.signal_mainthread_killall = True
+        self.__scan_queue = []
+        self.__scan_running = 0
+        self.__shell_exec_running = []
+        self.__legacy_job = None
+        for job in self.jobs.values():
+            if job.worker:
+                job.worker.stop()
+        self.jobs = {}
+        kill_slave_processes(self)
             
     def reset(self, data):
         """Command asks the client to reset and terminate all running processes"""
         logger.info("Received RESET command.")
-        self.state = protocol.RESET
+        # RESET is a command, not a state, subscribers see BUSY while
+        # the processes are killed
+        self.state = protocol.BUSY
         self.killall()
+        self.__master_info = None
+        self.state = protocol.IDLE
         return None
     
+def parse_timeout(timeout):
+    """Seconds as a float, or None for no timeout"""
+    if timeout is None:
+        return None
+    timeout = float(timeout)
+    if timeout <= 0:
+        return None
+    return timeout
+
+def device_size(device):
+    """Size in bytes of a block device like sda, or None"""
+    try:
+        f = open("/sys/class/block/%s/size" % device)
+        try:
+            # Always counted in 512 byte sectors
+            return int(f.read()) * 512
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
 def kill_slave_processes(slave):
-    for process in slave.processes:
+    for process in list(slave.processes):
+        slave.processes.remove(process)
         try:
             process.terminate()
         except OSError:
             # Nothing important, probably process is already done
             continue
-        slave.processes.remove(process)
 
             
 if __name__ == "__main__":
@@ -422,23 +1072,7 @@ _/_/_/_/    _/_/_/  _/    _/  _/_/_/            _/      _/_/_/_/  _/  _/
     print ""
     
     slave = Slave()
-    
-    while True:
-        
-        # Monitor signal to terminate all processes
-        # (this can only be done from main thread)
-        if slave.signal_mainthread_killall: 
-            kill_slave_processes(slave)
-            slave.state = protocol.IDLE
-            slave.signal_mainthread_killall = False
-            
-        s = raw_input()
-        if s == 'q':
-            print "Cleaning up..."
-            kill_slave_processes(slave)
-            slave.stop()
-            print "Finished. Bye!"
-            exit(0)
-        else:
-            time.sleep(1)
-    
\ No newline at end of file
+    slave.watch_stdin()
+    slave.run()
+    print "Finished. Bye!"
+    exit(0)
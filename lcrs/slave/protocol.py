@@ -17,6 +17,10 @@
 # You should have received a copy of the GNU General Public License
 # along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import socket
+import struct
+
 # States of the slave application
 ( IDLE,
   FAIL,
@@ -46,5 +50,97 @@ def translate_state(state):
     BADBLOCKS, # Scan for bad blocks
     DEBUG_MODE, # Switch on debug mode
     RESET,
-) = range(9) 
+    SUBSCRIBE, # Stream state and progress events (framed protocol only)
+    VERIFY, # Read random sectors of a device and compare them to a pattern
+    RESUME, # Continue a native wipe from a checkpoint
+    MASTER_INFO, # Keep the master's notes on this computer across a master restart
+) = range(13)
+
+
+# Version of the framed wire protocol. A master asks for it by sending
+# a one-shot STATUS request with {'upgrade': PROTOCOL_VERSION} as data.
+# A slave that understands it replies with a frame and keeps the
+# connection open. Older slaves reply with plain JSON and close the
+# connection, in which case the master stays with one-shot requests.
+PROTOCOL_VERSION = 2
+
+# A frame is a 4 byte unsigned big-endian length followed by a JSON
+# document of that length. Requests are [request_id, command, data],
+# replies are [request_id, state, data].
+FRAME_HEADER = struct.Struct("!I")
+
+# Bytes to ask for in each recv() on a framed connection
+RECV_SIZE = 65536
+
+# Frames larger than this are refused, so a confused or malicious peer
+# cannot make us buffer without limits.
+MAX_FRAME_SIZE = 32 * 1024 * 1024
+
+class FrameTooLarge(ValueError):
+    """Raised when a frame header announces more than MAX_FRAME_SIZE"""
+    pass
+
+def pack_frame(message):
+    """Serialize a message as a length-prefixed frame"""
+    data = json.dumps(message)
+    return FRAME_HEADER.pack(len(data)) + data
+
+class FrameDecoder():
+    """
+    Incremental decoder for a stream of frames. Feed it whatever
+    arrives on the socket; received chunks are only joined once a
+    frame is complete, and each frame is parsed exactly once.
+    """
+    
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.__chunks = []
+        self.__buffered = 0
+        self.__length = None
+    
+    def feed(self, data):
+        """Add received data. Returns the list of messages completed by it."""
+        messages = []
+        if data:
+            self.__chunks.append(data)
+            self.__buffered += len(data)
+        while True:
+            if self.__length is None:
+                if self.__buffered < FRAME_HEADER.size:
+                    break
+                buf = self.__take(FRAME_HEADER.size)
+                (self.__length,) = FRAME_HEADER.unpack(buf)
+                if self.__length > self.max_size:
+                    raise FrameTooLarge("Frame of %d bytes exceeds limit of %d bytes" %
+                                        (self.__length, self.max_size))
+            if self.__buffered < self.__length:
+                break
+            buf = self.__take(self.__length)
+            self.__length = None
+            messages.append(json.loads(buf))
+        return messages
+    
+    def __take(self, size):
+        """Remove size bytes from the buffered chunks"""
+        if len(self.__chunks) > 1:
+            self.__chunks = ["".join(self.__chunks)]
+        buf = self.__chunks[0] if self.__chunks else ""
+        data, rest = buf[:size], buf[size:]
+        self.__chunks = [rest] if rest else []
+        self.__buffered -= size
+        return data
 
+def recv_exactly(sock, size):
+    """Read exactly size bytes from a socket. Returns an empty string
+       if the connection was closed before anything was received."""
+    chunks = []
+    missing = size
+    while missing > 0:
+        chunk = sock.recv(min(missing, RECV_SIZE))
+        if not chunk:
+            if chunks:
+                raise socket.error("Connection closed in the middle of a frame")
+            return ""
+        chunks.append(chunk)
+        missing -= len(chunk)
+    return "".join(chunks)
@@ -0,0 +1,183 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Rene Jensen
+# - Michael Wojciechowski
+# - Benjamin Bach
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A small single-threaded event loop for the slave.
+
+All sockets and child process pipes are registered with one Reactor,
+which calls back when they become readable or writable. Timers replace
+the sleeping threads that used to sample progress. Callbacks run on
+the reactor's thread; other threads hand work over with
+call_soon_threadsafe().
+"""
+
+import os
+import time
+import heapq
+import errno
+import fcntl
+import select
+import logging
+import threading
+
+logger = logging.getLogger('lcrs_slave')
+
+# Event masks. epoll and poll use the same values.
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP
+
+class Timer():
+    """Returned by call_later(). Call cancel() to stop it from firing."""
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+class Reactor():
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.__poller = select.epoll()
+            self.__timeout_scale = 1.0
+        else:
+            self.__poller = select.poll()
+            self.__timeout_scale = 1000.0
+        self.__handlers = {}
+        self.__timers = []
+        self.__calls = []
+        self.__calls_lock = threading.Lock()
+        self.__running = False
+        self.thread = None
+
+        # Self-pipe used to wake up the loop from other threads
+        self.__wakeup_r, self.__wakeup_w = os.pipe()
+        set_nonblocking(self.__wakeup_r)
+        set_nonblocking(self.__wakeup_w)
+        self.register(self.__wakeup_r, READ, self.__on_wakeup)
+
+    def register(self, fd, events, callback):
+        """Call callback(fd, events) whenever fd is ready for events"""
+        fd = fileno(fd)
+        self.__handlers[fd] = callback
+        self.__poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.__poller.modify(fileno(fd), events)
+
+    def unregister(self, fd):
+        fd = fileno(fd)
+        if self.__handlers.pop(fd, None):
+            self.__poller.unregister(fd)
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds. Reactor thread only."""
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.__timers, timer)
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Run callback(*args) on the reactor's thread as soon as possible"""
+        self.__calls_lock.acquire()
+        self.__calls.append((callback, args))
+        self.__calls_lock.release()
+        try:
+            os.write(self.__wakeup_w, "x")
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def in_reactor_thread(self):
+        return self.thread is threading.currentThread()
+
+    def stop(self):
+        self.__running = False
+        if not self.in_reactor_thread():
+            self.call_soon_threadsafe(lambda: None)
+
+    def run(self):
+        """Run the loop in the calling thread until stop() is called"""
+        self.thread = threading.currentThread()
+        self.__running = True
+        while self.__running:
+            timeout = self.__run_timers()
+            try:
+                events = self.__poller.poll(timeout * self.__timeout_scale if timeout >= 0 else -1)
+            except (IOError, OSError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                callback = self.__handlers.get(fd, None)
+                if callback is None:
+                    continue
+                try:
+                    callback(fd, event)
+                except Exception:
+                    logger.exception("Unhandled exception in reactor callback")
+
+    def __run_timers(self):
+        """Fire expired timers. Returns seconds until the next one, or -1"""
+        now = time.time()
+        while self.__timers and (self.__timers[0].deadline <= now or self.__timers[0].cancelled):
+            timer = heapq.heappop(self.__timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Unhandled exception in reactor timer")
+        if self.__timers:
+            return max(0.0, self.__timers[0].deadline - time.time())
+        return -1
+
+    def __on_wakeup(self, fd, events):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.__calls_lock.acquire()
+        calls = self.__calls
+        self.__calls = []
+        self.__calls_lock.release()
+        for callback, args in calls:
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Unhandled exception in reactor call")
+
+def fileno(fd):
+    if hasattr(fd, 'fileno'):
+        return fd.fileno()
+    return fd
+
+def set_nonblocking(fd):
+    fd = fileno(fd)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
@@ -20,6 +20,20 @@
 LISTEN_PORT = 9000
 MAX_PACKET_SIZE = 4096
 CLIENT_TIMEOUT = 60.0 # Seconds before dropping a connection
+CLIENT_SWEEP_INTERVAL = 5.0 # Seconds between checks for idle connections
+POLL_INTERVAL = 2.0 # Seconds between progress samples of long-running jobs
+JOB_OUTPUT_LIMIT = 64 * 1024 # Bytes of output kept per pipe of a wipe or badblocks command
+PROGRESS_PUBLISH_INTERVAL = 0.5 # Seconds between progress events to subscribers
+RATE_WINDOW = 30.0 # Seconds of progress behind the current throughput and ETA of a job
+SCAN_WORKERS = 4 # Default number of scan commands to run at the same time
+SCAN_TIMEOUT = 60.0 # Default seconds before a scan command is killed
+SHELL_EXEC_TIMEOUT = 60.0 # Default seconds before a SHELL_EXEC command is killed
+HEARTBEAT_INTERVAL = 10.0 # Seconds between events to idle subscribers
+
+WIPE_BLOCK_SIZE = 4 * 1024 * 1024 # Bytes per write of the native wipe engine
+WIPE_DIRECT = True # Bypass the page cache with O_DIRECT
+WIPE_FSYNC_INTERVAL = 256 * 1024 * 1024 # Bytes between fsyncs, 0 for only at the end
+VERIFY_SECTORS = 10000 # Default number of random sectors read by VERIFY
 
 WIPE_OPTION_ZEROS = "z"
 WIPE_COMMAND = "/bin/wipe -x%(passes)d -%(method) -v -l0 %(device)"
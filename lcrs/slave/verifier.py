@@ -0,0 +1,284 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Rene Jensen
+# - Michael Wojciechowski
+# - Benjamin Bach
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Checks that a wiped drive holds nothing but the wipe pattern by reading
+random sectors straight from the device, instead of shipping hexdumps
+of a single sector to the master. FullVerifier reads the whole drive.
+"""
+
+import io
+import os
+import mmap
+import time
+import errno
+import random
+import logging
+import threading
+
+import settings
+from wipeengine import sector_size, THROUGHPUT_WINDOW
+
+logger = logging.getLogger('lcrs_slave')
+
+# Only this many offsets of bad sectors are reported, the counts are exact
+MAX_REPORTED_OFFSETS = 100
+
+class SectorVerifier():
+    """
+    Reads a number of random sectors of a device in a worker thread and
+    compares them with a pattern byte. The sectors are read in order of
+    their offset to spare the drive's head some travelling.
+    """
+
+    def __init__(self, device, sectors=settings.VERIFY_SECTORS, pattern=0,
+                 on_finished=None):
+        if sectors <= 0:
+            raise ValueError("Number of sectors must be positive")
+        self.device = device
+        self.sectors = sectors
+        self.pattern = chr(pattern)
+        self.on_finished = on_finished
+
+        self.checked = 0
+        self.failed = 0 # Readable, but not the pattern
+        self.unreadable = 0
+        self.failed_offsets = []
+        self.error = None
+        self.done = False
+        self.__stop = False
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop = True
+
+    @property
+    def progress(self):
+        return float(self.checked) / self.sectors
+
+    def status(self):
+        return {'sectors_checked': self.checked,
+                'sectors_failed': self.failed,
+                'sectors_unreadable': self.unreadable,
+                'failed_offsets': self.failed_offsets}
+
+    def failure(self):
+        """A message for the user if the drive could not be checked at
+           all. Sectors that do not match are part of the status."""
+        if self.error:
+            return "Failed while verifying. %s" % self.error
+        return None
+
+    def __run(self):
+        fd = None
+        try:
+            fd = os.open(self.device, os.O_RDONLY)
+            size = sector_size(fd)
+            total = os.lseek(fd, 0, os.SEEK_END) / size
+            if total < self.sectors:
+                self.sectors = max(1, total)
+            self.__check(fd, size, sorted(random.sample(xrange(total), self.sectors)))
+        except (OSError, IOError, ValueError), e:
+            self.error = "Could not read %s: %s" % (self.device, str(e))
+            logger.error(self.error)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        self.done = True
+        if self.on_finished:
+            self.on_finished(self)
+
+    def __check(self, fd, size, sectors):
+        expected = self.pattern * size
+        for sector in sectors:
+            if self.__stop:
+                break
+            offset = sector * size
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, size)
+            except (OSError, IOError), e:
+                if e.errno != errno.EIO:
+                    raise
+                data = None
+            if data is None or len(data) != size:
+                self.unreadable += 1
+                self.__record(offset)
+            elif data != expected:
+                self.failed += 1
+                self.__record(offset)
+            self.checked += 1
+
+    def __record(self, offset):
+        logger.warning("Sector at byte %d of %s did not verify" % (offset, self.device))
+        if len(self.failed_offsets) < MAX_REPORTED_OFFSETS:
+            self.failed_offsets.append(offset)
+
+class FullVerifier():
+    """
+    Streams a whole device through one preallocated buffer and compares
+    every chunk with a buffer of zeros, which is a memcmp in C. Chunks
+    that do not match are checked sector by sector to report offsets.
+    """
+
+    def __init__(self, device, block_size=settings.WIPE_BLOCK_SIZE,
+                 direct=settings.WIPE_DIRECT, on_finished=None):
+        if block_size <= 0 or block_size % mmap.PAGESIZE:
+            raise ValueError("Block size must be a multiple of %d bytes" % mmap.PAGESIZE)
+        self.device = device
+        self.block_size = int(block_size)
+        self.direct = bool(direct)
+        self.on_finished = on_finished
+
+        self.size = None
+        self.bytes_verified = 0
+        self.throughput = 0.0 # Bytes per second
+        self.failed = 0
+        self.unreadable = 0
+        self.failed_offsets = []
+        self.started_on = None
+        self.finished_on = None
+        self.error = None
+        self.done = False
+        self.__stop = False
+        self.__thread = None
+
+    def start(self):
+        self.started_on = time.time()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop = True
+
+    @property
+    def progress(self):
+        if not self.size:
+            return 0.0
+        return float(self.bytes_verified) / self.size
+
+    def status(self):
+        return {'full': True,
+                'bytes_verified': self.bytes_verified,
+                'throughput': self.throughput,
+                'sectors_failed': self.failed,
+                'sectors_unreadable': self.unreadable,
+                'failed_offsets': self.failed_offsets}
+
+    def failure(self):
+        if self.error:
+            return "Failed while verifying. %s" % self.error
+        if self.__stop:
+            return "Verification was stopped at byte %d" % self.bytes_verified
+        return None
+
+    def __run(self):
+        fd = None
+        try:
+            try:
+                fd = os.open(self.device, os.O_RDONLY | (os.O_DIRECT if self.direct else 0))
+            except OSError:
+                if not self.direct:
+                    raise
+                logger.warning("Could not open %s with O_DIRECT, using buffered reads" % self.device)
+                self.direct = False
+                fd = os.open(self.device, os.O_RDONLY)
+            self.size = os.lseek(fd, 0, os.SEEK_END)
+            os.lseek(fd, 0, os.SEEK_SET)
+            self.__read_all(fd, sector_size(fd))
+        except (OSError, IOError), e:
+            self.error = "Error at byte %d of %s: %s" % (self.bytes_verified, self.device, str(e))
+            logger.error(self.error)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        self.finished_on = time.time()
+        if self.finished_on > self.started_on:
+            self.throughput = self.bytes_verified / (self.finished_on - self.started_on)
+        self.done = True
+        if self.on_finished:
+            self.on_finished(self)
+
+    def __read_all(self, fd, sector_size):
+        buf = mmap.mmap(-1, self.block_size)
+        zeros = mmap.mmap(-1, self.block_size)
+        f = io.FileIO(fd, "r", closefd=False)
+        try:
+            window_start = time.time()
+            window_bytes = 0
+            while self.bytes_verified < self.size and not self.__stop:
+                length = min(self.block_size, self.size - self.bytes_verified)
+                if length < self.block_size:
+                    # The last chunk. A fresh buffer keeps the read aligned.
+                    buf.close()
+                    buf = mmap.mmap(-1, length)
+                try:
+                    ok = f.readinto(buf) == length and buffer(buf) == buffer(zeros, 0, length)
+                except (OSError, IOError), e:
+                    if e.errno != errno.EIO:
+                        raise
+                    ok = False
+                if not ok:
+                    self.__check_sectors(fd, f, sector_size, self.bytes_verified, length)
+                self.bytes_verified += length
+
+                now = time.time()
+                if now - window_start >= THROUGHPUT_WINDOW:
+                    self.throughput = (self.bytes_verified - window_bytes) / (now - window_start)
+                    window_start = now
+                    window_bytes = self.bytes_verified
+        finally:
+            f.close()
+            buf.close()
+            zeros.close()
+
+    def __check_sectors(self, fd, f, sector_size, offset, length):
+        """Find the sectors of a chunk that are not zeros"""
+        sector = mmap.mmap(-1, sector_size)
+        zeros = mmap.mmap(-1, sector_size)
+        try:
+            for sector_offset in xrange(offset, offset + length, sector_size):
+                try:
+                    os.lseek(fd, sector_offset, os.SEEK_SET)
+                    if f.readinto(sector) != sector_size:
+                        raise IOError(errno.EIO, "Short read")
+                except (OSError, IOError), e:
+                    if e.errno != errno.EIO:
+                        raise
+                    self.unreadable += 1
+                    self.__record(sector_offset)
+                    continue
+                if buffer(sector) != buffer(zeros):
+                    self.failed += 1
+                    self.__record(sector_offset)
+        finally:
+            sector.close()
+            zeros.close()
+        os.lseek(fd, offset + length, os.SEEK_SET)
+
+    def __record(self, offset):
+        logger.warning("Sector at byte %d of %s is not zeros" % (offset, self.device))
+        if len(self.failed_offsets) < MAX_REPORTED_OFFSETS:
+            self.failed_offsets.append(offset)
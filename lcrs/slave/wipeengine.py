@@ -0,0 +1,316 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Rene Jensen
+# - Michael Wojciechowski
+# - Benjamin Bach
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Wipes a drive with zeros from within the slave instead of running the
+external wipe command.
+
+Writes are done from one mmap-allocated buffer, which is page-aligned
+as O_DIRECT requires, so the data goes straight from the buffer to the
+drive without passing through the page cache.
+
+With verify, every block is read back right after it is written and
+compared to zeros, so one pass both wipes and checks the drive. Blocks
+that fail are retried sector by sector to find the bad sectors.
+
+The offset up to which the zeros are known to be on the drive is kept
+as the checkpoint, which moves on with every fsync. A wipe that was cut
+short can be continued from there with start_offset.
+
+Run this module with a device as argument to time a wipe:
+
+    python wipeengine.py /dev/sdb [block size in KiB] [direct 0/1] [verify 0/1]
+"""
+
+import io
+import os
+import sys
+import mmap
+import time
+import errno
+import fcntl
+import struct
+import logging
+import threading
+
+import settings
+
+logger = logging.getLogger('lcrs_slave')
+
+# Seconds over which the current throughput is measured
+THROUGHPUT_WINDOW = 2.0
+
+# Give up on a drive with more bad sectors than this
+MAX_BAD_SECTORS = 1000
+
+BLKSSZGET = 0x1268 # ioctl for the logical sector size
+DEFAULT_SECTOR_SIZE = 512
+
+class TooManyBadSectors(IOError):
+    pass
+
+def sector_size(fd):
+    """Logical sector size of the block device open as fd"""
+    try:
+        return struct.unpack("i", fcntl.ioctl(fd, BLKSSZGET, struct.pack("i", 0)))[0]
+    except IOError:
+        # Not a block device
+        return DEFAULT_SECTOR_SIZE
+
+class WipeEngine():
+    """
+    Overwrites a device with zeros in a worker thread. Read the
+    attributes bytes_written, size and throughput at any time, and
+    the error attribute once it is done. With verify, bytes_verified
+    and bad_sectors (sector numbers) are kept as well.
+
+    bytes_written is the offset reached on the device, so it starts
+    out at start_offset, which is rounded down to a whole block.
+    """
+
+    def __init__(self, device, block_size=settings.WIPE_BLOCK_SIZE,
+                 direct=settings.WIPE_DIRECT,
+                 fsync_interval=settings.WIPE_FSYNC_INTERVAL,
+                 verify=False, start_offset=0, on_finished=None):
+        if block_size <= 0 or block_size % mmap.PAGESIZE:
+            raise ValueError("Block size must be a multiple of %d bytes" % mmap.PAGESIZE)
+        if start_offset < 0:
+            raise ValueError("Start offset must not be negative")
+        self.device = device
+        self.block_size = int(block_size)
+        self.direct = bool(direct)
+        self.fsync_interval = int(fsync_interval or 0)
+        self.verify = bool(verify)
+        self.start_offset = int(start_offset) / self.block_size * self.block_size
+        self.on_finished = on_finished
+
+        self.size = None
+        self.sector_size = DEFAULT_SECTOR_SIZE
+        self.bytes_written = self.start_offset
+        self.bytes_verified = self.start_offset if self.verify else 0
+        # Everything before this offset has been written and synced
+        self.checkpoint = self.start_offset
+        self.bad_sectors = []
+        self.throughput = 0.0 # Bytes per second
+        self.started_on = None
+        self.finished_on = None
+        self.error = None
+        self.done = False
+        self.__stop = False
+        self.__thread = None
+
+    def start(self):
+        self.started_on = time.time()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop writing after the current block"""
+        self.__stop = True
+
+    def is_alive(self):
+        return self.__thread is not None and self.__thread.isAlive()
+
+    def status(self):
+        return {'bytes_written': self.bytes_written,
+                'bytes_verified': self.bytes_verified,
+                'bad_sectors': len(self.bad_sectors),
+                'throughput': self.throughput,
+                'start_offset': self.start_offset,
+                'checkpoint': self.checkpoint}
+
+    def failure(self):
+        """A message for the user if the wipe went wrong, or None"""
+        if self.error:
+            return "Failed while wiping. %s" % self.error
+        if self.bad_sectors:
+            return ("Found %d bad sectors, the first ones are: %s" %
+                    (len(self.bad_sectors), ", ".join(map(str, self.bad_sectors[:10]))))
+        return None
+
+    @property
+    def progress(self):
+        if not self.size:
+            return 0.0
+        return float(self.bytes_written) / self.size
+
+    def __open(self):
+        mode = os.O_RDWR if self.verify else os.O_WRONLY
+        try:
+            return os.open(self.device, mode | (os.O_DIRECT if self.direct else 0))
+        except OSError:
+            if not self.direct:
+                raise
+            # Some drivers and file systems refuse O_DIRECT. Reading
+            # back then only verifies the page cache.
+            logger.warning("Could not open %s with O_DIRECT, using buffered writes" % self.device)
+            self.direct = False
+            return os.open(self.device, mode)
+
+    def __run(self):
+        fd = None
+        try:
+            fd = self.__open()
+            # Works for block devices as well as regular files
+            self.size = os.lseek(fd, 0, os.SEEK_END)
+            if self.start_offset > self.size:
+                raise IOError(errno.EINVAL, "Cannot resume at byte %d of %d" %
+                                            (self.start_offset, self.size))
+            os.lseek(fd, self.start_offset, os.SEEK_SET)
+            self.sector_size = sector_size(fd)
+            self.__write_all(fd)
+            os.fsync(fd)
+            self.checkpoint = self.bytes_written
+        except (OSError, IOError), e:
+            self.error = "Error at byte %d of %s: %s" % (self.bytes_written, self.device, str(e))
+            logger.error(self.error)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        self.finished_on = time.time()
+        if self.finished_on > self.started_on:
+            # Report the average once there is nothing left to measure
+            self.throughput = (self.bytes_written - self.start_offset) / (self.finished_on - self.started_on)
+        self.done = True
+        if self.on_finished:
+            self.on_finished(self)
+
+    def __write_all(self, fd):
+        buf = mmap.mmap(-1, self.block_size)
+        readback = mmap.mmap(-1, self.block_size) if self.verify else None
+        # For reading into the buffers. Closing it leaves fd open.
+        f = io.FileIO(fd, "r+" if self.verify else "w", closefd=False)
+        try:
+            size = self.size
+            synced = self.bytes_written
+            window_start = time.time()
+            window_bytes = self.bytes_written
+            while self.bytes_written < size and not self.__stop:
+                length = min(self.block_size, size - self.bytes_written)
+                if length < self.block_size:
+                    # The last block. Fresh buffers keep reads aligned.
+                    buf.close()
+                    buf = mmap.mmap(-1, length)
+                    if readback:
+                        readback.close()
+                        readback = mmap.mmap(-1, length)
+                try:
+                    ok = self.__write_block(fd, f, buf, readback, length)
+                except (OSError, IOError), e:
+                    if e.errno != errno.EIO:
+                        raise
+                    ok = False
+                if not ok:
+                    self.__check_sectors(fd, f, self.bytes_written, length)
+                self.bytes_written += length
+                if self.verify:
+                    self.bytes_verified += length
+
+                if self.fsync_interval and self.bytes_written - synced >= self.fsync_interval:
+                    os.fsync(fd)
+                    synced = self.bytes_written
+                    self.checkpoint = synced
+
+                now = time.time()
+                if now - window_start >= THROUGHPUT_WINDOW:
+                    self.throughput = (self.bytes_written - window_bytes) / (now - window_start)
+                    window_start = now
+                    window_bytes = self.bytes_written
+        finally:
+            f.close()
+            buf.close()
+            if readback:
+                readback.close()
+
+    def __write_block(self, fd, f, buf, readback, length):
+        """Write zeros from buf at the current position. Returns False
+           if they could not be read back."""
+        offset = self.bytes_written
+        written = os.write(fd, buf)
+        if written != length:
+            os.lseek(fd, offset + length, os.SEEK_SET)
+            return False
+        if readback is None:
+            return True
+        os.lseek(fd, offset, os.SEEK_SET)
+        read = f.readinto(readback)
+        if read != length:
+            os.lseek(fd, offset + length, os.SEEK_SET)
+            return False
+        # buf still holds nothing but zeros
+        return buffer(readback) == buffer(buf)
+
+    def __check_sectors(self, fd, f, offset, length):
+        """Write and verify a failed block one sector at a time and
+           record the sectors that do not work"""
+        sector_size = self.sector_size
+        zeros = mmap.mmap(-1, sector_size)
+        readback = mmap.mmap(-1, sector_size)
+        try:
+            for sector_offset in xrange(offset, offset + length, sector_size):
+                try:
+                    os.lseek(fd, sector_offset, os.SEEK_SET)
+                    ok = os.write(fd, zeros) == sector_size
+                    if ok and self.verify:
+                        os.lseek(fd, sector_offset, os.SEEK_SET)
+                        ok = f.readinto(readback) == sector_size and buffer(readback) == buffer(zeros)
+                except (OSError, IOError), e:
+                    if e.errno != errno.EIO:
+                        raise
+                    ok = False
+                if not ok:
+                    self.bad_sectors.append(sector_offset / sector_size)
+                    logger.warning("Bad sector %d on %s" % (sector_offset / sector_size, self.device))
+                    if len(self.bad_sectors) > MAX_BAD_SECTORS:
+                        raise TooManyBadSectors(errno.EIO, "More than %d bad sectors" % MAX_BAD_SECTORS)
+        finally:
+            zeros.close()
+            readback.close()
+        os.lseek(fd, offset + length, os.SEEK_SET)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print "Usage: %s DEVICE [BLOCK_SIZE_KIB] [DIRECT] [VERIFY]" % sys.argv[0]
+        sys.exit(1)
+
+    block_size = settings.WIPE_BLOCK_SIZE
+    direct = settings.WIPE_DIRECT
+    if len(sys.argv) > 2:
+        block_size = int(sys.argv[2]) * 1024
+    if len(sys.argv) > 3:
+        direct = sys.argv[3] == "1"
+    verify = len(sys.argv) > 4 and sys.argv[4] == "1"
+
+    finished = threading.Event()
+    engine = WipeEngine(sys.argv[1], block_size, direct, verify=verify,
+                        on_finished=lambda engine: finished.set())
+    engine.start()
+    while not finished.wait(1.0):
+        print "%5.1f%%  %8.1f MB/s" % (engine.progress * 100, engine.throughput / 1e6)
+    if engine.error:
+        print engine.error
+        sys.exit(1)
+    duration = engine.finished_on - engine.started_on
+    print "Wrote %d bytes in %.2f seconds: %.1f MB/s (block size %d, O_DIRECT %s, verify %s)" % (
+        engine.bytes_written, duration, engine.throughput / 1e6,
+        engine.block_size, engine.direct, engine.verify)
+    if engine.bad_sectors:
+        print "Bad sectors: %s" % ", ".join(map(str, engine.bad_sectors))
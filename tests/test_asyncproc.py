@@ -0,0 +1,177 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import errno
+import signal
+import unittest
+import threading
+
+from lcrs.slave.asyncproc import OutputBuffer, Process, Timeout, with_timeout, shared_reactor
+
+class OutputBufferTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        buf = OutputBuffer()
+        buf.append("abc")
+        buf.append("def")
+        self.assertEqual(len(buf), 6)
+        self.assertEqual(buf.peek(), "abcdef")
+        self.assertEqual(buf.take(), "abcdef")
+        self.assertEqual(buf.take(), "")
+        self.assertEqual(buf.dropped, 0)
+
+    def test_fits(self):
+        buf = OutputBuffer(8)
+        buf.append("abc")
+        buf.append("defgh")
+        self.assertEqual(buf.peek(), "abcdefgh")
+        self.assertEqual(buf.dropped, 0)
+
+    def test_wraps_around(self):
+        buf = OutputBuffer(8)
+        buf.append("abcdef")
+        buf.append("ghij")
+        # The oldest two bytes are overwritten, the rest spans the end
+        # of the ring
+        self.assertEqual(len(buf), 8)
+        self.assertEqual(buf.peek(), "cdefghij")
+        self.assertEqual(buf.dropped, 2)
+        buf.append("kl")
+        self.assertEqual(buf.peek(), "efghijkl")
+        self.assertEqual(buf.dropped, 4)
+
+    def test_wraps_after_take(self):
+        buf = OutputBuffer(8)
+        buf.append("abcdef")
+        self.assertEqual(buf.take(), "abcdef")
+        buf.append("123")
+        buf.append("4567")
+        self.assertEqual(buf.peek(), "1234567")
+        buf.append("89")
+        self.assertEqual(buf.take(), "23456789")
+        self.assertEqual(buf.dropped, 1)
+        self.assertEqual(len(buf), 0)
+
+    def test_many_small_appends(self):
+        buf = OutputBuffer(10)
+        data = "".join(chr(ord("a") + i % 26) for i in range(1000))
+        for c in data:
+            buf.append(c)
+        self.assertEqual(buf.peek(), data[-10:])
+        self.assertEqual(buf.dropped, 990)
+
+    def test_larger_than_limit(self):
+        buf = OutputBuffer(4)
+        buf.append("ab")
+        buf.append("0123456789")
+        self.assertEqual(buf.peek(), "6789")
+        self.assertEqual(buf.dropped, 8)
+
+    def test_no_output_kept(self):
+        buf = OutputBuffer(0)
+        buf.append("abc")
+        self.assertEqual(buf.peek(), "")
+        self.assertEqual(buf.dropped, 3)
+
+class WithTimeoutTest(unittest.TestCase):
+
+    def test_returns_value(self):
+        self.assertEqual(with_timeout(5, lambda x: x * 2, 21), 42)
+
+    def test_times_out(self):
+        started = time.time()
+        self.assertRaises(Timeout, with_timeout, 1, time.sleep, 10)
+        self.assertTrue(time.time() - started < 5)
+
+class ProcessTest(unittest.TestCase):
+
+    def wait_for_output(self, process, text, timeout=5.0):
+        deadline = time.time() + timeout
+        while not text in process._peek()[0] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(text in process._peek()[0])
+
+    def test_output_and_exit(self):
+        p = Process("echo out; echo err >&2; exit 3", shell=True)
+        self.assertEqual(os.WEXITSTATUS(p.wait()), 3)
+        self.assertEqual(p.read(), "out\n")
+        self.assertEqual(p.readerr(), "err\n")
+
+    def test_terminate_closes_input(self):
+        # cat ends by itself at EOF, no signal is needed
+        p = Process(["cat"])
+        p.write("hello")
+        status = p.terminate(graceperiod=5)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(p.read(), "hello")
+
+    def test_terminate_sends_sigterm(self):
+        p = Process(["sleep", "30"])
+        started = time.time()
+        status = p.terminate(graceperiod=0.2)
+        self.assertEqual(os.WTERMSIG(status), signal.SIGTERM)
+        self.assertTrue(time.time() - started < 5)
+
+    def test_terminate_escalates_to_sigkill(self):
+        p = Process("trap '' TERM; echo ready; exec sleep 30", shell=True)
+        self.wait_for_output(p, "ready")
+        status = p.terminate(graceperiod=0.2)
+        self.assertTrue(os.WIFSIGNALED(status))
+        self.assertEqual(os.WTERMSIG(status), signal.SIGKILL)
+
+    def test_terminate_on_reactor_thread(self):
+        # A timeout on the reactor thread must not block it: SIGTERM is
+        # sent at once, SIGKILL by a timer and the exit callback follows
+        exited = threading.Event()
+        statuses = []
+        def on_exit(process, status):
+            statuses.append(status)
+            exited.set()
+        p = Process("trap '' TERM; echo ready; exec sleep 30", shell=True, on_exit=on_exit)
+        self.wait_for_output(p, "ready")
+        returned = []
+        shared_reactor().call_soon_threadsafe(lambda: returned.append(p.terminate(graceperiod=0.2)))
+        self.assertTrue(exited.wait(5))
+        self.assertEqual(returned, [None])
+        self.assertEqual(os.WTERMSIG(statuses[0]), signal.SIGKILL)
+
+    def test_kill_whole_process_group(self):
+        # A shell running a pipeline in its own group is killed with
+        # everything it started, so the pipe reaches EOF
+        p = Process("sleep 30 | cat", shell=True, preexec_fn=os.setpgrp)
+        started = time.time()
+        status = p.terminate(graceperiod=0.2)
+        self.assertTrue(os.WIFSIGNALED(status))
+        self.assertEqual(p.read(), "")
+        self.assertTrue(time.time() - started < 5)
+
+    def test_kill_after_exit(self):
+        p = Process(["true"])
+        p.wait()
+        try:
+            p.kill(signal.SIGTERM)
+        except OSError, e:
+            self.assertEqual(e.errno, errno.ECHILD)
+        else:
+            self.fail("kill() of an ended process did not raise")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import socket
+import unittest
+import threading
+
+from lcrs.slave import protocol
+from lcrs.master.connection import SlaveConnection, ConnectionException
+
+class FakeSlave():
+    """Listens on loopback and answers each connection with the next
+       of a list of behaviours: "framed" upgrades the connection and
+       answers every request with IDLE, "hangup" closes it after the
+       first request, "old" answers with plain JSON like a slave from
+       before the framed protocol"""
+
+    def __init__(self, behaviours):
+        self.behaviours = list(behaviours)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.requests = []
+        t = threading.Thread(target=self.serve)
+        t.setDaemon(True)
+        t.start()
+
+    def serve(self):
+        while self.behaviours:
+            conn, __ = self.sock.accept()
+            behaviour = self.behaviours.pop(0)
+            conn.recv(65536)
+            if behaviour == "old":
+                conn.sendall(json.dumps([protocol.IDLE, {}]))
+                conn.close()
+                continue
+            conn.sendall(protocol.pack_frame([0, protocol.IDLE, {}]))
+            decoder = protocol.FrameDecoder()
+            data = conn.recv(65536)
+            while data:
+                messages = decoder.feed(data)
+                for request_id, command, request in messages:
+                    self.requests.append((command, request))
+                    if behaviour != "hangup":
+                        conn.sendall(protocol.pack_frame([request_id, protocol.IDLE, {}]))
+                if behaviour == "hangup" and messages:
+                    break
+                data = conn.recv(65536)
+            conn.close()
+        self.sock.close()
+
+class SlaveConnectionTest(unittest.TestCase):
+
+    def test_renegotiates_after_disconnect(self):
+        slave = FakeSlave(["hangup", "framed"])
+        connection = SlaveConnection("127.0.0.1", slave.port)
+        self.assertTrue(connection.is_framed())
+        self.assertRaises(ConnectionException, connection.request, protocol.STATUS, {})
+        self.assertEqual(connection.framed, None)
+        # The next request with framed options is framed again
+        self.assertTrue(connection.is_framed())
+        self.assertEqual(connection.request(protocol.SCAN, {'commands': []}), (protocol.IDLE, {}))
+        self.assertEqual(slave.requests[-1], (protocol.SCAN, {'commands': []}))
+        connection.close()
+
+    def test_no_downgrade_after_framed(self):
+        slave = FakeSlave(["hangup", "old"])
+        connection = SlaveConnection("127.0.0.1", slave.port)
+        self.assertTrue(connection.is_framed())
+        self.assertRaises(ConnectionException, connection.request, protocol.STATUS, {})
+        self.assertRaises(ConnectionException, connection.is_framed)
+        self.assertNotEqual(connection.framed, False)
+
+    def test_old_slave_gets_one_shot_requests(self):
+        slave = FakeSlave(["old", "old"])
+        connection = SlaveConnection("127.0.0.1", slave.port)
+        self.assertFalse(connection.is_framed())
+        self.assertEqual(connection.subscribe(lambda state, data: None), None)
+        self.assertEqual(connection.request(protocol.STATUS, {}), (protocol.IDLE, {}))
+
+if __name__ == "__main__":
+    unittest.main()
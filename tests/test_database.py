@@ -0,0 +1,89 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from lcrs.master.database import Database
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "lcrs.db")
+        self.database = Database(self.path)
+        self.database.start()
+
+    def tearDown(self):
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def save(self, *args):
+        self.database.save_checkpoint(*args)
+        self.assertTrue(self.database.flush())
+
+    def test_same_slave(self):
+        since = time.time() - 60
+        self.save("WD-123", 476940, "8796758451", "Native wipe (zeros)", 4096)
+        stored = self.database.checkpoint("WD-123", 476940, "8796758451", since)
+        self.assertEqual(stored[:3], ("Native wipe (zeros)", 4096, "8796758451"))
+
+    def test_other_slave(self):
+        self.save("WD-123", 476940, "8796758451", "Native wipe (zeros)", 4096)
+        self.assertEqual(self.database.checkpoint("WD-123", 476940, "1234", time.time() - 60), None)
+
+    def test_too_old(self):
+        self.save("WD-123", 476940, "8796758451", "Native wipe (zeros)", 4096)
+        self.assertEqual(self.database.checkpoint("WD-123", 476940, "8796758451", time.time() + 60), None)
+
+    def test_cleared(self):
+        self.save("WD-123", 476940, "8796758451", "Native wipe (zeros)", 4096)
+        self.database.clear_checkpoint("WD-123", 476940)
+        self.assertTrue(self.database.flush())
+        self.assertEqual(self.database.checkpoint("WD-123", 476940, "8796758451", 0), None)
+
+    def test_one_per_drive(self):
+        self.save("WD-123", 476940, "8796758451", "Native wipe (zeros)", 4096)
+        self.save("WD-123", 476940, "1234", "Native wipe (zeros)", 8192)
+        self.assertEqual(self.database.checkpoint("WD-123", 476940, "8796758451", 0), None)
+        self.assertEqual(self.database.checkpoint("WD-123", 476940, "1234", 0)[1], 8192)
+
+    def test_old_table_is_upgraded(self):
+        self.database.close()
+        os.unlink(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE wipe_checkpoints (serial TEXT NOT NULL, size_mb INTEGER NOT NULL, "
+                     "method TEXT, offset INTEGER, updated_on REAL, PRIMARY KEY (serial, size_mb))")
+        conn.execute("INSERT INTO wipe_checkpoints VALUES ('WD-123', 476940, 'Native wipe (zeros)', 4096, ?)",
+                     (time.time(),))
+        conn.commit()
+        conn.close()
+        self.database = Database(self.path)
+        self.database.start()
+        # Not known to be of any slave, so never resumed
+        self.assertEqual(self.database.checkpoint("WD-123", 476940, "8796758451", 0), None)
+        self.save("WD-123", 476940, "8796758451", "Native wipe (zeros)", 8192)
+        self.assertEqual(self.database.checkpoint("WD-123", 476940, "8796758451", 0)[1], 8192)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,287 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+import ConfigParser
+
+from lcrs.master.dhcp import packet
+from lcrs.master.dhcp.leases import LeaseManager, NoFreeAddress
+from lcrs.master.dhcp.dhcp_manager import DHCPManager
+
+try:
+    from lcrs.master import config_master
+except ImportError:
+    # The master's configuration loads the GTK plugins
+    config_master = None
+
+MAC = "02:00:00:00:00:01"
+
+def make_request(message_type, mac=MAC, xid=0x1234, requested_ip=None, server_id=None,
+                 ciaddr=packet.ZERO_IP, op=packet.BOOTREQUEST, options=None):
+    """A client's packet"""
+    chaddr = "".join(chr(int(b, 16)) for b in mac.split(":"))
+    if options is None:
+        options = [(packet.OPTION_MESSAGE_TYPE, chr(message_type))]
+    if requested_ip:
+        options.append((packet.OPTION_REQUESTED_IP, socket.inet_aton(requested_ip)))
+    if server_id:
+        options.append((packet.OPTION_SERVER_ID, socket.inet_aton(server_id)))
+    header = packet.BOOTP_HEADER.pack(op, 1, len(chaddr), 0, xid, 0, 0x8000,
+                                      ciaddr, packet.ZERO_IP, packet.ZERO_IP, packet.ZERO_IP,
+                                      chaddr.ljust(16, "\0"), "\0" * 64, "\0" * 128)
+    return header + packet.MAGIC_COOKIE + packet.encode_options(options)
+
+class LeaseManagerTest(unittest.TestCase):
+
+    def test_same_address_again(self):
+        leases = LeaseManager(["10.0.0.1", "10.0.0.2"])
+        self.assertEqual(leases.lease("a"), ("10.0.0.1", True))
+        self.assertEqual(leases.lease("b"), ("10.0.0.2", True))
+        self.assertEqual(leases.lease("a"), ("10.0.0.1", False))
+        self.assertEqual(leases.get("b"), "10.0.0.2")
+        self.assertEqual(leases.free_count(), 0)
+
+    def test_exhausted(self):
+        leases = LeaseManager(["10.0.0.1"])
+        leases.lease("a")
+        self.assertRaises(NoFreeAddress, leases.lease, "b")
+
+    def test_expired_lease_is_reclaimed(self):
+        leases = LeaseManager(["10.0.0.1", "10.0.0.2"], lease_time=0.05)
+        leases.lease("a")
+        leases.lease("b")
+        time.sleep(0.1)
+        # Renewed, so b's is the only lease that has expired
+        leases.lease("a")
+        self.assertEqual(leases.lease("c"), ("10.0.0.2", True))
+        self.assertEqual(leases.get("b"), None)
+        self.assertEqual(leases.get("a"), "10.0.0.1")
+        self.assertRaises(NoFreeAddress, leases.lease, "d")
+
+    def test_oldest_expired_first(self):
+        leases = LeaseManager(["10.0.0.1", "10.0.0.2"], lease_time=0.05)
+        leases.lease("a")
+        time.sleep(0.01)
+        leases.lease("b")
+        time.sleep(0.1)
+        self.assertEqual(leases.lease("c"), ("10.0.0.1", True))
+        self.assertEqual(leases.get("a"), None)
+
+    def test_reserve_and_release(self):
+        leases = LeaseManager(["10.0.0.1", "10.0.0.2"])
+        leases.lease("a")
+        leases.lease("b")
+        leases.set_uuid("a", "1234")
+        # a takes over b's address, and keeps its uuid
+        leases.reserve("a", "10.0.0.2")
+        self.assertEqual(leases.get("a"), "10.0.0.2")
+        self.assertEqual(leases.get("b"), None)
+        leases.release("a")
+        self.assertEqual(leases.free_count(), 2)
+        self.assertRaises(KeyError, leases.reserve, "a", "10.9.9.9")
+
+    def test_pools(self):
+        leases = LeaseManager({'eth0': ["10.0.0.1"], 'eth1': ["10.0.1.1"]})
+        self.assertEqual(leases.lease("a", 'eth1'), ("10.0.1.1", True))
+        self.assertEqual(leases.pool_of("10.0.1.1"), 'eth1')
+        # Moved to the other segment
+        self.assertEqual(leases.lease("a", 'eth0'), ("10.0.0.1", True))
+        self.assertEqual(leases.lease("b", 'eth1'), ("10.0.1.1", True))
+        self.assertRaises(KeyError, leases.lease, "c", 'eth2')
+        self.assertRaises(ValueError, LeaseManager, {'eth0': ["10.0.0.1"], 'eth1': ["10.0.0.1"]})
+
+    def test_kept_over_restart(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "leases.json")
+            leases = LeaseManager(["10.0.0.1", "10.0.0.2"], path=path)
+            leases.lease("a")
+            leases.lease("b")
+            leases.set_uuid("b", "1234")
+            leases.close()
+            leases = LeaseManager(["10.0.0.2", "10.0.0.3"], path=path)
+            # The address of a is no longer in the range
+            self.assertEqual(leases.get("a"), None)
+            self.assertEqual(leases.known(), ["10.0.0.2"])
+            self.assertEqual(leases.lease("b"), ("10.0.0.2", True))
+            self.assertEqual(leases.lease("b"), ("10.0.0.2", False))
+            self.assertEqual(leases.known(), [])
+            leases.close()
+        finally:
+            shutil.rmtree(directory)
+
+class RequestTest(unittest.TestCase):
+
+    def test_fields(self):
+        request = packet.Request(make_request(packet.REQUEST, requested_ip="10.0.0.5",
+                                              server_id="10.0.0.1"))
+        self.assertEqual(request.mac, MAC)
+        self.assertEqual(request.xid, 0x1234)
+        self.assertEqual(request.message_type, packet.REQUEST)
+        self.assertEqual(request.requested_ip, "10.0.0.5")
+        self.assertEqual(request.server_id, "10.0.0.1")
+
+    def test_requested_ip_from_ciaddr(self):
+        request = packet.Request(make_request(packet.REQUEST, ciaddr=socket.inet_aton("10.0.0.7")))
+        self.assertEqual(request.requested_ip, "10.0.0.7")
+        self.assertEqual(packet.Request(make_request(packet.DISCOVER)).requested_ip, None)
+
+    def test_pad_options(self):
+        data = make_request(packet.DISCOVER)
+        data = data[:packet.OPTIONS_OFFSET] + "\0\0" + data[packet.OPTIONS_OFFSET:]
+        self.assertEqual(packet.Request(data).message_type, packet.DISCOVER)
+
+    def test_malformed(self):
+        self.assertRaises(packet.MalformedPacket, packet.Request, "\1" * 100)
+        self.assertRaises(packet.MalformedPacket, packet.Request,
+                          make_request(packet.DISCOVER, op=packet.BOOTREPLY))
+        data = make_request(packet.DISCOVER)
+        self.assertRaises(packet.MalformedPacket, packet.Request,
+                          data[:packet.BOOTP_HEADER.size] + "\0\0\0\0" + data[packet.OPTIONS_OFFSET:])
+        self.assertRaises(packet.MalformedPacket, packet.Request,
+                          make_request(packet.DISCOVER, options=[]))
+        self.assertRaises(packet.MalformedPacket, packet.Request,
+                          data[:packet.OPTIONS_OFFSET] + chr(packet.OPTION_MESSAGE_TYPE))
+
+class ReplyTemplateTest(unittest.TestCase):
+
+    def reply(self, **kwargs):
+        template = packet.ReplyTemplate(packet.OFFER, "10.0.0.1", **kwargs)
+        request = packet.Request(make_request(packet.DISCOVER))
+        data = template.reply(request, "10.0.0.5")
+        fields = packet.BOOTP_HEADER.unpack_from(data)
+        return fields, packet.parse_options(data, packet.OPTIONS_OFFSET)
+
+    def test_client_fields(self):
+        fields, options = self.reply()
+        (op, __, __, __, xid, __, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr, sname, boot_file) = fields
+        self.assertEqual(op, packet.BOOTREPLY)
+        self.assertEqual(xid, 0x1234)
+        self.assertEqual(flags, 0x8000)
+        self.assertEqual(socket.inet_ntoa(yiaddr), "10.0.0.5")
+        self.assertEqual(chaddr[:6], "\x02\0\0\0\0\x01")
+        self.assertEqual(siaddr, packet.ZERO_IP)
+        self.assertEqual(ord(options[packet.OPTION_MESSAGE_TYPE]), packet.OFFER)
+        self.assertEqual(socket.inet_ntoa(options[packet.OPTION_SERVER_ID]), "10.0.0.1")
+        self.assertFalse(packet.OPTION_SUBNET_MASK in options)
+        self.assertFalse(packet.OPTION_PATH_PREFIX in options)
+
+    def test_boot_options(self):
+        fields, options = self.reply(lease_time=3600, netmask="255.255.254.0", boot_file="lpxelinux.0",
+                                     path_prefix="http://10.0.0.1/")
+        siaddr, sname, boot_file = fields[9], fields[12], fields[13]
+        self.assertEqual(socket.inet_ntoa(siaddr), "10.0.0.1")
+        self.assertEqual(sname.rstrip("\0"), "10.0.0.1")
+        self.assertEqual(boot_file.rstrip("\0"), "lpxelinux.0")
+        self.assertEqual(struct.unpack("!I", options[packet.OPTION_LEASE_TIME])[0], 3600)
+        self.assertEqual(socket.inet_ntoa(options[packet.OPTION_SUBNET_MASK]), "255.255.254.0")
+        self.assertEqual(options[packet.OPTION_PATH_PREFIX], "http://10.0.0.1/")
+
+    def test_template_is_not_changed(self):
+        template = packet.ReplyTemplate(packet.ACK, "10.0.0.1")
+        data = template.data
+        template.reply(packet.Request(make_request(packet.REQUEST)), "10.0.0.5")
+        self.assertEqual(template.data, data)
+
+class DHCPManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.leases = LeaseManager(["10.0.0.5", "10.0.0.6"])
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(2.0)
+        self.manager = DHCPManager(lambda mac: self.leases.lease(mac)[0], "10.0.0.1", None,
+                                   server_port=0, client_port=self.client.getsockname()[1],
+                                   broadcast_address="127.0.0.1", netmask="255.255.255.0")
+
+    def tearDown(self):
+        self.manager.close()
+        self.client.close()
+
+    def receive(self):
+        data = self.client.recv(4096)
+        options = packet.parse_options(data, packet.OPTIONS_OFFSET)
+        return ord(options[packet.OPTION_MESSAGE_TYPE]), data, options
+
+    def test_offer_and_ack(self):
+        self.manager.handle_packet(make_request(packet.DISCOVER))
+        message_type, data, options = self.receive()
+        self.assertEqual(message_type, packet.OFFER)
+        self.assertEqual(socket.inet_ntoa(data[packet.YIADDR_OFFSET:packet.YIADDR_OFFSET + 4]), "10.0.0.5")
+        self.assertEqual(socket.inet_ntoa(options[packet.OPTION_SUBNET_MASK]), "255.255.255.0")
+        self.manager.handle_packet(make_request(packet.REQUEST, requested_ip="10.0.0.5", server_id="10.0.0.1"))
+        self.assertEqual(self.receive()[0], packet.ACK)
+
+    def test_nak_for_other_address(self):
+        self.manager.handle_packet(make_request(packet.REQUEST, requested_ip="10.0.0.9"))
+        self.assertEqual(self.receive()[0], packet.NAK)
+
+    def test_request_for_other_server(self):
+        self.manager.handle_packet(make_request(packet.REQUEST, requested_ip="10.0.0.5",
+                                                server_id="10.0.0.2"))
+        self.assertEqual(self.manager.stats['replied'], 0)
+
+    def test_retransmit(self):
+        data = make_request(packet.DISCOVER)
+        self.manager.handle_packet(data)
+        self.manager.handle_packet(data)
+        self.assertEqual(self.manager.stats['dropped'], 1)
+        self.assertEqual(self.manager.stats['replied'], 1)
+        self.manager.handle_packet("junk")
+        self.assertEqual(self.manager.stats['malformed'], 1)
+
+@unittest.skipIf(config_master is None, "lcrs.master.config_master cannot be imported")
+class SegmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = config_master.config
+        config = ConfigParser.SafeConfigParser()
+        config.add_section("network:eth2")
+        for k, v in (("server-iface", "eth2"), ("server-ip", "10.20.22.1"),
+                     ("dhcp-prefix", "10.20.22."), ("dhcp-range-lower", "10"),
+                     ("dhcp-range-upper", "12")):
+            config.set("network:eth2", k, v)
+        config.add_section("network:eth1")
+        for k, v in (("server-iface", "eth1"), ("server-ip", "10.20.21.1"),
+                     ("dhcp-prefix", "10.20.21."), ("dhcp-range-lower", "100"),
+                     ("dhcp-range-upper", "101")):
+            config.set("network:eth1", k, v)
+        config.add_section("network:broken")
+        config.set("network:broken", "server-iface", "eth3")
+        config_master.config = config
+
+    def tearDown(self):
+        config_master.config = self.saved
+
+    def test_segments(self):
+        segments = config_master.dhcp_segments()
+        # [network] first, then the others by name, the broken one is left out
+        self.assertEqual([s['name'] for s in segments], [config_master.dhcpInterface, "eth1", "eth2"])
+        self.assertEqual(segments[1], {'name': "eth1", 'iface': "eth1", 'server_ip': "10.20.21.1",
+                                       'addresses': ["10.20.21.100", "10.20.21.101"]})
+        self.assertEqual(segments[2]['addresses'], ["10.20.22.10", "10.20.22.11", "10.20.22.12"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import httplib
+import tempfile
+import unittest
+import threading
+
+from lcrs.master import httpboot
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_closed(self):
+        self.assertEqual(httpboot.parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(httpboot.parse_range(" bytes = 10 - 19 ", 1000), (10, 19))
+
+    def test_past_the_end(self):
+        self.assertEqual(httpboot.parse_range("bytes=900-5000", 1000), (900, 999))
+
+    def test_open_ended(self):
+        self.assertEqual(httpboot.parse_range("bytes=100-", 1000), (100, 999))
+
+    def test_suffix(self):
+        self.assertEqual(httpboot.parse_range("bytes=-100", 1000), (900, 999))
+        # A suffix longer than the file is the whole file
+        self.assertEqual(httpboot.parse_range("bytes=-5000", 1000), (0, 999))
+
+    def test_unsatisfiable(self):
+        self.assertRaises(ValueError, httpboot.parse_range, "bytes=1000-", 1000)
+        self.assertRaises(ValueError, httpboot.parse_range, "bytes=500-100", 1000)
+        self.assertRaises(ValueError, httpboot.parse_range, "bytes=-0", 1000)
+
+    def test_whole_file(self):
+        self.assertEqual(httpboot.parse_range("bytes=0-9,20-29", 1000), None)
+        self.assertEqual(httpboot.parse_range("items=0-9", 1000), None)
+        self.assertEqual(httpboot.parse_range("bytes=-", 1000), None)
+
+class HTTPBootServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.content = "".join(chr(i % 251) for i in xrange(300000))
+        f = open(os.path.join(self.root, "initrd.gz"), "wb")
+        f.write(self.content)
+        f.close()
+        self.server = httpboot.HTTPBootServer(self.root, "127.0.0.1", 0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.conn = httplib.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def get(self, path, headers={}):
+        self.conn.request("GET", path, headers=headers)
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    def test_whole_file(self):
+        response, body = self.get("/initrd.gz")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Accept-Ranges"), "bytes")
+        self.assertEqual(body, self.content)
+        self.assertEqual(self.server.stats['bytes_sent'], len(self.content))
+
+    def test_partial(self):
+        response, body = self.get("/initrd.gz", {'Range': "bytes=1000-1999"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader("Content-Range"), "bytes 1000-1999/300000")
+        self.assertEqual(body, self.content[1000:2000])
+        # The connection is kept alive for the next range
+        response, body = self.get("/initrd.gz", {'Range': "bytes=-10"})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader("Content-Range"), "bytes 299990-299999/300000")
+        self.assertEqual(body, self.content[-10:])
+
+    def test_unsatisfiable(self):
+        response, body = self.get("/initrd.gz", {'Range': "bytes=300000-"})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader("Content-Range"), "bytes */300000")
+        self.assertEqual(body, "")
+
+    def test_several_ranges(self):
+        response, body = self.get("/initrd.gz", {'Range': "bytes=0-9,20-29"})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self.content)
+
+    def test_head(self):
+        self.conn.request("HEAD", "/initrd.gz")
+        response = self.conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Length"), "300000")
+        self.assertEqual(response.read(), "")
+
+    def test_errors(self):
+        self.assertEqual(self.get("/missing")[0].status, 404)
+        self.assertEqual(self.get("/../etc/passwd")[0].status, 403)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import socket
+import unittest
+import threading
+
+from lcrs.slave import protocol
+
+class PackFrameTest(unittest.TestCase):
+
+    def test_length_prefix(self):
+        message = [1, protocol.STATUS, {"a": [1, 2]}]
+        frame = protocol.pack_frame(message)
+        (length,) = protocol.FRAME_HEADER.unpack(frame[:protocol.FRAME_HEADER.size])
+        self.assertEqual(length, len(frame) - protocol.FRAME_HEADER.size)
+        self.assertEqual(json.loads(frame[protocol.FRAME_HEADER.size:]), message)
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def test_whole_frame(self):
+        decoder = protocol.FrameDecoder()
+        self.assertEqual(decoder.feed(protocol.pack_frame([1, 2, {}])), [[1, 2, {}]])
+        self.assertEqual(decoder.feed(""), [])
+
+    def test_split_header(self):
+        decoder = protocol.FrameDecoder()
+        frame = protocol.pack_frame([7, protocol.IDLE, {"x": "y"}])
+        # One byte at a time, the header arrives in four pieces
+        messages = []
+        for i in range(len(frame) - 1):
+            messages += decoder.feed(frame[i])
+            self.assertEqual(messages, [])
+        self.assertEqual(decoder.feed(frame[-1]), [[7, protocol.IDLE, {"x": "y"}]])
+
+    def test_split_body(self):
+        decoder = protocol.FrameDecoder()
+        frame = protocol.pack_frame([1, 0, {"dmesg": "x" * 10000}])
+        self.assertEqual(decoder.feed(frame[:6]), [])
+        self.assertEqual(decoder.feed(frame[6:5000]), [])
+        self.assertEqual(decoder.feed(frame[5000:]), [[1, 0, {"dmesg": "x" * 10000}]])
+
+    def test_several_frames_in_one_chunk(self):
+        decoder = protocol.FrameDecoder()
+        messages = [[i, protocol.STATUS, {"i": i}] for i in range(3)]
+        data = "".join(protocol.pack_frame(m) for m in messages)
+        # The last frame is cut, it is completed by the next chunk
+        next_frame = protocol.pack_frame([3, protocol.STATUS, {}])
+        self.assertEqual(decoder.feed(data + next_frame[:3]), messages)
+        self.assertEqual(decoder.feed(next_frame[3:]), [[3, protocol.STATUS, {}]])
+
+    def test_frame_too_large(self):
+        decoder = protocol.FrameDecoder(max_size=100)
+        self.assertEqual(decoder.feed(protocol.pack_frame("x" * 90)), ["x" * 90])
+        self.assertRaises(protocol.FrameTooLarge, decoder.feed,
+                          protocol.FRAME_HEADER.pack(101))
+
+    def test_frame_too_large_is_value_error(self):
+        decoder = protocol.FrameDecoder()
+        header = protocol.FRAME_HEADER.pack(protocol.MAX_FRAME_SIZE + 1)
+        self.assertRaises(ValueError, decoder.feed, header)
+
+class RecvExactlyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_collects_pieces(self):
+        self.a.sendall("abc")
+        self.a.sendall("defgh")
+        self.assertEqual(protocol.recv_exactly(self.b, 4), "abcd")
+        self.assertEqual(protocol.recv_exactly(self.b, 4), "efgh")
+
+    def test_larger_than_recv_size(self):
+        data = "".join(chr(i % 251) for i in range(protocol.RECV_SIZE * 3 + 17))
+        sender = threading.Thread(target=self.a.sendall, args=(data + "tail",))
+        sender.start()
+        try:
+            self.assertEqual(protocol.recv_exactly(self.b, len(data)), data)
+            self.assertEqual(protocol.recv_exactly(self.b, 4), "tail")
+        finally:
+            sender.join()
+
+    def test_closed_before_anything(self):
+        self.a.close()
+        self.assertEqual(protocol.recv_exactly(self.b, 4), "")
+
+    def test_closed_in_the_middle(self):
+        self.a.sendall("ab")
+        self.a.close()
+        self.assertRaises(socket.error, protocol.recv_exactly, self.b, 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import unittest
+from datetime import datetime
+from cStringIO import StringIO
+
+try:
+    from lcrs.master import reports
+except ImportError:
+    # The master's configuration loads the GTK plugins
+    reports = None
+
+@unittest.skipIf(reports is None, "lcrs.master.config_master cannot be imported")
+class HtmlReportTest(unittest.TestCase):
+
+    def record(self):
+        hw_info = {"BIOS S/N": "SN<1>",
+                   "CPU": {"name": "Intel Core 2 Duo"},
+                   "Memory": 2048,
+                   "Hard drives": {"sda": {"Size": 160000, "Serial": "WD-1"}}}
+        return reports.make_record(hw_info, "Group 1", "ID00001", "02:00:00:00:00:01", True,
+                                   "native wipe (zeros)", datetime(2012, 3, 4, 5, 6, 7))
+
+    def write(self, records):
+        f = StringIO()
+        count = reports.write_html(f, records)
+        return count, f.getvalue()
+
+    def test_cells_match_header(self):
+        count, html = self.write([self.record()])
+        self.assertEqual(count, 1)
+        header = len(re.findall(r"<th>", html))
+        row = re.search(r"<tr><td>ID00001.*?</tr>", html, re.S).group(0)
+        self.assertEqual(len(re.findall(r"<td>", row)), header)
+
+    def test_cpu_and_memory_share_a_cell(self):
+        count, html = self.write([self.record()])
+        self.assertTrue("<td>Intel Core 2 Duo<br />2048 MB RAM</td>" in html)
+
+    def test_escaped(self):
+        count, html = self.write([self.record()])
+        self.assertTrue("<td>SN&lt;1&gt;</td>" in html)
+
+if __name__ == "__main__":
+    unittest.main()
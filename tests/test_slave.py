@@ -0,0 +1,96 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+import socket
+import unittest
+import threading
+
+from lcrs.slave import protocol
+from lcrs.slave import settings
+from lcrs.slave.main import Slave
+
+def recv_frame(sock):
+    header = protocol.recv_exactly(sock, protocol.FRAME_HEADER.size)
+    if not header:
+        return None
+    (length,) = protocol.FRAME_HEADER.unpack(header)
+    return json.loads(protocol.recv_exactly(sock, length))
+
+class ClientSweepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (settings.CLIENT_TIMEOUT, settings.CLIENT_SWEEP_INTERVAL,
+                      settings.HEARTBEAT_INTERVAL)
+        settings.CLIENT_TIMEOUT = 0.3
+        settings.CLIENT_SWEEP_INTERVAL = 0.05
+        # No heartbeats, the subscriber must stay silent on both ends
+        settings.HEARTBEAT_INTERVAL = 3600.0
+        self.slave = Slave(listen_port=0)
+        self.port = self.slave.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.slave.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.slave.reactor.call_soon_threadsafe(self.slave.stop)
+        self.thread.join()
+        (settings.CLIENT_TIMEOUT, settings.CLIENT_SWEEP_INTERVAL,
+         settings.HEARTBEAT_INTERVAL) = self.saved
+
+    def connect(self):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        sock.settimeout(5.0)
+        sock.sendall(json.dumps([protocol.STATUS, {'upgrade': protocol.PROTOCOL_VERSION}]))
+        recv_frame(sock)
+        return sock
+
+    def is_open(self, sock):
+        """The slave has not closed the connection, i.e. nothing to read"""
+        sock.settimeout(0.05)
+        try:
+            return sock.recv(1) != ""
+        except socket.timeout:
+            return True
+        except socket.error:
+            return False
+        finally:
+            sock.settimeout(5.0)
+
+    def test_idle_client_is_dropped(self):
+        sock = self.connect()
+        time.sleep(settings.CLIENT_TIMEOUT * 3)
+        self.assertFalse(self.is_open(sock))
+        sock.close()
+
+    def test_subscribed_idle_client_outlives_timeout(self):
+        sock = self.connect()
+        sock.sendall(protocol.pack_frame([1, protocol.SUBSCRIBE, {}]))
+        request_id, state, data = recv_frame(sock)
+        self.assertEqual(request_id, 1)
+        time.sleep(settings.CLIENT_TIMEOUT * 3)
+        self.assertTrue(self.is_open(sock))
+        # And events still arrive on it
+        self.slave.reactor.call_soon_threadsafe(self.slave.publish, 'heartbeat')
+        request_id, state, data = recv_frame(sock)
+        self.assertEqual((request_id, data['event']), (1, 'heartbeat'))
+        sock.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,270 @@
+#
+# LCRS Copyright (C) 2009-2012
+# - Benjamin Bach
+# - Rene Jensen
+# - Michael Wojciechowski
+#
+# LCRS is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LCRS is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LCRS.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+import threading
+
+from lcrs.master import tftp
+
+def ack(number):
+    return struct.pack("!HH", tftp.OP_ACK, number & 0xffff)
+
+def parse_oack(data):
+    fields = data[2:].split("\0")
+    return dict(zip(fields[0::2], fields[1::2]))
+
+class TFTPTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.server = tftp.TFTPServer(self.root, "127.0.0.1", 0)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(2.0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.sock.close()
+        shutil.rmtree(self.root)
+
+    def make_file(self, name, size):
+        data = "".join(chr(i % 251) for i in xrange(size))
+        f = open(os.path.join(self.root, name), "wb")
+        f.write(data)
+        f.close()
+        return data
+
+    def transfer(self, name, **options):
+        """A transfer to self.client, driven by the test"""
+        options = dict((k, str(v)) for k, v in options.items())
+        transfer = tftp.Transfer(self.server, self.client.getsockname(),
+                                 os.path.join(self.root, name), options)
+        self.addCleanup(transfer.sock.close)
+        return transfer
+
+    def receive(self):
+        data, address = self.client.recvfrom(65536)
+        opcode = struct.unpack("!H", data[:2])[0]
+        return opcode, data
+
+    def receive_data(self):
+        opcode, data = self.receive()
+        self.assertEqual(opcode, tftp.OP_DATA)
+        return struct.unpack("!H", data[2:4])[0], data[4:]
+
+class ParseRequestTest(unittest.TestCase):
+
+    def test_options(self):
+        data = struct.pack("!H", tftp.OP_RRQ) + "pxelinux.0\0OCTET\0BLKSIZE\x001468\0tsize\x000\0"
+        self.assertEqual(tftp.parse_request(data),
+                         (tftp.OP_RRQ, "pxelinux.0", "octet", {'blksize': "1468", 'tsize': "0"}))
+
+    def test_malformed(self):
+        self.assertRaises(tftp.TransferError, tftp.parse_request, struct.pack("!H", tftp.OP_RRQ) + "name")
+
+class NegotiationTest(TFTPTestCase):
+
+    def test_no_options(self):
+        content = self.make_file("kernel", 1000)
+        transfer = self.transfer("kernel")
+        transfer.start()
+        # No OACK, the first block is sent right away
+        self.assertEqual(self.receive_data(), (1, content[:512]))
+
+    def test_oack(self):
+        self.make_file("kernel", 5000)
+        transfer = self.transfer("kernel", blksize=1024, windowsize=4, tsize=0, timeout=3)
+        transfer.start()
+        opcode, data = self.receive()
+        self.assertEqual(opcode, tftp.OP_OACK)
+        self.assertEqual(parse_oack(data), {'blksize': "1024", 'windowsize': "4",
+                                            'tsize': "5000", 'timeout': "3"})
+        self.assertEqual(transfer.blocks, 5)
+
+    def test_clamped(self):
+        self.make_file("kernel", 10)
+        transfer = self.transfer("kernel", blksize=65464, windowsize=1000, timeout=1000)
+        self.assertEqual((transfer.blksize, transfer.windowsize, transfer.timeout),
+                         (tftp.MAX_BLKSIZE, tftp.MAX_WINDOWSIZE, 255))
+        transfer = self.transfer("kernel", blksize=1, windowsize=0, timeout=0)
+        self.assertEqual((transfer.blksize, transfer.windowsize, transfer.timeout), (8, 1, 1))
+        transfer.start()
+        self.assertEqual(parse_oack(self.receive()[1]), {'blksize': "8", 'windowsize': "1", 'timeout': "1"})
+
+    def test_windows(self):
+        content = self.make_file("kernel", 3000)
+        transfer = self.transfer("kernel", blksize=512, windowsize=4)
+        transfer.start()
+        self.assertEqual(self.receive()[0], tftp.OP_OACK)
+        transfer.handle(ack(0), self.client.getsockname())
+        self.assertEqual([self.receive_data()[0] for __ in range(4)], [1, 2, 3, 4])
+        transfer.handle(ack(4), self.client.getsockname())
+        # 3000 bytes are 5 full blocks and an empty one
+        self.assertEqual(self.receive_data(), (5, content[2048:2560]))
+        self.assertEqual(self.receive_data(), (6, content[2560:]))
+        transfer.handle(ack(6), self.client.getsockname())
+        self.assertTrue(transfer.done)
+        self.assertEqual(transfer.stats['error'], None)
+
+class RetransmitTest(TFTPTestCase):
+
+    def test_timeout_sends_window_again(self):
+        self.make_file("kernel", 2000)
+        transfer = self.transfer("kernel", windowsize=2)
+        transfer.start()
+        self.receive()
+        transfer.handle(ack(0), self.client.getsockname())
+        self.assertEqual([self.receive_data()[0] for __ in range(2)], [1, 2])
+        # Nothing is sent again before the deadline
+        transfer.check_timeout(transfer.deadline - 0.5)
+        transfer.check_timeout(transfer.deadline + 0.1)
+        self.assertEqual([self.receive_data()[0] for __ in range(2)], [1, 2])
+        self.assertEqual(transfer.stats['retransmits'], 1)
+
+    def test_lost_oack(self):
+        self.make_file("kernel", 2000)
+        transfer = self.transfer("kernel", blksize=1024)
+        transfer.start()
+        self.assertEqual(self.receive()[0], tftp.OP_OACK)
+        transfer.check_timeout(transfer.deadline + 0.1)
+        self.assertEqual(self.receive()[0], tftp.OP_OACK)
+
+    def test_partial_window(self):
+        self.make_file("kernel", 4000)
+        transfer = self.transfer("kernel", windowsize=4)
+        transfer.start()
+        self.receive()
+        transfer.handle(ack(0), self.client.getsockname())
+        [self.receive_data() for __ in range(4)]
+        # Block 3 was lost, the window starts over after block 2
+        transfer.handle(ack(2), self.client.getsockname())
+        self.assertEqual([self.receive_data()[0] for __ in range(4)], [3, 4, 5, 6])
+        self.assertEqual(transfer.stats['retransmits'], 1)
+
+    def test_duplicate_ack_is_ignored(self):
+        self.make_file("kernel", 2000)
+        transfer = self.transfer("kernel")
+        transfer.start()
+        self.receive_data()
+        transfer.handle(ack(1), self.client.getsockname())
+        self.receive_data()
+        transfer.handle(ack(1), self.client.getsockname())
+        self.client.settimeout(0.2)
+        self.assertRaises(socket.timeout, self.client.recvfrom, 65536)
+
+    def test_gives_up(self):
+        self.make_file("kernel", 2000)
+        transfer = self.transfer("kernel")
+        transfer.start()
+        for __ in range(tftp.RETRIES + 1):
+            transfer.check_timeout(transfer.deadline + 0.1)
+        self.assertTrue(transfer.done)
+        self.assertEqual(transfer.stats['error'], "Timed out")
+
+    def test_unknown_tid(self):
+        self.make_file("kernel", 2000)
+        transfer = self.transfer("kernel")
+        other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        other.bind(("127.0.0.1", 0))
+        other.settimeout(2.0)
+        try:
+            transfer.handle(ack(1), other.getsockname())
+            data = other.recv(65536)
+            self.assertEqual(struct.unpack("!HH", data[:4]), (tftp.OP_ERROR, tftp.ERROR_UNKNOWN_TID))
+        finally:
+            other.close()
+        self.assertFalse(transfer.done)
+
+class RolloverTest(TFTPTestCase):
+
+    def test_block_numbers_wrap(self):
+        # 65540 blocks of 8 bytes, the block number wraps after 65535
+        content = self.make_file("big", 8 * 65540)
+        transfer = self.transfer("big", blksize=8, windowsize=4)
+        client = self.client.getsockname()
+        # Pretend blocks up to 65534 went through
+        transfer.acked = 65533
+        transfer.sent = 65534
+        transfer.handle(ack(65534), client)
+        received = [self.receive_data() for __ in range(4)]
+        self.assertEqual([number for number, __ in received], [65535, 0, 1, 2])
+        self.assertEqual(received[2][1], content[65536 * 8:65537 * 8])
+        # ACK of the block numbered 2 is block 65538
+        transfer.handle(ack(2), client)
+        self.assertEqual(transfer.acked, 65538)
+        self.assertEqual(self.receive_data(), (3, content[65538 * 8:65539 * 8]))
+        # A late ACK from before the wrap is a duplicate
+        transfer.handle(ack(65535), client)
+        self.assertEqual(transfer.acked, 65538)
+
+class ServerTest(TFTPTestCase):
+
+    def setUp(self):
+        TFTPTestCase.setUp(self)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        TFTPTestCase.tearDown(self)
+
+    def request(self, filename, options=""):
+        self.client.sendto(struct.pack("!H", tftp.OP_RRQ) + filename + "\0octet\0" + options,
+                           ("127.0.0.1", self.server.port))
+
+    def test_fetch(self):
+        content = self.make_file("kernel", 10000)
+        self.request("kernel", "blksize\x001468\0windowsize\x004\0")
+        data, peer = self.client.recvfrom(65536)
+        # The transfer answers from its own port, not the server's
+        self.assertNotEqual(peer[1], self.server.port)
+        self.assertEqual(struct.unpack("!H", data[:2])[0], tftp.OP_OACK)
+        self.client.sendto(ack(0), peer)
+        received = []
+        expected = 1
+        while True:
+            number, block = self.receive_data()
+            self.assertEqual(number, expected)
+            received.append(block)
+            if len(block) < 1468 or number % 4 == 0:
+                self.client.sendto(ack(number), peer)
+            if len(block) < 1468:
+                break
+            expected += 1
+        self.assertEqual("".join(received), content)
+
+    def test_errors(self):
+        self.request("../etc/passwd")
+        opcode, data = self.receive()
+        self.assertEqual(struct.unpack("!HH", data[:4]), (tftp.OP_ERROR, tftp.ERROR_ACCESS))
+        self.request("missing")
+        opcode, data = self.receive()
+        self.assertEqual(struct.unpack("!HH", data[:4]), (tftp.OP_ERROR, tftp.ERROR_NOT_FOUND))
+        self.client.sendto(struct.pack("!H", tftp.OP_WRQ) + "kernel\0octet\0", ("127.0.0.1", self.server.port))
+        opcode, data = self.receive()
+        self.assertEqual(struct.unpack("!HH", data[:4]), (tftp.OP_ERROR, tftp.ERROR_ACCESS))
+
+if __name__ == "__main__":
+    unittest.main()